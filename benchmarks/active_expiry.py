@@ -0,0 +1,43 @@
+"""
+Keys left behind by lazy-only expiry against the active expire cycle, for a workload that writes --keys keys with a
+short TTL and never reads them back. Also reports the longest single cron call, the pause the cycle adds.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.database import Database  # noqa: E402
+
+
+def run(workdir, keys, ttl_ms, active):
+    database = Database('bench', os.path.join(workdir, f'active_{active}.log'), None, appendfsync='no')
+    set_args = argparse.Namespace(NX=False, XX=False, KEEPTTL=False, EX=None, PX=ttl_ms)
+    longest_cron = 0.0
+    start = time.perf_counter()
+    for i in range(keys):
+        database.set(f'key:{i}', f'value-{i}', set_args)
+        if active and i % 100 == 0:
+            # The server runs cron between commands, every 100 writes stands in for its 100ms interval
+            cron_start = time.perf_counter()
+            database.cron()
+            longest_cron = max(longest_cron, time.perf_counter() - cron_start)
+    elapsed = time.perf_counter() - start
+    stats = database.expiry_stats()
+    database.aof.close()
+    return elapsed, len(database.data), stats, longest_cron
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Lazy vs active key expiry.')
+    parser.add_argument('--keys', default=500000, type=int)
+    parser.add_argument('--ttl_ms', default=50, type=int)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_expiry_')
+    for label, active_cycle in (('lazy only', False), ('active', True)):
+        elapsed_time, left, expiry, pause = run(directory, args.keys, args.ttl_ms, active_cycle)
+        print(f'{label:<10}{elapsed_time:>8.2f}s  keys left {left:>9,}  expired {expiry["expired_keys"]:>9,}  '
+              f'longest cron {pause * 1000:>6.2f}ms')
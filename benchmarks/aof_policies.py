@@ -0,0 +1,52 @@
+"""
+Write throughput of Database.set under each appendfsync policy, next to the logging module based log it replaced.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.database import Database  # noqa: E402
+
+SET_ARGS = argparse.Namespace(NX=False, XX=False, KEEPTTL=False, EX=None, PX=None)
+
+
+def logging_baseline(workdir, count):
+    logger = logging.getLogger('bench')
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler(os.path.join(workdir, 'logging.log'))
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+    logger.addHandler(handler)
+    start = time.perf_counter()
+    for i in range(count):
+        logger.info(f'SET key{i} value{i} None')
+    elapsed = time.perf_counter() - start
+    handler.close()
+    return elapsed
+
+
+def policy_run(workdir, policy, count):
+    database = Database(f'bench_{policy}', os.path.join(workdir, f'{policy}.log'), None, appendfsync=policy)
+    start = time.perf_counter()
+    for i in range(count):
+        database.set(f'key{i}', f'value{i}', SET_ARGS)
+    database.aof.close()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='AOF write throughput per fsync policy.')
+    parser.add_argument('--count', default=100000, type=int)
+    parser.add_argument('--always_count', default=2000, type=int, help='fsync per write is slow, use fewer writes')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_aof_')
+    elapsed_time = logging_baseline(directory, args.count)
+    print(f'{"logging module":<16}{args.count:>9} writes {elapsed_time:>8.3f}s {args.count / elapsed_time:>12,.0f} w/s')
+    for fsync_policy in ('no', 'everysec', 'always'):
+        writes = args.always_count if fsync_policy == 'always' else args.count
+        elapsed_time = policy_run(directory, fsync_policy, writes)
+        print(f'{fsync_policy:<16}{writes:>9} writes {elapsed_time:>8.3f}s {writes / elapsed_time:>12,.0f} w/s')
@@ -0,0 +1,79 @@
+"""
+Negative lookup cache (--bloom_error_rate) on a read workload where --miss_ratio of the GETs are for absent keys. A
+database of --keys keys is loaded without the filter and with one per --error_rates rate, then --reads GETs are timed
+both through validate_tokens + process_command, the server's path minus the network, and straight on Database.get,
+where the lookup itself is most of the cost. Prints the throughput, the filter's size next to the key dict's and its
+expected and observed false positive rates.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine import Session  # noqa: E402
+from modules.database import db_map  # noqa: E402
+
+
+def session_for(error_rate, directory):
+    session = Session(argparse.Namespace(log_path=os.path.join(directory, 'logs'),
+                                         database_path=os.path.join(directory, 'databases'),
+                                         RDB_persistence=False, RDB_timeout=30, AOF_persistence=False,
+                                         appendfsync='no', auto_aof_rewrite_percentage=100,
+                                         auto_aof_rewrite_min_size=64, maxmemory=0,
+                                         maxmemory_policy='noeviction', maxmemory_samples=5, debug=False,
+                                         bloom_error_rate=error_rate))
+    for path in ('logs', 'databases'):
+        os.makedirs(os.path.join(directory, path), exist_ok=True)
+    return session
+
+
+def execute(session, tokens):
+    validated, parsed = session.validate_tokens(tokens)
+    return session.process_command(validated[0], parsed, validated)
+
+
+def run(error_rate, keys, args):
+    session = session_for(error_rate, tempfile.mkdtemp(prefix='bench_bloom_'))
+    name = f'bench{len(db_map)}'
+    execute(session, ['SELECT', name])
+    database = db_map[name]
+    for offset in range(0, args.keys, 1000):
+        execute(session, ['MSET'] + [token for i in range(offset, min(offset + 1000, args.keys))
+                                     for token in (f'key:{i}', 'value')])
+
+    start = time.perf_counter()
+    for key in keys:
+        execute(session, ['GET', key])
+    command = len(keys) / (time.perf_counter() - start)
+    get = database.get
+    start = time.perf_counter()
+    for key in keys:
+        get(key)
+    lookup = len(keys) / (time.perf_counter() - start)
+
+    stats = database.keyspace_stats()
+    label = f'bloom {error_rate}' if error_rate else 'no filter'
+    line = f'{label:<14}GET {command:>10,.0f}/s   Database.get {lookup:>12,.0f}/s'
+    if error_rate:
+        line += (f'   filter {stats["bloom_bytes"] / 1024:>7,.0f} KB (key dict {sys.getsizeof(database.data) / 1024:,.0f} '
+                 f'KB)   fpr expected {stats["bloom_expected_fpr"]:.4f} observed {stats["bloom_observed_fpr"]:.4f}')
+    print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='GET throughput with and without a Bloom filter on a miss heavy load.')
+    parser.add_argument('--keys', default=100000, type=int, help='Keys in the database')
+    parser.add_argument('--reads', default=200000, type=int)
+    parser.add_argument('--miss_ratio', default=0.9, type=float, help='Fraction of GETs for absent keys')
+    parser.add_argument('--error_rates', nargs='+', default=[0.01, 0.001], type=float)
+    bench_args = parser.parse_args()
+
+    rng = random.Random(0)
+    # Absent keys share the prefix of the present ones, so neither side gets a cheaper hash or comparison
+    read_keys = [f'key:{bench_args.keys + rng.randrange(10 * bench_args.keys)}' if rng.random() < bench_args.miss_ratio
+                 else f'key:{rng.randrange(bench_args.keys)}' for _ in range(bench_args.reads)]
+    for rate in [None] + bench_args.error_rates:
+        run(rate, read_keys, bench_args)
@@ -0,0 +1,96 @@
+"""
+Client side caching (Client(cache_size=...) against server.py --tracking_port) on a skewed read mostly workload.
+--keys keys are read with a power law skew, a few hot keys take most reads, while a separate writer process keeps
+overwriting random keys at --write_rate writes per second. Each run reads --reads keys through one Client, without a
+cache and with caches of each --cache_sizes size, and prints the GET throughput, latency percentiles and hit rate.
+Once the writer stopped and the last invalidations are in, every key still cached must match the server.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from client import Client  # noqa: E402
+from benchmarks.server_throughput import start_server  # noqa: E402
+
+
+def skewed(rng, keys, skew):
+    return f'key:{int(keys * rng.random() ** skew)}'
+
+
+def write_load(port, keys, rate, stop):
+    client = Client(port=port, database='bench', pool_size=1)
+    rng = random.Random(1)
+    count = 0
+    start = time.perf_counter()
+    while not stop.is_set():
+        client.set(f'key:{rng.randrange(keys)}', f'value-{count}')
+        count += 1
+        delay = start + count / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    client.close()
+
+
+def run(port, cache_size, args):
+    client = Client(port=port, database='bench', pool_size=1, cache_size=cache_size)
+    client.get('key:0')
+    # The first heartbeat makes the cache trust the invalidation stream
+    time.sleep(0.3)
+    stop = multiprocessing.Event()
+    writer = multiprocessing.Process(target=write_load, args=(port, args.keys, args.write_rate, stop))
+    writer.start()
+    rng = random.Random(2)
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(args.reads):
+        key = skewed(rng, args.keys, args.skew)
+        began = time.perf_counter()
+        client.get(key)
+        latencies.append(time.perf_counter() - began)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    writer.join()
+
+    latencies.sort()
+    label = f'cache {cache_size:,} keys' if cache_size else 'no cache'
+    line = (f'{label:<20}{args.reads / elapsed:>10,.0f} GET/s   p50 {latencies[len(latencies) // 2] * 1e3:>6.3f} ms   '
+            f'p99 {latencies[int(len(latencies) * 0.99)] * 1e3:>6.3f} ms')
+    if client.cache is not None:
+        cache = client.cache
+        line += f'   hit rate {cache.hits / (cache.hits + cache.misses):>6.1%}   invalidated {cache.invalidations:,}'
+        time.sleep(0.3)
+        plain = Client(port=port, database='bench', pool_size=1)
+        stale = sum(client.get(f'key:{i}') != plain.get(f'key:{i}') for i in range(args.keys))
+        line += f'   stale {stale}'
+        plain.close()
+    print(line)
+    client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Latency and hit rate of client side caching.')
+    parser.add_argument('--keys', default=10000, type=int)
+    parser.add_argument('--reads', default=50000, type=int)
+    parser.add_argument('--skew', default=3.0, type=float, help='Power of the key distribution, 1 for uniform')
+    parser.add_argument('--write_rate', default=500, type=int, help='Writes per second from the writer process')
+    parser.add_argument('--cache_sizes', nargs='+', default=[100, 1000, 10000], type=int)
+    parser.add_argument('--port', default=5899, type=int)
+    bench_args = parser.parse_args()
+
+    server = start_server('router', bench_args.port, tempfile.mkdtemp(prefix='bench_cache_'),
+                          ['--tracking_port', str(bench_args.port + 100)])
+    try:
+        loader = Client(port=bench_args.port, database='bench')
+        for offset in range(0, bench_args.keys, 1000):
+            loader.mset({f'key:{i}': f'value-{i}' for i in range(offset, min(offset + 1000, bench_args.keys))})
+        loader.close()
+        for size in [0] + bench_args.cache_sizes:
+            run(bench_args.port, size, bench_args)
+    finally:
+        server.terminate()
+        server.wait()
@@ -0,0 +1,93 @@
+"""
+Many concurrent callers against one server.py, through the client.py APIs:
+    session+lock   one ClientSession shared under a lock, what a program had to do before Client existed
+    Client pool    threads sharing a Client, each call borrows one of --pool_size pooled connections
+    AsyncClient    asyncio tasks sharing a single AsyncClient, every caller's request in flight at once
+Each caller runs --calls GET/SET pairs, throughput and per call latency percentiles are printed per caller count.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from client import AsyncClient, Client, ClientSession  # noqa: E402
+from benchmarks.server_throughput import start_server  # noqa: E402
+
+
+def report(label, callers, latencies, elapsed):
+    latencies.sort()
+    print(f'{label:<16}{callers:>5} callers {len(latencies) / elapsed:>10,.0f} calls/s   '
+          f'p50 {latencies[len(latencies) // 2] * 1e3:>7.2f} ms   p99 {latencies[int(len(latencies) * 0.99)] * 1e3:>7.2f} ms')
+
+
+def threaded(label, callers, calls, call):
+    latencies = []
+
+    def caller(index):
+        mine = []
+        for i in range(calls):
+            key = f'key:{index}:{i % 100}'
+            start = time.perf_counter()
+            call('SET', key, str(i))
+            call('GET', key)
+            mine.append((time.perf_counter() - start) / 2)
+        latencies.extend(mine)
+
+    threads = [threading.Thread(target=caller, args=(index,)) for index in range(callers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report(label, callers, latencies, (time.perf_counter() - start) / 2)
+
+
+async def asynchronous(port, callers, calls):
+    client = AsyncClient(port=port, database='bench')
+    latencies = []
+
+    async def caller(index):
+        for i in range(calls):
+            key = f'key:{index}:{i % 100}'
+            start = time.perf_counter()
+            await client.set(key, str(i))
+            await client.get(key)
+            latencies.append((time.perf_counter() - start) / 2)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(caller(index) for index in range(callers)))
+    report('AsyncClient', callers, latencies, (time.perf_counter() - start) / 2)
+    client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Client throughput and latency with many concurrent callers.')
+    parser.add_argument('--callers', nargs='+', default=[1, 8, 64], type=int)
+    parser.add_argument('--calls', default=500, type=int, help='GET/SET pairs per caller')
+    parser.add_argument('--pool_size', default=16, type=int)
+    parser.add_argument('--port', default=5893, type=int)
+    args = parser.parse_args()
+
+    server = start_server('router', args.port, tempfile.mkdtemp(prefix='bench_client_'))
+    try:
+        session = ClientSession(argparse.Namespace(server_host='localhost', server_port=args.port))
+        session.execute_command('SELECT', 'bench')
+        lock = threading.Lock()
+
+        def locked(*tokens):
+            with lock:
+                return session.execute_command(*tokens)
+
+        client = Client(port=args.port, database='bench', pool_size=args.pool_size)
+        for caller_count in args.callers:
+            threaded('session+lock', caller_count, args.calls, locked)
+            threaded('Client pool', caller_count, args.calls, client.execute_command)
+            asyncio.run(asynchronous(args.port, caller_count, args.calls))
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
@@ -0,0 +1,97 @@
+"""
+Cost and gain of --compression on JSON documents of --min_size to --max_size bytes. For no compression and each
+--codecs codec, --values documents are SET into an in-process Session with the append only log on, read back with GET,
+and snapshotted. Prints the compression ratio, the SET and GET time per value, and the dataset's estimated memory,
+log size and snapshot size, so --compression_min_size can be weighed against them.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine import Session  # noqa: E402
+from modules import rdb  # noqa: E402
+from modules.database import db_map  # noqa: E402
+
+
+def document(rng, size):
+    # Records with the repetitive field names and mixed values typical of API payloads, about size bytes of JSON
+    records = []
+    length = 2
+    while length < size:
+        record = {'id': rng.randrange(10 ** 9), 'name': f'user-{rng.randrange(10 ** 6)}',
+                  'email': f'user{rng.randrange(10 ** 6)}@example.com', 'active': rng.random() < 0.5,
+                  'score': round(rng.random() * 1000, 3), 'tags': rng.sample(['red', 'green', 'blue', 'admin', 'beta',
+                                                                               'trial', 'eu', 'us'], 3)}
+        records.append(record)
+        length += len(json.dumps(record)) + 2
+    return json.dumps(records)
+
+
+def session_for(codec, min_size, directory):
+    session = Session(argparse.Namespace(log_path=os.path.join(directory, 'logs'),
+                                         database_path=os.path.join(directory, 'databases'),
+                                         RDB_persistence=False, RDB_timeout=30, AOF_persistence=True,
+                                         appendfsync='no', auto_aof_rewrite_percentage=100,
+                                         auto_aof_rewrite_min_size=64, maxmemory=0,
+                                         maxmemory_policy='noeviction', maxmemory_samples=5, debug=False,
+                                         compression=codec, compression_min_size=min_size))
+    for path in ('logs', 'databases'):
+        os.makedirs(os.path.join(directory, path), exist_ok=True)
+    return session
+
+
+def execute(session, tokens):
+    validated, parsed = session.validate_tokens(tokens)
+    return session.process_command(validated[0], parsed, validated)
+
+
+def run(codec, documents, args):
+    directory = tempfile.mkdtemp(prefix='bench_compression_')
+    session = session_for(codec, args.min_compress, directory)
+    name = f'bench{len(db_map)}'
+    execute(session, ['SELECT', name])
+    database = db_map[name]
+
+    start = time.perf_counter()
+    for index, value in enumerate(documents):
+        execute(session, ['SET', f'doc:{index}', value])
+    set_time = (time.perf_counter() - start) / len(documents)
+    start = time.perf_counter()
+    for index in range(len(documents)):
+        if execute(session, ['GET', f'doc:{index}']) != documents[index]:
+            raise AssertionError(f'doc:{index} came back changed')
+    get_time = (time.perf_counter() - start) / len(documents)
+
+    database.aof.flush()
+    snapshot = os.path.join(directory, 'snapshot.rdb')
+    start = time.perf_counter()
+    rdb.dump(database.data, snapshot)
+    dump_time = time.perf_counter() - start
+    stats = database.keyspace_stats()
+    label = codec or 'none'
+    print(f'{label:<6}ratio {stats.get("compression_ratio", 1.0):>5.2f}   SET {set_time * 1e6:>7.0f} us   '
+          f'GET {get_time * 1e6:>7.0f} us   memory {stats["used_memory"] / 2 ** 20:>7.2f} MB   '
+          f'log {os.path.getsize(database.log_path) / 2 ** 20:>7.2f} MB   '
+          f'snapshot {os.path.getsize(snapshot) / 2 ** 20:>7.2f} MB in {dump_time * 1e3:>5.0f} ms')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compression ratio and CPU cost of compressed string values.')
+    parser.add_argument('--values', default=500, type=int)
+    parser.add_argument('--min_size', default=10000, type=int, help='Smallest document in bytes')
+    parser.add_argument('--max_size', default=100000, type=int, help='Largest document in bytes')
+    parser.add_argument('--codecs', nargs='+', default=['zlib', 'lzma'], choices=['zlib', 'lzma'])
+    parser.add_argument('--min_compress', default=1024, type=int, help='--compression_min_size of the runs')
+    bench_args = parser.parse_args()
+
+    generator = random.Random(0)
+    docs = [document(generator, generator.randrange(bench_args.min_size, bench_args.max_size + 1))
+            for _ in range(bench_args.values)]
+    print(f'{len(docs)} documents, {sum(map(len, docs)) / 2 ** 20:.1f} MB of JSON')
+    for name in [None] + bench_args.codecs:
+        run(name, docs, bench_args)
@@ -0,0 +1,96 @@
+"""
+Cache hit rate of each maxmemory policy on a synthetic access trace: GET a key, SET it on a miss. The trace mixes a
+Zipf distributed hot set with sequential scans over cold keys, which plain LRU handles badly and LFU shrugs off.
+Next to every policy the hit rate of an exact LRU cache of the same number of keys is printed as a reference. Fails
+if sampled allkeys-lru strays more than --tolerance from it, or allkeys-lfu does no better than allkeys-lru.
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.database import Database, EVICTION_POLICIES  # noqa: E402
+
+
+def build_trace(length, keys, zipf_s, scan_every, scan_length, seed):
+    rng = random.Random(seed)
+    weights = list(itertools.accumulate(1.0 / (rank ** zipf_s) for rank in range(1, keys + 1)))
+    trace = rng.choices(range(keys), cum_weights=weights, k=length)
+    scan_key = keys
+    for start in range(scan_every, length, scan_every):
+        trace[start:start + scan_length] = range(scan_key, scan_key + scan_length)
+        scan_key += scan_length
+    return [f'key:{key}' for key in trace[:length]]
+
+
+def policy_run(workdir, policy, trace, maxmemory, samples):
+    database = Database('bench', os.path.join(workdir, f'{policy}.log'), None, aof_enabled=False)
+    database.maxmemory = maxmemory
+    database.maxmemory_policy = policy
+    database.maxmemory_samples = samples
+    set_args = argparse.Namespace(NX=False, XX=False, KEEPTTL=False, EX=3600, PX=None)
+    hits = 0
+    start = time.perf_counter()
+    for key in trace:
+        if database.get(key) is not None:
+            hits += 1
+        else:
+            database.set(key, 'x' * 32, set_args)
+    return hits / len(trace), time.perf_counter() - start, len(database.data)
+
+
+def exact_lru(trace, capacity):
+    cache = OrderedDict()
+    hits = 0
+    for key in trace:
+        if key in cache:
+            cache.move_to_end(key)
+            hits += 1
+        else:
+            cache[key] = True
+            if len(cache) > capacity:
+                cache.popitem(last=False)
+    return hits / len(trace)
+
+
+def check_hit_rates(results, tolerance):
+    # results: policy -> (hit rate, exact LRU hit rate at the keys it kept)
+    lru, exact = results['allkeys-lru']
+    if abs(lru - exact) > tolerance:
+        raise AssertionError(f'sampled allkeys-lru hit rate {lru:.1%} is off exact LRU {exact:.1%} by more than '
+                             f'{tolerance:.1%}')
+    lfu = results['allkeys-lfu'][0]
+    if lfu <= lru:
+        raise AssertionError(f'allkeys-lfu hit rate {lfu:.1%} does not beat allkeys-lru {lru:.1%} on a scanned trace')
+    print(f'sampled LRU within {tolerance:.1%} of exact LRU, LFU ahead of LRU by {lfu - lru:.1%}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Hit rate per eviction policy on a synthetic trace.')
+    parser.add_argument('--length', default=500000, type=int, help='Trace length')
+    parser.add_argument('--keys', default=100000, type=int, help='Distinct keys in the Zipf distributed part')
+    parser.add_argument('--zipf', default=0.9, type=float, help='Zipf exponent')
+    parser.add_argument('--scan_every', default=20000, type=int)
+    parser.add_argument('--scan_length', default=5000, type=int)
+    parser.add_argument('--maxmemory', default=2, type=int, help='MB')
+    parser.add_argument('--samples', default=5, type=int)
+    parser.add_argument('--tolerance', default=0.02, type=float,
+                        help='Largest gap allowed between sampled and exact LRU hit rates')
+    args = parser.parse_args()
+
+    access_trace = build_trace(args.length, args.keys, args.zipf, args.scan_every, args.scan_length, seed=42)
+    directory = tempfile.mkdtemp(prefix='bench_eviction_')
+    policy_results = {}
+    for eviction_policy in EVICTION_POLICIES[1:]:
+        hit_rate, elapsed_time, kept = policy_run(directory, eviction_policy, access_trace, args.maxmemory * 1024 * 1024,
+                                                  args.samples)
+        reference = exact_lru(access_trace, kept)
+        policy_results[eviction_policy] = hit_rate, reference
+        print(f'{eviction_policy:<16} hit rate {hit_rate:>6.1%}  exact LRU at {kept:,} keys '
+              f'{reference:>6.1%}  {len(access_trace) / elapsed_time:>9,.0f} ops/s')
+    check_hit_rates(policy_results, args.tolerance)
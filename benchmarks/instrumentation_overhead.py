@@ -0,0 +1,86 @@
+"""
+Cost of the INFO/SLOWLOG instrumentation around Session.process_command. Every command run pays for two
+time.perf_counter_ns() calls and one ServerStats.record(), timed here on their own and set against a whole GET and SET
+through validate_tokens + process_command on an in-process Session, with latency tracking on and off, and against a
+GET round trip to server.py.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine import Session  # noqa: E402
+from client import Client  # noqa: E402
+from benchmarks.server_throughput import start_server  # noqa: E402
+from modules.stats import ServerStats  # noqa: E402
+
+
+def per_call(function, count):
+    start = time.perf_counter()
+    function(count)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def instrumentation(count):
+    stats = ServerStats()
+    perf_counter_ns = time.perf_counter_ns
+    for _ in range(count):
+        start = perf_counter_ns()
+        stats.record('GET', (perf_counter_ns() - start) // 1000, 'value')
+
+
+def execute(session, tokens):
+    validated, parsed = session.validate_tokens(tokens)
+    return session.process_command(validated[0], parsed, validated)
+
+
+def commands(session, tokens):
+    def run(count):
+        for i in range(count):
+            execute(session, [tokens[0], f'key:{i % 1000}', *tokens[1:]])
+    return run
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Overhead of per command stats and latency histograms.')
+    parser.add_argument('--count', default=200000, type=int)
+    parser.add_argument('--port', default=5901, type=int)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_stats_')
+    session = Session(argparse.Namespace(log_path=os.path.join(directory, 'logs'),
+                                         database_path=os.path.join(directory, 'databases'),
+                                         RDB_persistence=False, RDB_timeout=30, AOF_persistence=False,
+                                         appendfsync='no', auto_aof_rewrite_percentage=100,
+                                         auto_aof_rewrite_min_size=64, maxmemory=0,
+                                         maxmemory_policy='noeviction', maxmemory_samples=5, debug=False))
+    os.makedirs(os.path.join(directory, 'databases'))
+    execute(session, ['SELECT', 'bench'])
+
+    cost = per_call(instrumentation, args.count)
+    print(f'{"perf_counter_ns x2 + record":<36}{cost:>8.3f} us/call')
+    for tracking in (True, False):
+        session.stats.latency_tracking = tracking
+        for name, tokens in (('SET', ['SET', 'value']), ('GET', ['GET'])):
+            command_cost = per_call(commands(session, tokens), args.count)
+            print(f'{name} latency tracking {"on" if tracking else "off":<17}{command_cost:>8.3f} us/call   '
+                  f'instrumentation {cost / command_cost:>6.1%} of it')
+    print(execute(session, ['INFO', 'latencystats']))
+
+    server = start_server('router', args.port, tempfile.mkdtemp(prefix='bench_stats_'))
+    try:
+        client = Client(port=args.port, database='bench', pool_size=1)
+        client.set('key', 'value')
+
+        def round_trips(count):
+            for _ in range(count):
+                client.get('key')
+        round_trip = per_call(round_trips, args.count // 10)
+        print(f'{"GET round trip to server.py":<36}{round_trip:>8.3f} us/call   '
+              f'instrumentation {cost / round_trip:>6.1%} of it')
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
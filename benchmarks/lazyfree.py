@@ -0,0 +1,86 @@
+"""
+Stall caused by dropping a big sorted set, freed at once versus lazily. For each way of dropping it (DEL, UNLINK, DEL
+and an overwriting SET with --lazyfree, expiry with --lazyfree) a sorted set of --members members is built on an
+in-process Session, dropped, and --gets GETs follow with the session's cron after each, as server.py runs them. Prints
+how long the dropping command took, the worst and p99 latency of the GETs that followed and how long until the set was
+fully released.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine import Session  # noqa: E402
+from modules.database import db_map  # noqa: E402
+
+SCENARIOS = (('DEL', False, ['DEL', 'big']), ('UNLINK', False, ['UNLINK', 'big']),
+             ('DEL --lazyfree', True, ['DEL', 'big']), ('SET --lazyfree', True, ['SET', 'big', 'value']),
+             ('expiry --lazyfree', True, None))
+
+
+def session_for(lazyfree, directory):
+    session = Session(argparse.Namespace(log_path=os.path.join(directory, 'logs'),
+                                         database_path=os.path.join(directory, 'databases'),
+                                         RDB_persistence=False, RDB_timeout=30, AOF_persistence=False,
+                                         appendfsync='no', auto_aof_rewrite_percentage=100,
+                                         auto_aof_rewrite_min_size=64, maxmemory=0,
+                                         maxmemory_policy='noeviction', maxmemory_samples=5, debug=False,
+                                         lazyfree=lazyfree, lazyfree_threshold=1024))
+    for path in ('logs', 'databases'):
+        os.makedirs(os.path.join(directory, path), exist_ok=True)
+    return session
+
+
+def execute(session, tokens):
+    validated, parsed = session.validate_tokens(tokens)
+    return session.process_command(validated[0], parsed, validated)
+
+
+def run(name, lazyfree, tokens, args):
+    session = session_for(lazyfree, tempfile.mkdtemp(prefix='bench_lazyfree_'))
+    database_name = f'bench{len(db_map)}'
+    execute(session, ['SELECT', database_name])
+    database = db_map[database_name]
+    execute(session, ['SET', 'key', 'value'])
+    for offset in range(0, args.members, 1000):
+        execute(session, ['ZADD', 'big'] + [token for i in range(offset, min(offset + 1000, args.members))
+                                             for token in (str(i), f'member:{i}')])
+
+    if tokens is None:
+        # Due straight away, the first cron expires it
+        execute(session, ['EXPIRE', 'big', '0'])
+        time.sleep(0.01)
+        start = time.perf_counter()
+        session.cron()
+    else:
+        start = time.perf_counter()
+        execute(session, tokens)
+        session.cron()
+    drop = time.perf_counter() - start
+
+    latencies = []
+    released = None
+    began = time.perf_counter()
+    for _ in range(args.gets):
+        start = time.perf_counter()
+        execute(session, ['GET', 'key'])
+        session.cron()
+        latencies.append(time.perf_counter() - start)
+        if released is None and not database.lazyfree_pending_objects:
+            released = time.perf_counter() - began
+    latencies.sort()
+    print(f'{name:<20}drop {drop * 1e3:>8.2f} ms   GET p99 {latencies[int(len(latencies) * 0.99)] * 1e3:>6.3f} ms   '
+          f'max {latencies[-1] * 1e3:>6.3f} ms   released after '
+          + ('-' if released is None else f'{released * 1e3:.0f} ms'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Latency impact of freeing big values at once or lazily.')
+    parser.add_argument('--members', default=1000000, type=int, help='Members of the sorted set that gets dropped')
+    parser.add_argument('--gets', default=5000, type=int, help='GETs timed after dropping it')
+    bench_args = parser.parse_args()
+
+    for scenario in SCENARIOS:
+        run(*scenario, bench_args)
@@ -0,0 +1,45 @@
+"""
+Bytes per key, measured with tracemalloc while a Database is filled through its commands: plain strings, strings with
+a TTL, and small sorted sets of --members members. Key, value and member strings are counted too, as they would be
+when read off the wire.
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.database import Database  # noqa: E402
+
+
+def measure(label, keys, fill):
+    database = Database('bench', os.devnull, None, aof_enabled=False)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(keys):
+        fill(database, i)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f'{label:<28}{keys:>10,} keys {used / 1e6:>9.1f} MB {used / keys:>9.1f} bytes/key')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Memory used per key.')
+    parser.add_argument('--keys', default=200000, type=int)
+    parser.add_argument('--members', default=3, type=int, help='Members per sorted set')
+    args = parser.parse_args()
+
+    plain = argparse.Namespace(NX=False, XX=False, KEEPTTL=False, EX=None, PX=None)
+    volatile = argparse.Namespace(NX=False, XX=False, KEEPTTL=False, EX=3600, PX=None)
+
+    def zadd(database, i):
+        database.zadd(f'zset:{i}', argparse.Namespace(
+            NX=False, XX=False, CH=False, INCR=False,
+            score_member=[(float(j), f'member-{j}') for j in range(args.members)]))
+
+    measure('string', args.keys, lambda database, i: database.set(f'key:{i}', f'value-{i}', plain))
+    measure('string with TTL', args.keys, lambda database, i: database.set(f'key:{i}', f'value-{i}', volatile))
+    measure(f'sorted set, {args.members} members', args.keys, zadd)
@@ -0,0 +1,48 @@
+"""
+Per-command parse cost of the argparse CommandParser (with shlex tokenization) against tokenize + FastCommandParser.
+"""
+import argparse
+import os
+import shlex
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.utils import CommandParser, FastCommandParser, tokenize  # noqa: E402
+
+COMMANDS = [
+    'GET user:1000',
+    'SET user:1000 payload',
+    'SET user:1000 payload -EX 60 -NX',
+    'DEL a b c d',
+    'ZADD board -CH 10 alice 20 bob 30 carol',
+    'ZRANGE board 0 -1 -WITHSCORES',
+    'TTL user:1000',
+]
+
+
+def legacy(parsers, line):
+    command = shlex.split(line, comments=True)
+    return parsers[command[0]].parse(command[1:])
+
+
+def fast(parsers, line):
+    command = tokenize(line)
+    return parsers[command[0]].parse(command[1:])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Microbenchmark for command parsing.')
+    parser.add_argument('--number', default=20000, type=int, help='Parses per command')
+    args = parser.parse_args()
+
+    names = {line.split()[0] for line in COMMANDS}
+    legacy_parsers = {name: CommandParser(name) for name in names}
+    fast_parsers = {name: FastCommandParser(name) for name in names}
+
+    print(f'{"command":<42}{"argparse us":>12}{"fast us":>10}{"speedup":>9}')
+    for line in COMMANDS:
+        assert legacy(legacy_parsers, line) == fast(fast_parsers, line)
+        before = timeit.timeit(lambda: legacy(legacy_parsers, line), number=args.number) / args.number * 1e6
+        after = timeit.timeit(lambda: fast(fast_parsers, line), number=args.number) / args.number * 1e6
+        print(f'{line:<42}{before:>12.2f}{after:>10.2f}{before / after:>8.1f}x')
@@ -0,0 +1,53 @@
+"""
+Throughput of N SETs sent one round trip at a time against the same SETs sent through ClientSession.pipeline().
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from client import ClientSession  # noqa: E402
+from benchmarks.server_throughput import start_server  # noqa: E402
+
+
+def one_at_a_time(session, count):
+    for i in range(count):
+        session.execute_command('SET', f'key{i}', f'value{i}')
+
+
+def pipelined(session, count, batch):
+    for offset in range(0, count, batch):
+        pipe = session.pipeline()
+        for i in range(offset, min(offset + batch, count)):
+            pipe.execute_command('SET', f'key{i}', f'value{i}')
+        pipe.execute()
+
+
+def timed(label, count, function, *function_args):
+    start = time.perf_counter()
+    function(*function_args)
+    elapsed = time.perf_counter() - start
+    print(f'{label:<28}{elapsed:>8.3f}s {count / elapsed:>12,.0f} SET/s')
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    parser = argparse.ArgumentParser(description='Pipelined vs one-at-a-time SET throughput.')
+    parser.add_argument('--count', default=10000, type=int)
+    parser.add_argument('--batches', nargs='+', default=[100, 1000, 10000], type=int)
+    parser.add_argument('--port', default=5799, type=int)
+    args = parser.parse_args()
+
+    server = start_server('router', args.port, tempfile.mkdtemp(prefix='bench_'))
+    try:
+        client = ClientSession(argparse.Namespace(server_host='localhost', server_port=args.port))
+        client.execute_command('SELECT', 'bench')
+
+        timed('one at a time', args.count, one_at_a_time, client, args.count)
+        for batch_size in args.batches:
+            timed(f'pipeline, batch {batch_size}', args.count, pipelined, client, args.count, batch_size)
+    finally:
+        server.terminate()
+        server.wait()
@@ -0,0 +1,264 @@
+"""
+Benchmark tool modeled on redis-benchmark: runs each of --tests (GET, SET, ZADD, ZRANGE, EXPIRE, and MIX, a weighted
+mix of them set by --mix) for --requests commands and reports ops/sec and p50/p99/p99.9 latency.
+
+Two targets, --targets picks either or both:
+    inprocess  a Session in this process, every command through validate_tokens + process_command, which is the
+               server's path minus the network. --pipeline commands are timed together as one request.
+    server     a server.py started on scratch directories (or the running one at --server HOST:PORT) driven by
+               --clients client processes over client.py Connections, --pipeline commands per request frame.
+Latency is per request, so with a pipeline it covers all of its commands, as redis-benchmark reports it.
+
+Keys are key:0 to key:<keyspace - 1> (zset:0 to zset:<zsets - 1> for ZADD/ZRANGE), picked with a seeded random
+generator per client, so runs with the same arguments send the same commands. Unless --no_populate, every key and
+sorted set gets filled first, so GET, ZRANGE and EXPIRE hit existing keys.
+
+--output writes the results as JSON, or as CSV when the path ends in .csv. --profile runs the in-process target under
+cProfile and prints its hottest functions, --profile_output keeps the raw profile for pstats/snakeviz.
+"""
+import argparse
+import cProfile
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import pstats
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine import Session  # noqa: E402
+from client import Connection  # noqa: E402
+from modules.protocol import ErrorReply, encode_command  # noqa: E402
+from benchmarks.server_throughput import start_server  # noqa: E402
+
+TESTS = ('SET', 'GET', 'ZADD', 'ZRANGE', 'EXPIRE', 'MIX')
+
+
+class Workload:
+    """Builds the commands of a test from the key space settings, deterministic for a given seed"""
+    def __init__(self, args):
+        self.keyspace = args.keyspace
+        self.zsets = args.zsets
+        self.value = 'x' * args.value_size
+        self.mix = [(command, int(weight)) for command, weight in
+                    (part.split('=') for part in args.mix.split(','))]
+
+    def command(self, test, rng):
+        if test == 'MIX':
+            test = rng.choices([command for command, _ in self.mix], [weight for _, weight in self.mix])[0]
+        if test == 'GET':
+            return ['GET', f'key:{rng.randrange(self.keyspace)}']
+        if test == 'SET':
+            return ['SET', f'key:{rng.randrange(self.keyspace)}', self.value]
+        if test == 'ZADD':
+            return ['ZADD', f'zset:{rng.randrange(self.zsets)}', str(rng.randrange(1000000)),
+                    f'member:{rng.randrange(self.keyspace)}']
+        if test == 'ZRANGE':
+            return ['ZRANGE', f'zset:{rng.randrange(self.zsets)}', '0', '10']
+        if test == 'EXPIRE':
+            return ['EXPIRE', f'key:{rng.randrange(self.keyspace)}', '3600']
+        raise ValueError(f'Unknown test {test}')
+
+    def requests(self, test, count, pipeline, seed):
+        # count commands in requests of up to pipeline commands each
+        rng = random.Random(seed)
+        commands = [self.command(test, rng) for _ in range(count)]
+        return [commands[start:start + pipeline] for start in range(0, count, pipeline)]
+
+    def populate(self):
+        # Requests of 1000 commands filling every key, and every sorted set with 100 members
+        commands = [['SET', f'key:{i}', self.value] for i in range(self.keyspace)]
+        commands += [['ZADD', f'zset:{i % self.zsets}', str(i), f'member:{i}']
+                     for i in range(self.zsets * 100)]
+        return [commands[start:start + 1000] for start in range(0, len(commands), 1000)]
+
+
+def summary(test, target, args, latencies, elapsed, errors):
+    latencies.sort()
+    count = len(latencies)
+
+    def percentile(fraction):
+        return latencies[min(count - 1, int(count * fraction))] * 1000
+
+    return {'test': test, 'target': target, 'clients': args.clients if target == 'server' else 1,
+            'pipeline': args.pipeline, 'requests': args.requests, 'keyspace': args.keyspace,
+            'value_size': args.value_size, 'ops_per_sec': round(args.requests / elapsed, 1),
+            'p50_ms': round(percentile(0.5), 4), 'p99_ms': round(percentile(0.99), 4),
+            'p999_ms': round(percentile(0.999), 4), 'errors': errors}
+
+
+def report(result):
+    print(f'{result["test"]:<8}{result["target"]:<11}{result["ops_per_sec"]:>12,.0f} ops/s   '
+          f'p50 {result["p50_ms"]:>8.3f} ms   p99 {result["p99_ms"]:>8.3f} ms   p99.9 {result["p999_ms"]:>8.3f} ms'
+          + (f'   errors {result["errors"]}' if result['errors'] else ''))
+
+
+def in_process_session(directory):
+    session = Session(argparse.Namespace(log_path=os.path.join(directory, 'logs'),
+                                         database_path=os.path.join(directory, 'databases'),
+                                         RDB_persistence=False, RDB_timeout=30, AOF_persistence=False,
+                                         appendfsync='no', auto_aof_rewrite_percentage=100,
+                                         auto_aof_rewrite_min_size=64, maxmemory=0,
+                                         maxmemory_policy='noeviction', maxmemory_samples=5, debug=False))
+    for path in ('logs', 'databases'):
+        os.makedirs(os.path.join(directory, path), exist_ok=True)
+    return session
+
+
+def execute(session, tokens):
+    validated, parsed = session.validate_tokens(tokens)
+    if validated is None:
+        return parsed
+    return session.process_command(validated[0], parsed, validated)
+
+
+def run_in_process(session, requests):
+    # Returns the latency of every request and the number of error replies
+    latencies = []
+    replies = []
+    perf_counter = time.perf_counter
+    for request in requests:
+        start = perf_counter()
+        replies.extend([execute(session, tokens) for tokens in request])
+        latencies.append(perf_counter() - start)
+    return latencies, sum(isinstance(reply, ErrorReply) for reply in replies)
+
+
+def in_process(args, workload, tests):
+    session = in_process_session(tempfile.mkdtemp(prefix='bench_suite_'))
+    execute(session, ['SELECT', 'bench'])
+    if not args.no_populate:
+        for request in workload.populate():
+            for tokens in request:
+                execute(session, tokens)
+    profiler = cProfile.Profile() if args.profile else None
+    results = []
+    for test in tests:
+        requests = workload.requests(test, args.requests, args.pipeline, args.seed)
+        if profiler is not None:
+            profiler.enable()
+        latencies, errors = run_in_process(session, requests)
+        # In-process requests run back to back, the time spent on them is the elapsed time
+        elapsed = sum(latencies)
+        if profiler is not None:
+            profiler.disable()
+        results.append(summary(test, 'inprocess', args, latencies, elapsed, errors))
+        report(results[-1])
+    if profiler is not None:
+        stats = pstats.Stats(profiler)
+        if args.profile_output:
+            stats.dump_stats(args.profile_output)
+        stats.sort_stats(args.profile_sort).print_stats(args.profile_lines)
+    return results
+
+
+def client_process(host, port, frames, start_barrier, results):
+    connection = Connection(host, port, 'bench')
+    connection.send_frame(encode_command(['SELECT', 'bench']))
+    latencies = []
+    errors = 0
+    perf_counter = time.perf_counter
+    start_barrier.wait()
+    for frame in frames:
+        start = perf_counter()
+        replies = connection.send_frame(frame)
+        latencies.append(perf_counter() - start)
+        errors += sum(isinstance(reply, ErrorReply) for reply in replies)
+    connection.close()
+    results.put((latencies, errors))
+
+
+def server(args, workload, tests):
+    if args.server:
+        host, port = args.server.rsplit(':', 1)
+        port, process = int(port), None
+    else:
+        host, port = 'localhost', args.port
+        process = start_server('router', port, tempfile.mkdtemp(prefix='bench_suite_'),
+                               ['--AOF_persistence', ''] if not args.aof else [])
+    try:
+        if not args.no_populate:
+            connection = Connection(host, port, 'bench')
+            for request in workload.populate():
+                connection.send_frame(b''.join(encode_command(tokens) for tokens in request))
+            connection.close()
+        results = []
+        for test in tests:
+            # Every client sends its share of the requests, frames are encoded before the clock starts
+            shares = [args.requests // args.clients + (index < args.requests % args.clients)
+                      for index in range(args.clients)]
+            frames = [[b''.join(encode_command(tokens) for tokens in request)
+                       for request in workload.requests(test, share, args.pipeline, args.seed + index)]
+                      for index, share in enumerate(shares)]
+            start_barrier = multiprocessing.Barrier(args.clients + 1)
+            queue = multiprocessing.Queue()
+            processes = [multiprocessing.Process(target=client_process,
+                                                 args=(host, port, client_frames, start_barrier, queue))
+                         for client_frames in frames]
+            for client in processes:
+                client.start()
+            start_barrier.wait()
+            start = time.perf_counter()
+            finished = [queue.get() for _ in processes]
+            elapsed = time.perf_counter() - start
+            for client in processes:
+                client.join()
+            latencies = [latency for client_latencies, _ in finished for latency in client_latencies]
+            results.append(summary(test, 'server', args, latencies, elapsed, sum(errors for _, errors in finished)))
+            report(results[-1])
+        return results
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+def write_results(path, args, results):
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+        return
+    with open(path, 'w') as f:
+        json.dump({'arguments': vars(args), 'python': sys.version.split()[0], 'platform': platform.platform(),
+                   'cpus': os.cpu_count(), 'timestamp': time.time(), 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='redis-benchmark style throughput and latency of the engine, '
+                                                 'in-process and over server.py.')
+    parser.add_argument('--targets', nargs='+', default=['inprocess', 'server'], choices=['inprocess', 'server'])
+    parser.add_argument('--tests', nargs='+', default=list(TESTS), type=str.upper, choices=TESTS)
+    parser.add_argument('--requests', default=100000, type=int, help='Commands per test, over all clients')
+    parser.add_argument('--clients', default=4, type=int, help='Client processes of the server target')
+    parser.add_argument('--pipeline', default=1, type=int, help='Commands per request')
+    parser.add_argument('--keyspace', default=100000, type=int, help='Keys the commands pick from')
+    parser.add_argument('--zsets', default=100, type=int, help='Sorted sets ZADD and ZRANGE pick from')
+    parser.add_argument('--value_size', default=3, type=int, help='Bytes per SET value')
+    parser.add_argument('--mix', default='GET=50,SET=30,ZADD=10,ZRANGE=5,EXPIRE=5',
+                        help='Command weights of the MIX test')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--no_populate', action='store_true', help='Start from an empty database')
+    parser.add_argument('--aof', action='store_true', help='Keep the append only log on for the server target')
+    parser.add_argument('--server', default=None, metavar='HOST:PORT', help='Benchmark a running server instead')
+    parser.add_argument('--port', default=5903, type=int, help='Port of the server started for the server target')
+    parser.add_argument('--output', default=None, help='Write the results to this .json or .csv file')
+    parser.add_argument('--profile', action='store_true', help='Profile the in-process target with cProfile')
+    parser.add_argument('--profile_sort', default='tottime', help='pstats sort key of the printed profile')
+    parser.add_argument('--profile_lines', default=25, type=int, help='Functions printed from the profile')
+    parser.add_argument('--profile_output', default=None, help='Also save the raw profile to this file')
+    bench_args = parser.parse_args()
+
+    bench_workload = Workload(bench_args)
+    all_results = []
+    if 'inprocess' in bench_args.targets:
+        all_results += in_process(bench_args, bench_workload, bench_args.tests)
+    if 'server' in bench_args.targets:
+        all_results += server(bench_args, bench_workload, bench_args.tests)
+    if bench_args.output:
+        write_results(bench_args.output, bench_args, all_results)
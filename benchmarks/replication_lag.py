@@ -0,0 +1,93 @@
+"""
+Replication over loopback: a primary (--replication_port) and a replica (--replicaof) as two local server.py processes.
+A writer pipelines --writes SET/ZADD/DEL commands into the primary while ROLE is polled on the replica to sample its
+lag, in records behind the primary and in milliseconds. Afterwards the replica must catch up and serve exactly the
+primary's data, which is checked key by key.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from client import ClientSession  # noqa: E402
+from benchmarks.server_throughput import start_server  # noqa: E402
+
+
+def write_load(port, writes, batch, done):
+    session = ClientSession(argparse.Namespace(server_host='localhost', server_port=port))
+    session.execute_command('SELECT', 'bench')
+    start = time.perf_counter()
+    for offset in range(0, writes, batch):
+        with session.pipeline() as pipe:
+            for i in range(offset, min(offset + batch, writes)):
+                if i % 10 == 9:
+                    pipe.execute_command('DEL', f'key:{i - 5}')
+                elif i % 3:
+                    pipe.execute_command('SET', f'key:{i}', f'value-{i}')
+                else:
+                    pipe.execute_command('ZADD', f'zset:{i % 100}', str(i), f'member-{i}')
+            pipe.execute()
+    done.append(time.perf_counter() - start)
+
+
+def lag(role):
+    # ROLE on a replica: ['replica', primary, [[name, offset, records behind, lag ms, last io ms], ...]]
+    return next(((behind, lag_ms) for name, _, behind, lag_ms, _ in role[2] if name == 'bench'), (0, 0))
+
+
+def contents(session, count):
+    keys = [f'key:{i}' for i in range(count)]
+    values = session.execute_command('MGET', *keys)
+    zsets = [session.execute_command('ZRANGE', f'zset:{i}', '0', str(count)) for i in range(100)]
+    return values, zsets
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replication lag and consistency of a local primary and replica.')
+    parser.add_argument('--writes', default=100000, type=int)
+    parser.add_argument('--batch', default=100, type=int, help='Commands per pipeline')
+    parser.add_argument('--port', default=5891, type=int)
+    args = parser.parse_args()
+
+    stream_port = args.port + 100
+    primary = start_server('router', args.port, tempfile.mkdtemp(prefix='bench_primary_'),
+                           ['--replication_port', str(stream_port)])
+    replica = start_server('router', args.port + 1, tempfile.mkdtemp(prefix='bench_replica_'),
+                           ['--replicaof', f'localhost:{args.port}'])
+    try:
+        reader = ClientSession(argparse.Namespace(server_host='localhost', server_port=args.port + 1))
+        print('replica SELECT:', reader.execute_command('SELECT', 'bench'))
+
+        finished = []
+        writer = threading.Thread(target=write_load, args=(args.port, args.writes, args.batch, finished))
+        writer.start()
+        samples = []
+        while writer.is_alive():
+            samples.append(lag(reader.execute_command('ROLE')))
+            time.sleep(0.01)
+        writer.join()
+        print(f'{args.writes:,} writes in {finished[0]:.2f}s, {args.writes / finished[0]:,.0f} writes/s')
+        if samples:
+            behind = sorted(sample[0] for sample in samples)
+            lag_ms = sorted(sample[1] for sample in samples)
+            print(f'lag over {len(samples)} samples: records behind median {behind[len(behind) // 2]:,} '
+                  f'max {behind[-1]:,}, ms median {lag_ms[len(lag_ms) // 2]} max {lag_ms[-1]}')
+
+        start = time.perf_counter()
+        while lag(reader.execute_command('ROLE'))[0]:
+            time.sleep(0.01)
+        print(f'caught up {time.perf_counter() - start:.3f}s after the last write')
+
+        source = ClientSession(argparse.Namespace(server_host='localhost', server_port=args.port))
+        source.execute_command('SELECT', 'bench')
+        time.sleep(0.3)
+        print('replica matches primary:', contents(source, args.writes) == contents(reader, args.writes))
+        print('write on replica:', reader.execute_command('SET', 'key:0', 'x'))
+        print('replica ROLE:', reader.execute_command('ROLE'))
+    finally:
+        for server in (primary, replica):
+            server.terminate()
+            server.wait()
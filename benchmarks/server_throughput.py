@@ -0,0 +1,97 @@
+"""
+Measures requests/sec of server.py in its `rep` and `router` serving modes.
+Spins up a server subprocess per mode on scratch directories and drives it with concurrent client threads.
+`rep` is driven by REQ sockets (one request in flight per client, the only thing REQ/REP allows), `router` by DEALER
+sockets which keep `--depth` requests in flight per client.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import zmq
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_server(mode, port, workdir, extra_args=()):
+    cmd = [sys.executable, os.path.join(ROOT, 'server.py'), '--port', str(port), '--serve_mode', mode,
+           '--database_path', os.path.join(workdir, 'databases'), '--log_path', os.path.join(workdir, 'logs'),
+           *extra_args]
+    server = subprocess.Popen(cmd, cwd=workdir, stdout=subprocess.DEVNULL)
+    time.sleep(1.0)
+    return server
+
+
+def req_client(context, port, requests, results):
+    socket = context.socket(zmq.REQ)
+    socket.connect(f'tcp://localhost:{port}')
+    socket.send_string('SELECT bench')
+    socket.recv()
+    for i in range(requests):
+        socket.send_string(f'SET key{i % 1000} val{i}' if i % 2 else f'GET key{i % 1000}')
+        socket.recv()
+    socket.close()
+    results.append(requests)
+
+
+def dealer_client(context, port, requests, depth, results):
+    socket = context.socket(zmq.DEALER)
+    socket.connect(f'tcp://localhost:{port}')
+    # The selected database is per connection
+    socket.send_multipart([b'', b'SELECT bench'])
+    socket.recv_multipart()
+    sent = received = 0
+    while received < requests:
+        while sent < requests and sent - received < depth:
+            i = sent
+            socket.send_multipart([b'', (f'SET key{i % 1000} val{i}' if i % 2 else f'GET key{i % 1000}').encode()])
+            sent += 1
+        socket.recv_multipart()
+        received += 1
+    socket.close()
+    results.append(requests)
+
+
+def run(mode, args):
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    server = start_server(mode, args.port, workdir)
+    context = zmq.Context()
+    try:
+        results = []
+        if mode == 'rep':
+            threads = [threading.Thread(target=req_client, args=(context, args.port, args.requests, results))
+                       for _ in range(args.clients)]
+        else:
+            threads = [threading.Thread(target=dealer_client,
+                                        args=(context, args.port, args.requests, args.depth, results))
+                       for _ in range(args.clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+        context.term()
+
+    total = sum(results)
+    print(f'{mode:>6}: {total} requests from {args.clients} clients in {elapsed:.2f}s -> {total / elapsed:,.0f} req/s')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare requests/sec of the REP and ROUTER serving modes.')
+    parser.add_argument('--clients', default=8, type=int)
+    parser.add_argument('--requests', default=5000, type=int, help='Requests per client')
+    parser.add_argument('--depth', default=16, type=int, help='In-flight requests per DEALER client (router mode)')
+    parser.add_argument('--port', default=5798, type=int)
+    parser.add_argument('--modes', nargs='+', default=['rep', 'router'])
+    bench_args = parser.parse_args()
+
+    for serve_mode in bench_args.modes:
+        run(serve_mode, bench_args)
@@ -0,0 +1,75 @@
+"""
+Throughput of a sharded server.py from 1 to --max_shards worker processes, against the single process server.
+Each run starts a server with --shards N on scratch directories and drives it from --clients_per_shard client
+processes per shard (separate processes, so the clients are not what is measured). Every client pipelines batches of
+--batch SET/GET pairs on random keys, either straight to the shards (client.py --cluster) or through the front.
+Throughput only grows with the shard count while there are cores to spare for the workers and the clients.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from client import ClientSession  # noqa: E402
+from benchmarks.server_throughput import start_server  # noqa: E402
+
+
+def client_run(port, cluster, batches, batch, seed, start_barrier, results):
+    session = ClientSession(argparse.Namespace(server_host='localhost', server_port=port, cluster=cluster))
+    session.execute_command('SELECT', 'bench')
+    rng = random.Random(seed)
+    start_barrier.wait()
+    start = time.perf_counter()
+    for _ in range(batches):
+        with session.pipeline() as pipe:
+            for _ in range(batch // 2):
+                key = f'key:{rng.randrange(100000)}'
+                pipe.execute_command('SET', key, 'x' * 16)
+                pipe.execute_command('GET', key)
+            pipe.execute()
+    results.put((batches * (batch // 2) * 2, time.perf_counter() - start))
+
+
+def run(shards, cluster, args):
+    workdir = tempfile.mkdtemp(prefix='bench_shards_')
+    server = start_server('router', args.port, workdir, ['--shards', str(shards)])
+    clients = args.clients_per_shard * max(shards, 1)
+    start_barrier = multiprocessing.Barrier(clients)
+    results = multiprocessing.Queue()
+    try:
+        processes = [multiprocessing.Process(target=client_run,
+                                             args=(args.port, cluster, args.batches, args.batch, seed, start_barrier,
+                                                   results))
+                     for seed in range(clients)]
+        for process in processes:
+            process.start()
+        finished = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+    # Every client starts at the barrier, the slowest one bounds the run
+    return sum(count for count, _ in finished) / max(elapsed for _, elapsed in finished)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Throughput scaling of server.py --shards.')
+    parser.add_argument('--max_shards', default=os.cpu_count(), type=int)
+    parser.add_argument('--clients_per_shard', default=2, type=int)
+    parser.add_argument('--batches', default=200, type=int, help='Pipelines sent per client')
+    parser.add_argument('--batch', default=100, type=int, help='Commands per pipeline')
+    parser.add_argument('--port', default=5897, type=int)
+    bench_args = parser.parse_args()
+
+    single = run(0, False, bench_args)
+    print(f'{"single process":<28}{single:>12,.0f} cmd/s')
+    for shard_count in range(1, bench_args.max_shards + 1):
+        for direct in (True, False):
+            rate = run(shard_count, direct, bench_args)
+            label = f'{shard_count} shards, {"direct" if direct else "via front"}'
+            print(f'{label:<28}{rate:>12,.0f} cmd/s {rate / single:>6.2f}x')
@@ -0,0 +1,85 @@
+"""
+Snapshot time and peak child RSS of the pickle based RDB routine against the streaming binary format.
+Both run in a forked child, so the numbers compare the serializers rather than the process start method.
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+import _pickle as pickle
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules import rdb  # noqa: E402
+from modules.datastructures import MySortedSet, Value  # noqa: E402
+
+# {'k': Value('v'), 't': Value('w', 9999999999.0), 'z': Value(<a 1, b 2, c 3>)} as the first versions pickled it, when
+# Value had a __dict__ with a type field and MySortedSet a SortedSet keyed by a bound method
+LEGACY_SNAPSHOT = bytes.fromhex(
+    '80049549010000000000007d94288c016b948c166d6f64756c65732e6461746173747275637475726573948c0556616c7565'
+    '9493942981947d94288c0376616c948c0176948c0774696d656f7574944e8c0474797065944e75628c01749468042981947d'
+    '942868078c0177946809474202a05f1ff80000680a4e75628c017a9468042981947d9428680768028c0b4d79536f72746564'
+    '5365749493942981947d94288c076d656d62657273948c1a736f72746564636f6e7461696e6572732e736f72746564736574'
+    '948c09536f727465645365749493948f94288c0161948c0162948c016394908c086275696c74696e73948c07676574617474'
+    '7294939468148c0d736f727465647365745f6b65799486945294869452948c0873636f72656d6170947d9428681c47400000'
+    '0000000000681b473ff0000000000000681d47400800000000000075756268094e680a4e7562752e')
+
+
+def build_dataset(keys, zsets, members):
+    data = {f'key:{i}': Value(f'value-{i}' * 4, time.time() + 3600 if i % 10 == 0 else None) for i in range(keys)}
+    for i in range(zsets):
+        zset = MySortedSet()
+        zset.update([(float(j), f'member-{j}') for j in range(members)])
+        data[f'zset:{i}'] = Value(zset)
+    return data
+
+
+def pickle_dump(data, path):
+    with open(path, 'wb') as f:
+        pickle.dump(data, f)
+
+
+def check_legacy_load(directory):
+    # Snapshots pickled by the first versions must still load
+    path = os.path.join(directory, 'legacy.rdb')
+    with open(path, 'wb') as f:
+        f.write(LEGACY_SNAPSHOT)
+    loaded = rdb.load(path)
+    found = {key: (value.val if type(value.val) == str else value.val.items(), value.timeout)
+             for key, value in loaded.items()}
+    expected = {'k': ('v', None), 't': ('w', 9999999999.0), 'z': ([('a', 1.0), ('b', 2.0), ('c', 3.0)], None)}
+    if found != expected:
+        raise AssertionError(f'legacy snapshot loaded as {found}')
+    print('legacy pickled snapshot loads')
+
+
+def forked(function, data, path):
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        function(data, path)
+        os._exit(0)
+    _, status, usage = os.wait4(pid, 0)
+    return time.perf_counter() - start, usage.ru_maxrss, os.path.getsize(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='RDB snapshot time and peak RSS.')
+    parser.add_argument('--keys', default=1000000, type=int)
+    parser.add_argument('--zsets', default=10, type=int)
+    parser.add_argument('--members', default=10000, type=int)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_rdb_')
+    check_legacy_load(directory)
+    dataset = build_dataset(args.keys, args.zsets, args.members)
+    parent_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'parent peak RSS {parent_rss / 1024:,.0f} MB, {len(dataset):,} keys')
+    for label, dump in (('pickle', pickle_dump), ('binary', rdb.dump)):
+        elapsed, child_rss, size = forked(dump, dataset, os.path.join(directory, f'{label}.rdb'))
+        print(f'{label:<8}{elapsed:>8.2f}s  child peak RSS {child_rss / 1024:>8,.0f} MB  file {size / 1e6:>8.1f} MB')
+
+    start_time = time.perf_counter()
+    loaded = rdb.load(os.path.join(directory, 'binary.rdb'))
+    print(f'binary load {time.perf_counter() - start_time:.2f}s, {len(loaded):,} keys')
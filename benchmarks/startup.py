@@ -0,0 +1,73 @@
+"""
+Restart time for a database of --keys keys: snapshot load (pickle vs memory-mapped binary) and log replay (every
+record vs collapsed), followed by a full Session.restore with its startup breakdown.
+"""
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import _pickle as pickle
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine import Session  # noqa: E402
+from modules import rdb  # noqa: E402
+from modules.aof import collapse_records, read_records, write_records  # noqa: E402
+from modules.database import Database  # noqa: E402
+from modules.datastructures import Value  # noqa: E402
+
+
+def timed(label, function, *function_args):
+    # Collection is off while timing, as it is during restore
+    gc.disable()
+    start = time.perf_counter()
+    result = function(*function_args)
+    elapsed = time.perf_counter() - start
+    gc.enable()
+    print(f'{label:<36}{elapsed:>8.2f}s')
+    return result
+
+
+def apply_all(database, records):
+    for record in records:
+        database.apply_record(record)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Startup time breakdown.')
+    parser.add_argument('--keys', default=1000000, type=int)
+    parser.add_argument('--writes', default=1000000, type=int, help='Log records written after the snapshot')
+    parser.add_argument('--hot_keys', default=100000, type=int, help='Distinct keys the logged writes touch')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_startup_')
+    for sub_directory in ('databases', 'logs'):
+        os.makedirs(os.path.join(directory, sub_directory))
+    dump_path = os.path.join(directory, 'databases', 'bench.rdb')
+    log_path = os.path.join(directory, 'logs', 'bench.log')
+
+    dataset = {f'key:{i}': Value(f'value-{i}') for i in range(args.keys)}
+    with open(dump_path + '.pickle', 'wb') as f:
+        pickle.dump(dataset, f)
+    rdb.dump(dataset, dump_path)
+    del dataset
+    write_records(log_path, (('SET', f'key:{i % args.hot_keys}', f'new-{i}') for i in range(args.writes)))
+
+    with open(dump_path + '.pickle', 'rb') as f:
+        timed('snapshot, pickle.load', pickle.load, f)
+    timed('snapshot, mmap binary decode', rdb.load, dump_path)
+    log_records = timed('log, decode', lambda: list(read_records(log_path)))
+    scratch = Database('scratch', os.path.join(directory, 'scratch.log'), None, aof_enabled=False)
+    timed('log, apply every record', apply_all, scratch, log_records)
+    timed('log, collapse + apply', lambda: apply_all(scratch, collapse_records(log_records)))
+    del log_records, scratch
+    os.remove(dump_path + '.pickle')
+
+    session = Session(argparse.Namespace(log_path=os.path.join(directory, 'logs'),
+                                         database_path=os.path.join(directory, 'databases'),
+                                         RDB_persistence=False, RDB_timeout=30, AOF_persistence=True,
+                                         appendfsync='everysec', auto_aof_rewrite_percentage=100,
+                                         auto_aof_rewrite_min_size=64, maxmemory=0,
+                                         maxmemory_policy='noeviction', maxmemory_samples=5, debug=False))
+    timed('Session.restore', session.restore, 'bench')
@@ -0,0 +1,66 @@
+"""
+Throughput of 10 command batches: sent one round trip per command, pipelined in one frame, and wrapped in MULTI/EXEC
+in one frame, where the whole batch also goes to the log as a single record. Run per appendfsync policy, as under
+`always` every record costs an fsync.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from client import ClientSession  # noqa: E402
+from benchmarks.server_throughput import start_server  # noqa: E402
+
+
+def batch_commands(offset, size):
+    return [('SET', f'key{i}', f'value{i}') for i in range(offset, offset + size)]
+
+
+def one_at_a_time(session, batches, size):
+    for batch in range(batches):
+        for command in batch_commands(batch * size, size):
+            session.execute_command(*command)
+
+
+def pipelined(session, batches, size, transaction):
+    for batch in range(batches):
+        pipe = session.pipeline()
+        if transaction:
+            pipe.execute_command('MULTI')
+        for command in batch_commands(batch * size, size):
+            pipe.execute_command(*command)
+        if transaction:
+            pipe.execute_command('EXEC')
+        pipe.execute()
+
+
+def timed(label, count, function, *function_args):
+    start = time.perf_counter()
+    function(*function_args)
+    elapsed = time.perf_counter() - start
+    print(f'{label:<32}{elapsed:>8.3f}s {count / elapsed:>12,.0f} commands/s')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='MULTI/EXEC batch throughput.')
+    parser.add_argument('--batches', default=1000, type=int)
+    parser.add_argument('--size', default=10, type=int, help='Commands per batch')
+    parser.add_argument('--port', default=5799, type=int)
+    args = parser.parse_args()
+
+    for policy in ('always', 'everysec'):
+        server = start_server('router', args.port, tempfile.mkdtemp(prefix='bench_'),
+                              ['--appendfsync', policy, '--RDB_persistence', ''])
+        try:
+            client = ClientSession(argparse.Namespace(server_host='localhost', server_port=args.port))
+            client.execute_command('SELECT', 'bench')
+            commands = args.batches * args.size
+            print(f'appendfsync {policy}')
+            timed('  one round trip per command', commands, one_at_a_time, client, args.batches, args.size)
+            timed('  pipelined batch', commands, pipelined, client, args.batches, args.size, False)
+            timed('  MULTI/EXEC batch', commands, pipelined, client, args.batches, args.size, True)
+        finally:
+            server.terminate()
+            server.wait()
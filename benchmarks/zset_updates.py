@@ -0,0 +1,51 @@
+"""
+MySortedSet write paths: one ZADD of --members members, the same members added in batches of --batch, rescoring
+every member in one ZADD, and --increments single member ZADD INCR calls (ZINCRBY) on random members.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.datastructures import MySortedSet  # noqa: E402
+
+
+def timed(label, count, function):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    print(f'{label:<36}{elapsed:>8.2f}s {count / elapsed:>12,.0f} members/s')
+    return result
+
+
+def batched(zset, pairs, batch):
+    for i in range(0, len(pairs), batch):
+        zset.update(pairs[i:i + batch])
+
+
+def increments(zset, members, count, rng):
+    for _ in range(count):
+        zset.incr_update([(rng.random(), members[rng.randrange(len(members))])])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sorted set insert and update throughput.')
+    parser.add_argument('--members', default=100000, type=int)
+    parser.add_argument('--batch', default=100, type=int)
+    parser.add_argument('--increments', default=1000000, type=int)
+    args = parser.parse_args()
+
+    random_generator = random.Random(7)
+    member_names = [f'member-{i}' for i in range(args.members)]
+    score_member = [(random_generator.random() * 1000, member) for member in member_names]
+
+    timed(f'ZADD {args.members:,} members at once', args.members, lambda: MySortedSet().update(score_member))
+    sorted_set = MySortedSet()
+    timed(f'ZADD in batches of {args.batch}', args.members, lambda: batched(sorted_set, score_member, args.batch))
+    rescored = [(score + 1, member) for score, member in score_member]
+    timed('ZADD rescoring every member', args.members, lambda: sorted_set.update(rescored))
+    timed('ZADD, every score unchanged', args.members, lambda: sorted_set.update(rescored))
+    timed(f'ZINCRBY x {args.increments:,}', args.increments,
+          lambda: increments(sorted_set, member_names, args.increments, random_generator))
@@ -1,51 +1,662 @@
-import shlex
 import zmq
+import zmq.asyncio
 import argparse
-from modules.utils import CommandParser
+import asyncio
+import itertools
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from modules.utils import FastCommandParser, tokenize
+from modules.protocol import ENCODING, ERRORS, ErrorReply, decode_commands, decode_replies, encode_command, render
+from modules.cluster import Batch, ClusterConnection, ShardRouter, command_keys
+from modules.tracking import HEARTBEAT_TOPIC
 import sys
 
+# Commands a caching Client forgets the cached values of the keys of straight away, rather than once the server's
+# invalidation for them comes in
+_WRITE_COMMANDS = frozenset({'SET', 'EXPIRE', 'DEL', 'UNLINK', 'MSET', 'MSETNX', 'ZADD', 'ZREM', 'ZREMRANGEBYSCORE',
+                             'ZREMRANGEBYRANK'})
+
+
+class ResponseError(Exception):
+    """An error reply from the server, raised by the typed helpers of Commands"""
+    pass
+
+
+class Pipeline:
+    """
+    Queues commands and ships them to the server in a single frame, the server answers them in order in one reply.
+    Commands are not validated locally, errors come back per command as ErrorReply results.
+    Usage:
+        with session.pipeline() as pipe:
+            pipe.execute_command('SET', 'a', '1')
+            pipe.execute_command('GET a')
+            results = pipe.execute()
+    """
+    def __init__(self, session, transaction=False):
+        # transaction: wrap the commands in MULTI/EXEC, execute() then returns EXEC's reply
+        self.__session = session
+        self.__transaction = transaction
+        self.__commands = []
+
+    def __len__(self):
+        return len(self.__commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__commands = []
+
+    def execute_command(self, *tokens):
+        # Accepts either separate tokens or a single command line
+        if len(tokens) == 1:
+            tokens = tokenize(tokens[0])
+        self.__commands.append(encode_command(tokens))
+        return self
+
+    def _take(self):
+        # The queued commands as a single frame, the queue starts over empty
+        commands, self.__commands = self.__commands, []
+        if self.__transaction:
+            commands = [encode_command(['MULTI']), *commands, encode_command(['EXEC'])]
+        return b''.join(commands)
+
+    def _results(self, replies):
+        return replies[-1] if self.__transaction else replies
+
+    def execute(self):
+        if not self.__commands:
+            return []
+        return self._results(self.__session.send_frame(self._take()))
+
+
+class AsyncPipeline(Pipeline):
+    """Pipeline of an AsyncClient, execute() is a coroutine"""
+    def __init__(self, session, transaction=False):
+        super().__init__(session, transaction)
+        self.__session = session
+
+    async def execute(self):
+        if not len(self):
+            return []
+        return self._results(await self.__session.send_frame(self._take()))
+
+
+class Connection:
+    """
+    One REQ socket to a server, safe against lost replies: a request that gets no reply within `timeout` seconds
+    closes the socket (a REQ socket waiting for a reply can't send anything else) and is sent again on a fresh one, up
+    to `retries` more times, before TimeoutError is raised. A retried write may be applied twice if it was only its
+    reply that got lost. database is SELECTed on every fresh socket, the server keeps it per connection, and with a
+    cache CLIENT TRACKING is turned on for it.
+    """
+    def __init__(self, host='localhost', port=5698, database=None, timeout=10.0, retries=2, context=None, cache=None):
+        self.host = host
+        self.port = port
+        self.database = database
+        self.timeout = timeout
+        self.retries = retries
+        self.cache = cache
+        self.__context = context or zmq.Context.instance()
+        self.__socket = None
+
+    def __open(self):
+        self.__socket = self.__context.socket(zmq.REQ)
+        self.__socket.setsockopt(zmq.LINGER, 0)
+        self.__socket.connect(f"tcp://{self.host}:{self.port}")
+        if self.database is not None:
+            self.__setup(['SELECT', self.database])
+        if self.cache is not None:
+            self.cache.connect(self.__setup(['CLIENT', 'TRACKING', 'ON', '-REDIRECT', self.cache.topic]))
+
+    def __setup(self, tokens):
+        self.send(encode_command(tokens))
+        reply = self.receive()[0]
+        if isinstance(reply, ErrorReply):
+            raise ResponseError(reply)
+        return reply
+
+    def close(self):
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+    def send(self, payload):
+        if self.__socket is None:
+            self.__open()
+        self.__socket.send(payload)
+
+    def receive(self):
+        # Decoded replies to the frame sent last, TimeoutError (and a closed socket) if none came in time
+        if self.timeout is not None and not self.__socket.poll(self.timeout * 1000):
+            self.close()
+            raise TimeoutError(f'No reply from {self.host}:{self.port} within {self.timeout}s')
+        return decode_replies(self.__socket.recv())
+
+    def send_frame(self, payload):
+        for attempt in range(self.retries + 1):
+            try:
+                self.send(payload)
+                replies = self.receive()
+            except TimeoutError:
+                if attempt == self.retries:
+                    raise
+                continue
+            if attempt == self.retries or not _lost_database(self.database, replies):
+                return replies
+            self.close()
+
+
+def _lost_database(database, replies):
+    # A restarted server forgets what a connection SELECTed while zmq reconnects the socket underneath without a word,
+    # every command of the frame was then rejected unrun and can be sent again once the database is selected anew
+    return database is not None and any(isinstance(reply, ErrorReply) and reply.startswith('Select a database first')
+                                        for reply in replies)
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of up to `size` Connections to one server, all with the same database selected. A thread gets a
+    connection to itself for as long as it holds it, waiting up to the connections' timeout for one to free up.
+    """
+    def __init__(self, host='localhost', port=5698, database=None, size=8, timeout=10.0, retries=2, cache=None):
+        self.host = host
+        self.port = port
+        self.database = database
+        self.timeout = timeout
+        self.retries = retries
+        self.cache = cache
+        self.__slots = threading.BoundedSemaphore(size)
+        self.__idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        if not self.__slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f'No free connection to {self.host}:{self.port} within {self.timeout}s')
+        try:
+            connection = self.__idle.get_nowait()
+        except queue.Empty:
+            connection = Connection(self.host, self.port, self.database, self.timeout, self.retries, cache=self.cache)
+        try:
+            yield connection
+        finally:
+            self.__idle.put(connection)
+            self.__slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.__idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class ClientCache:
+    """
+    Bounded LRU of the values a Client read with GET, `size` keys at most, kept valid by the server (CLIENT TRACKING,
+    see modules/tracking.py): every connection of the pool redirects its invalidations to this cache's topic, which
+    are applied before every lookup. Everything is dropped once the invalidation stream can't be trusted, a server
+    restart, lost messages or no heartbeat for max_silence seconds, and nothing is served from the cache until the
+    stream is back. A read that was in flight while its key got invalidated is not cached, its value may predate the
+    change. Between a change on the server and its invalidation arriving, other clients' writes may be read stale.
+    """
+
+    # Seconds without a heartbeat (the server sends one every 0.1s) before the cache stops trusting the stream
+    max_silence = 1.0
+
+    def __init__(self, host, database, size=10000, context=None):
+        self.host = host
+        self.size = size
+        self.topic = uuid.uuid4().hex
+        self.__database = database.encode(ENCODING, ERRORS)
+        self.__context = context or zmq.Context.instance()
+        self.__socket = None
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        # key -> reads of it in flight, and the keys invalidated while one was
+        self.__reading = {}
+        self.__stale = set()
+        self.__run_id = None
+        self.__sequence = 0
+        self.__heard = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def connect(self, reply):
+        # Reply to CLIENT TRACKING ON of a fresh connection: [tracking port, topic]
+        with self.__lock:
+            if self.__socket is None:
+                socket = self.__context.socket(zmq.SUB)
+                socket.setsockopt(zmq.LINGER, 0)
+                socket.setsockopt(zmq.SUBSCRIBE, self.topic.encode())
+                socket.setsockopt(zmq.SUBSCRIBE, HEARTBEAT_TOPIC)
+                socket.connect(f"tcp://{self.host}:{reply[0]}")
+                self.__socket = socket
+
+    def __flush(self):
+        self.invalidations += len(self.__entries)
+        self.__entries.clear()
+        self.__stale.update(self.__reading)
+
+    def __invalidate(self, key):
+        if self.__entries.pop(key, None) is not None:
+            self.invalidations += 1
+        if key in self.__reading:
+            self.__stale.add(key)
+
+    def __drain(self):
+        # Applies the messages waiting on the stream, True if it can be trusted
+        socket = self.__socket
+        if socket is None:
+            return False
+        topic = self.topic.encode()
+        while socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            frames = socket.recv_multipart()
+            if frames[0] == HEARTBEAT_TOPIC:
+                run_id, sequence = frames[1], int(frames[2])
+                if run_id != self.__run_id or sequence != self.__sequence + 1:
+                    self.__flush()
+                self.__run_id, self.__sequence, self.__heard = run_id, sequence, time.monotonic()
+            elif frames[0] == topic and frames[1] == self.__database:
+                if len(frames) > 2:
+                    self.__invalidate(frames[2].decode(ENCODING, ERRORS))
+                else:
+                    self.__flush()
+        if time.monotonic() - self.__heard > self.max_silence:
+            if self.__run_id is not None:
+                self.__flush()
+                self.__run_id = None
+            return False
+        return True
+
+    def get(self, key, fetch):
+        # The cached value of key, else fetch() it from the server and cache it
+        with self.__lock:
+            if self.__drain() and key in self.__entries:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return self.__entries[key]
+            self.misses += 1
+            self.__reading[key] = self.__reading.get(key, 0) + 1
+        value = fetched = None
+        try:
+            value = fetch()
+            fetched = True
+        finally:
+            with self.__lock:
+                trusted = self.__drain()
+                self.__reading[key] -= 1
+                stale = key in self.__stale
+                if not self.__reading[key]:
+                    del self.__reading[key]
+                    self.__stale.discard(key)
+                if fetched and trusted and not stale:
+                    self.__entries[key] = value
+                    self.__entries.move_to_end(key)
+                    if len(self.__entries) > self.size:
+                        self.__entries.popitem(last=False)
+        return value
+
+    def forget(self, keys):
+        with self.__lock:
+            for key in keys:
+                self.__invalidate(key)
+
+    def close(self):
+        with self.__lock:
+            if self.__socket is not None:
+                self.__socket.close()
+                self.__socket = None
+            self.__entries.clear()
+
+
+def _float_or_none(reply):
+    return None if reply is None else float(reply)
+
+
+def _score_pairs(reply):
+    return [(member, float(score)) for member, score in reply]
+
+
+class Commands:
+    """
+    Typed helpers over execute_command: tokens are built straight from the arguments, nothing is validated locally,
+    error replies are raised as ResponseError. Subclasses provide _call(tokens, parse=None), which sends the command and
+    returns _result of its reply, or a coroutine of it for AsyncClient.
+    """
+    @staticmethod
+    def _result(reply, parse):
+        if isinstance(reply, ErrorReply):
+            raise ResponseError(reply)
+        return reply if parse is None else parse(reply)
+
+    def get(self, key):
+        return self._call(['GET', key])
+
+    def set(self, key, value, ex=None, px=None, nx=False, xx=False, keepttl=False):
+        # True once set, False if NX/XX kept it from being set
+        tokens = ['SET', key, value]
+        if ex is not None:
+            tokens += ['-EX', str(ex)]
+        if px is not None:
+            tokens += ['-PX', str(px)]
+        tokens += [flag for flag, given in (('-NX', nx), ('-XX', xx), ('-KEEPTTL', keepttl)) if given]
+        return self._call(tokens, lambda reply: reply == 'OK')
+
+    def delete(self, *keys):
+        return self._call(['DEL', *keys])
+
+    def unlink(self, *keys):
+        return self._call(['UNLINK', *keys])
+
+    def mget(self, *keys):
+        return self._call(['MGET', *keys])
+
+    def mset(self, mapping):
+        return self._call(['MSET', *[token for pair in mapping.items() for token in pair]])
+
+    def msetnx(self, mapping):
+        return self._call(['MSETNX', *[token for pair in mapping.items() for token in pair]], bool)
+
+    def expire(self, key, seconds):
+        return self._call(['EXPIRE', key, str(seconds)], bool)
+
+    def ttl(self, key):
+        return self._call(['TTL', key])
+
+    def zadd(self, key, mapping, nx=False, xx=False, ch=False, incr=False):
+        # mapping: member -> score
+        tokens = ['ZADD', key, *[flag for flag, given in (('-NX', nx), ('-XX', xx), ('-CH', ch), ('-INCR', incr))
+                                 if given]]
+        tokens += [token for member, score in mapping.items() for token in (str(score), member)]
+        return self._call(tokens, _float_or_none if incr else None)
+
+    def zrange(self, key, start, stop, withscores=False):
+        tokens = ['ZRANGE', key, str(start), str(stop)] + (['-WITHSCORES'] if withscores else [])
+        return self._call(tokens, _score_pairs if withscores else None)
+
+    def zrevrange(self, key, start, stop, withscores=False):
+        tokens = ['ZREVRANGE', key, str(start), str(stop)] + (['-WITHSCORES'] if withscores else [])
+        return self._call(tokens, _score_pairs if withscores else None)
+
+    def zrangebyscore(self, key, min, max, withscores=False, offset=None, count=None):
+        # min/max as numbers, or strings for -inf/+inf and (exclusive bounds
+        tokens = ['ZRANGEBYSCORE', key, str(min), str(max)] + (['-WITHSCORES'] if withscores else [])
+        if offset is not None:
+            tokens += ['-LIMIT', str(offset), str(count)]
+        return self._call(tokens, _score_pairs if withscores else None)
+
+    def zcount(self, key, min, max):
+        return self._call(['ZCOUNT', key, str(min), str(max)])
+
+    def zrank(self, key, member):
+        return self._call(['ZRANK', key, member])
+
+    def zrevrank(self, key, member):
+        return self._call(['ZREVRANK', key, member])
+
+    def zscore(self, key, member):
+        return self._call(['ZSCORE', key, member], _float_or_none)
+
+    def zrem(self, key, *members):
+        return self._call(['ZREM', key, *members])
+
+    def scan(self, cursor=0, match=None, count=None):
+        # (next cursor, keys), the walk is complete once the cursor is back to 0
+        tokens = ['SCAN', str(cursor)] + (['-MATCH', match] if match is not None else []) + \
+            (['-COUNT', str(count)] if count is not None else [])
+        return self._call(tokens, lambda reply: (int(reply[0]), reply[1]))
+
+
+class Client(Commands):
+    """
+    Thread safe client for programs: every call borrows a connection from a ConnectionPool, so any number of threads
+    can share one Client. database is selected on every connection of the pool. With cache_size, get() is served
+    from a ClientCache of that many keys, which needs a database and a server started with --tracking_port.
+    Usage:
+        client = Client(port=5698, database='db')
+        client.set('a', '1')
+        with client.pipeline(transaction=True) as pipe:
+            pipe.execute_command('SET', 'a', '2')
+            pipe.execute_command('GET', 'a')
+            results = pipe.execute()
+    """
+    def __init__(self, host='localhost', port=5698, database=None, pool_size=8, timeout=10.0, retries=2,
+                 cache_size=0):
+        self.cache = ClientCache(host, database, cache_size) if cache_size else None
+        self.pool = ConnectionPool(host, port, database, pool_size, timeout, retries, self.cache)
+
+    def send_frame(self, payload):
+        with self.pool.connection() as connection:
+            return connection.send_frame(payload)
+
+    def execute_command(self, *tokens):
+        reply = self.send_frame(encode_command(tokens))[0]
+        if self.cache is not None and tokens[0] in _WRITE_COMMANDS:
+            # Read your own writes: the invalidation of a key this client just wrote may still be on its way
+            self.cache.forget(command_keys(tokens))
+        return reply
+
+    def get(self, key):
+        if self.cache is None:
+            return self._call(['GET', key])
+        return self.cache.get(key, lambda: self._call(['GET', key]))
+
+    def _call(self, tokens, parse=None):
+        return self._result(self.execute_command(*tokens), parse)
+
+    def pipeline(self, transaction=False):
+        # A pipeline goes out on a single connection, so MULTI/EXEC around it is safe
+        return Pipeline(self, transaction)
+
+    def close(self):
+        self.pool.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+class AsyncClient(Commands):
+    """
+    asyncio client on a single DEALER socket: any number of requests in flight at once. Every request carries an id,
+    the server echoes it back with the reply, which is how replies find their callers whatever order they come in.
+    A request without a reply within `timeout` seconds is sent again on a fresh socket (the old one may be talking
+    to a server that went away), up to `retries` more times. Requests share the socket's state on the server (the
+    selected database), so MULTI/WATCH belong in pipeline(transaction=True), not in concurrent calls.
+    Usage:
+        client = AsyncClient(port=5698, database='db')
+        values = await asyncio.gather(*(client.get(f'key{i}') for i in range(100)))
+    """
+    def __init__(self, host='localhost', port=5698, database=None, timeout=10.0, retries=2):
+        self.host = host
+        self.port = port
+        self.database = database
+        self.timeout = timeout
+        self.retries = retries
+        self.__context = zmq.asyncio.Context.instance()
+        self.__socket = None
+        self.__reader = None
+        self.__pending = {}
+        self.__ids = itertools.count()
+
+    async def __open(self):
+        socket = self.__context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(f"tcp://{self.host}:{self.port}")
+        self.__socket = socket
+        self.__reader = asyncio.ensure_future(self.__read(socket))
+        if self.database is not None:
+            reply = (await self.__request(encode_command(['SELECT', self.database])))[0]
+            if isinstance(reply, ErrorReply):
+                raise ResponseError(reply)
+
+    async def __read(self, socket):
+        # Hands every reply, [b'', request id, frame], to the request waiting for it
+        while True:
+            _, request_id, frame = await socket.recv_multipart()
+            future = self.__pending.pop(request_id, None)
+            if future is not None and not future.done():
+                future.set_result(decode_replies(frame))
+
+    async def __request(self, payload):
+        # A timer rather than asyncio.wait_for, which would wrap every request in a task of its own
+        loop = asyncio.get_running_loop()
+        request_id = b'%d' % next(self.__ids)
+        future = loop.create_future()
+        self.__pending[request_id] = future
+        socket = self.__socket
+        timer = loop.call_later(self.timeout, self.__expire, request_id, socket) if self.timeout is not None else None
+        await socket.send_multipart([b'', request_id, payload])
+        try:
+            return await future
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    def __expire(self, request_id, socket):
+        future = self.__pending.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_exception(TimeoutError(f'No reply from {self.host}:{self.port} within {self.timeout}s'))
+        if self.__socket is socket:
+            self.close()
+
+    async def send_frame(self, payload):
+        for attempt in range(self.retries + 1):
+            try:
+                if self.__socket is None:
+                    await self.__open()
+                replies = await self.__request(payload)
+            except TimeoutError:
+                if attempt == self.retries:
+                    raise
+                continue
+            if attempt == self.retries or not _lost_database(self.database, replies):
+                return replies
+            self.close()
+
+    async def execute_command(self, *tokens):
+        return (await self.send_frame(encode_command(tokens)))[0]
+
+    async def _call(self, tokens, parse=None):
+        return self._result(await self.execute_command(*tokens), parse)
+
+    def pipeline(self, transaction=False):
+        return AsyncPipeline(self, transaction)
+
+    def close(self):
+        if self.__reader is not None:
+            self.__reader.cancel()
+            self.__reader = None
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
 
 class ClientSession:
+    """
+    Connection to a server. With args.cluster the server is expected to be sharded (server.py --shards): the session
+    asks it for its shards and from then on sends every command straight to the shard holding its keys, see
+    modules/cluster.py, rather than through the front. Requests go through Connections, a lost reply is retried on a
+    fresh socket after args.timeout seconds rather than leaving the session stuck.
+    """
     def __init__(self, args):
-        self.__known_commands = {'SELECT', 'DESELECT', 'GET', 'SET', 'EXPIRE', 'TTL', 'DEL', 'ZADD', 'ZRANK', 'ZRANGE',
+        self.__known_commands = {'SELECT', 'DESELECT', 'GET', 'SET', 'EXPIRE', 'TTL', 'DEL', 'UNLINK', 'ZADD', 'ZRANK',
+                                 'ZRANGE', 'ZREVRANK', 'ZSCORE', 'ZREVRANGE', 'ZRANGEBYSCORE', 'ZREVRANGEBYSCORE',
+                                 'ZCOUNT', 'ZRANGEBYLEX', 'ZLEXCOUNT', 'ZREM', 'ZREMRANGEBYSCORE', 'ZREMRANGEBYRANK',
+                                 'MGET', 'MSET', 'MSETNX', 'SCAN', 'ZSCAN', 'MULTI', 'EXEC', 'DISCARD', 'WATCH',
+                                 'UNWATCH', 'BGSAVE', 'BGREWRITEAOF', 'ROLE', 'CLIENT', 'INFO', 'SLOWLOG', 'LATENCY',
                                  'EXIT'}
         self.__parsers = {}
         self.__init_parsers()
         self.server_host = args.server_host
         self.server_port = args.server_port
-        self.__context = None
-        self.__socket = None
+        self.cluster = getattr(args, 'cluster', False)
+        self.timeout = getattr(args, 'timeout', 10.0)
+        self.retries = getattr(args, 'retries', 2)
+        self.__connection = None
+        self.__shard_connections = None
+        self.__router = None
+        self.__cluster_connection = ClusterConnection()
 
     def __init_parsers(self):
         for command in self.__known_commands:
-            self.__parsers[command] = CommandParser(command)
+            self.__parsers[command] = FastCommandParser(command)
 
     def __validate_cmd(self, cmd):
-        command = shlex.split(cmd, comments=True)
+        try:
+            command = tokenize(cmd)
+        except ValueError as e:
+            print(e)
+            return None, None
         if command == [] or command[0] not in self.__known_commands:
             print(f'Unrecognized Command')
             print(f'The known commands are:')
             print(' '.join(self.__known_commands))
             return None, None
         else:
-            parsed_args = self.__parsers[command[0]].parse(command[1:])
+            parser = self.__parsers[command[0]]
+            parsed_args = parser.parse(command[1:])
             if parsed_args is not None:
                 return command, parsed_args
             else:
+                print(parser.last_error)
                 return None, None
 
     def connect(self):
-        self.__context = zmq.Context()
-        self.__socket = self.__context.socket(zmq.REQ)
-        self.__socket.connect(f"tcp://{self.server_host}:{self.server_port}")
+        self.__connection = Connection(self.server_host, self.server_port, timeout=self.timeout, retries=self.retries)
+        if self.cluster:
+            ports = self.__connection.send_frame(encode_command(['SHARDS']))[0]
+            if not isinstance(ports, list):
+                raise ConnectionError(f'{self.server_host}:{self.server_port} is not a sharded server: {ports}')
+            self.__shard_connections = [Connection(self.server_host, port, timeout=self.timeout, retries=self.retries)
+                                        for port in ports]
+            self.__router = ShardRouter(len(ports))
+
+    def send_frame(self, payload):
+        # One framed request (any number of encoded commands) out, the decoded list of their replies back
+        if self.__connection is None:
+            self.connect()
+        if self.__shard_connections:
+            return self.__send_sharded(payload)
+        return self.__connection.send_frame(payload)
+
+    def __send_sharded(self, payload):
+        # Every shard gets its commands before any reply is awaited, so the shards work on them in parallel
+        batch = Batch([self.__router.route(tokens, self.__cluster_connection) for tokens in decode_commands(payload)])
+        shard = batch.passthrough
+        if shard is not None:
+            return self.__shard_connections[shard].send_frame(payload)
+        connections = {shard: self.__shard_connections[shard] for shard in batch.commands}
+        try:
+            for shard, commands in batch.commands.items():
+                connections[shard].send(b''.join(encode_command(tokens) for tokens in commands))
+            return batch.replies({shard: connection.receive() for shard, connection in connections.items()})
+        except BaseException:
+            # Shards still owing a reply would refuse the next request
+            for connection in connections.values():
+                connection.close()
+            raise
+
+    def execute_command(self, *tokens):
+        reply = self.send_frame(encode_command(tokens))[0]
+        if tokens[0] in ('SELECT', 'DESELECT') and not isinstance(reply, ErrorReply):
+            # Selected again on the connections opened after a timeout
+            for connection in [self.__connection, *(self.__shard_connections or [])]:
+                connection.database = tokens[1] if tokens[0] == 'SELECT' else None
+        return reply
+
+    def pipeline(self):
+        return Pipeline(self)
 
-    def __process_command(self, user_input):
-        self.__socket.send_string(user_input)
-        message = self.__socket.recv_string()
-        return message
+    def __process_command(self, command):
+        return render(self.execute_command(*command))
 
     def shell(self):
-        if not self.__socket:
+        if self.__connection is None:
             self.connect()
         prompt = 'Redis> '
 
@@ -56,7 +667,7 @@ class ClientSession:
                 continue
             if validated_cmd[0] == 'EXIT':
                 sys.exit(0)
-            output = self.__process_command(user_input)
+            output = self.__process_command(validated_cmd)
             if output:
                 print(str(output))
 
@@ -71,6 +682,11 @@ if __name__=="__main__":
                                                  'database engine.')
     parser.add_argument('--server_host', default='localhost', help='Host Address for the server.')
     parser.add_argument('--server_port', default=5698, type=int, help='Host Port for the server.')
+    parser.add_argument('--cluster', action='store_true',
+                        help='Send commands straight to the shards of a sharded server rather than through its front.')
+    parser.add_argument('--timeout', default=10.0, type=float,
+                        help='Seconds to wait for a reply before reconnecting and sending the request again.')
+    parser.add_argument('--retries', default=2, type=int, help='Times a request is sent again after a timeout.')
 
     args = parser.parse_args()
     main(args)
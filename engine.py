@@ -1,46 +1,54 @@
 import argparse
 # import logging
-import shlex
 import time
-import _pickle as pickle
-from multiprocessing import Process, Lock
 import os
-import shutil
 # from sortedcontainers import SortedSet
 import sys
 # from modules.datastructures import MySortedSet, Value
-from modules.utils import CommandParser
-from modules.database import Database
+from modules.utils import FastCommandParser, tokenize
+from modules.protocol import OK, ErrorReply, encode_text
+from modules.database import Database, db_map
+from modules.replication import Replica, ReplicationStream
+from modules.tracking import InvalidationStream
+from modules.stats import ServerStats
+from modules import rdb
 
 
 
 
-def rdb_serialize(cur_database, dump_path, lock):
-    """
-    Function call to serialize database snapshot
-    Args:
-        cur_database: copy of data snapshot
-        dump_path: full path to file where data to be serialized
-        lock: multiprocessing.Lock object to prevent race conditions while serializing.
-    """
-
-    lock.acquire()
-    with open(dump_path+'.new', 'wb') as f:
-        pickle.dump(cur_database, f)
-    shutil.copy(dump_path+'.new', dump_path)
-    os.remove(dump_path+'.new')
-    lock.release()
-
-
 # TODO: To enable multiple server sessions, add a check if any other session using the same dataset
 # TODO: Make singleton class of database
-def init_database(name, log_path, dump_path):
+def init_database(name, log_path, dump_path, appendfsync='everysec', aof_enabled=True):
     log_path = os.path.join(log_path, name) + '.log'
     dump_path = os.path.join(dump_path, name) + '.rdb'
-    database = Database.get_instance(name, log_path, dump_path)
+    database = Database.get_instance(name, log_path, dump_path, appendfsync, aof_enabled)
     return database
 
 
+class Connection:
+    """
+    State a client keeps across its requests
+    queue: commands queued since MULTI, None outside a transaction
+    failed: a command failed validation while queueing, EXEC discards the transaction
+    watched: (database, key) pairs under WATCH, dirty is raised by the database once any of them is modified
+    database: the Database this client has SELECTed, None before SELECT and after DESELECT
+    tracking: topic the invalidations of the keys this client reads go to, None unless CLIENT TRACKING is on
+    last_seen: time of the client's latest request, see Session.timeout
+    """
+    def __init__(self):
+        self.database = None
+        self.queue = None
+        self.failed = False
+        self.watched = []
+        self.dirty = False
+        self.tracking = None
+        self.last_seen = 0.0
+
+    @property
+    def idle(self):
+        return self.database is None and self.queue is None and not self.watched and self.tracking is None
+
+
 class Session:
     """
     Session object for the Redis Server Instance.
@@ -50,9 +58,20 @@ class Session:
     def __init__(self, main_args):
 
         self.persistence_timeout = None
-        self.__known_commands = {'SELECT', 'DESELECT', 'GET', 'SET', 'EXPIRE', 'TTL', 'DEL', 'ZADD', 'ZRANK', 'ZRANGE',
-                                 'EXIT'}
-        self.__cur_database = None
+        self.__known_commands = {'SELECT', 'DESELECT', 'GET', 'SET', 'EXPIRE', 'TTL', 'DEL', 'UNLINK', 'ZADD', 'ZRANK',
+                                 'ZRANGE', 'ZREVRANK', 'ZSCORE', 'ZREVRANGE', 'ZRANGEBYSCORE', 'ZREVRANGEBYSCORE',
+                                 'ZCOUNT', 'ZRANGEBYLEX', 'ZLEXCOUNT', 'ZREM', 'ZREMRANGEBYSCORE', 'ZREMRANGEBYRANK',
+                                 'MGET', 'MSET', 'MSETNX', 'SCAN', 'ZSCAN', 'MULTI', 'EXEC', 'DISCARD', 'WATCH',
+                                 'UNWATCH', 'BGSAVE', 'BGREWRITEAOF', 'SYNC', 'ROLE', 'CLIENT', 'INFO', 'SLOWLOG',
+                                 'LATENCY', 'EXIT'}
+        # Run straight away even inside MULTI, everything else is queued for EXEC
+        self.__transaction_commands = {'MULTI', 'EXEC', 'DISCARD', 'WATCH'}
+        # Rejected by replicas, their data only changes through the primary
+        self.__write_commands = {'SET', 'EXPIRE', 'DEL', 'UNLINK', 'MSET', 'MSETNX', 'ZADD', 'ZREM', 'ZREMRANGEBYSCORE',
+                                 'ZREMRANGEBYRANK'}
+        # Their keys are tracked for clients with CLIENT TRACKING on
+        self.__read_commands = {'GET', 'MGET', 'TTL', 'ZRANK', 'ZRANGE', 'ZREVRANK', 'ZSCORE', 'ZREVRANGE',
+                                'ZRANGEBYSCORE', 'ZREVRANGEBYSCORE', 'ZCOUNT', 'ZRANGEBYLEX', 'ZLEXCOUNT', 'ZSCAN'}
 
         self.__command_processors = {
             'GET': self.__cmd_get,
@@ -62,163 +81,528 @@ class Session:
             'DESELECT': self.__cmd_deselect,
             'TTL': self.__cmd_ttl,
             'DEL': self.__cmd_del,
+            'UNLINK': self.__cmd_unlink,
+            'MGET': self.__cmd_mget,
+            'MSET': self.__cmd_mset,
+            'MSETNX': self.__cmd_msetnx,
+            'BGSAVE': self.__cmd_bgsave,
+            'BGREWRITEAOF': self.__cmd_bgrewriteaof,
             'ZADD': self.__cmd_zadd,
             'ZRANK': self.__cmd_zrank,
             'ZRANGE': self.__cmd_zrange,
+            'ZREVRANK': self.__cmd_zrevrank,
+            'ZSCORE': self.__cmd_zscore,
+            'ZREVRANGE': self.__cmd_zrevrange,
+            'ZRANGEBYSCORE': self.__cmd_zrangebyscore,
+            'ZREVRANGEBYSCORE': self.__cmd_zrevrangebyscore,
+            'ZCOUNT': self.__cmd_zcount,
+            'ZRANGEBYLEX': self.__cmd_zrangebylex,
+            'ZLEXCOUNT': self.__cmd_zlexcount,
+            'ZREM': self.__cmd_zrem,
+            'ZREMRANGEBYSCORE': self.__cmd_zremrangebyscore,
+            'ZREMRANGEBYRANK': self.__cmd_zremrangebyrank,
+            'SCAN': self.__cmd_scan,
+            'ZSCAN': self.__cmd_zscan,
+            'MULTI': self.__cmd_multi,
+            'EXEC': self.__cmd_exec,
+            'DISCARD': self.__cmd_discard,
+            'WATCH': self.__cmd_watch,
+            'UNWATCH': self.__cmd_unwatch,
+            'SYNC': self.__cmd_sync,
+            'ROLE': self.__cmd_role,
+            'CLIENT': self.__cmd_client,
+            'INFO': self.__cmd_info,
+            'SLOWLOG': self.__cmd_slowlog,
+            'LATENCY': self.__cmd_latency,
             'EXIT': self.__cmd_exit
         }
 
         self.__parsers = {}
         self.__init_parsers()
 
+        # Per client state, keyed by whatever identifies a client to the frontend. The shell is the one client None.
+        # Clients other than the current one, in the order they were last seen.
+        self.__connections = {}
+        self.__connection_id = None
+        self.__connection = Connection()
+
         self.__log_path = main_args.log_path
         self.__dump_path = main_args.database_path
 
-        self.last_save = time.time()
-
+        self.debug_mode = main_args.debug
         self.RDB_persistence = main_args.RDB_persistence
         if main_args.debug:
             self.RDB_timeout = main_args.RDB_timeout
         else:
             self.RDB_timeout = main_args.RDB_timeout*60.0
         self.AOF_persistence = main_args.AOF_persistence
-
-        self.lock = Lock()
+        self.appendfsync = main_args.appendfsync
+        self.auto_aof_rewrite_percentage = main_args.auto_aof_rewrite_percentage
+        self.auto_aof_rewrite_min_size = main_args.auto_aof_rewrite_min_size * 1024 * 1024
+        self.maxmemory = main_args.maxmemory * 1024 * 1024
+        self.maxmemory_policy = main_args.maxmemory_policy
+        self.maxmemory_samples = main_args.maxmemory_samples
+        self.lazyfree = getattr(main_args, 'lazyfree', False)
+        self.lazyfree_threshold = getattr(main_args, 'lazyfree_threshold', 1024)
+        self.bloom_error_rate = getattr(main_args, 'bloom_error_rate', None)
+        self.compression = getattr(main_args, 'compression', None)
+        self.compression_min_size = getattr(main_args, 'compression_min_size', 1024)
+        # Seconds a client may stay idle before its state is forgotten, 0 keeps it until the frontend reports the client
+        # gone, which stock libzmq never does
+        self.timeout = getattr(main_args, 'timeout', 300)
+
+        # Replication, server.py only: publish the writes of every database on replication_port, and/or follow the
+        # primary at replicaof (host:port) read only
+        replication_port = getattr(main_args, 'replication_port', None)
+        replicaof = getattr(main_args, 'replicaof', None)
+        self.replication = ReplicationStream(replication_port) if replication_port else None
+        self.replica = Replica(replicaof) if replicaof else None
+        # Client side caching, server.py only: invalidations of the keys tracking clients read go out on tracking_port
+        tracking_port = getattr(main_args, 'tracking_port', None)
+        self.tracking = InvalidationStream(tracking_port) if tracking_port else None
+
+        # Per command counters and latencies, and the slow log, see INFO, SLOWLOG and LATENCY HISTOGRAM
+        self.stats = ServerStats(getattr(main_args, 'slowlog_log_slower_than', 10000),
+                                 getattr(main_args, 'slowlog_max_len', 128),
+                                 getattr(main_args, 'latency_tracking', True))
 
     def __init_parsers(self):
         for command in self.__known_commands:
-            self.__parsers[command] = CommandParser(command)
+            self.__parsers[command] = FastCommandParser(command)
 
     def __cmd_exit(self, args):
         sys.exit(0)
 
     def __cmd_zrank(self, args):
         try:
-            return self.__cur_database.zrank(args.key, args.member)
+            return self.__connection.database.zrank(args.key, args.member)
         except KeyError:
-            return '(nil)'
+            return None
         except Exception as e:
-            return f"Error: {e}"
+            return ErrorReply(f"Error: {e}")
 
     def __cmd_zrange(self, args):
         try:
-            return self.__cur_database.zrange(args.key, args)
+            return self.__connection.database.zrange(args.key, args)
         except KeyError:
-            return '(nil)'
+            return None
         except Exception as e:
-            return f"Error: {e}"
+            return ErrorReply(f"Error: {e}")
+
+    def __cmd_zrevrank(self, args):
+        return self.__connection.database.zrevrank(args.key, args.member)
+
+    def __cmd_zscore(self, args):
+        return self.__connection.database.zscore(args.key, args.member)
+
+    def __cmd_zrevrange(self, args):
+        return self.__connection.database.zrevrange(args.key, args)
+
+    def __cmd_zrangebyscore(self, args):
+        return self.__connection.database.zrangebyscore(args.key, args)
+
+    def __cmd_zrevrangebyscore(self, args):
+        return self.__connection.database.zrangebyscore(args.key, args, reverse=True)
+
+    def __cmd_zcount(self, args):
+        return self.__connection.database.zcount(args.key, args)
+
+    def __cmd_zrangebylex(self, args):
+        return self.__connection.database.zrangebylex(args.key, args)
+
+    def __cmd_zlexcount(self, args):
+        return self.__connection.database.zlexcount(args.key, args)
+
+    def __cmd_zrem(self, args):
+        return self.__connection.database.zrem(args.key, args.members)
+
+    def __cmd_zremrangebyscore(self, args):
+        return self.__connection.database.zremrangebyscore(args.key, args)
+
+    def __cmd_zremrangebyrank(self, args):
+        return self.__connection.database.zremrangebyrank(args.key, args)
+
+    def set_connection(self, identity):
+        # Switches to the state of the client identified by identity, frontends call this before every request.
+        # State of a client with nothing open is dropped, it is recreated on demand.
+        if self.__connection_id != identity:
+            if not self.__connection.idle:
+                self.__connections[self.__connection_id] = self.__connection
+            self.__connection = self.__connections.pop(identity, None) or Connection()
+            self.__connection_id = identity
+        self.__connection.last_seen = time.time()
+
+    def drop_connection(self, identity):
+        # Forgets a client that went away, releasing its watched keys
+        connection = self.__connections.pop(identity, None)
+        if connection is None and self.__connection_id == identity:
+            connection = self.__connection
+            self.__connection, self.__connection_id = Connection(), None
+        if connection is not None:
+            for database, key in connection.watched:
+                database.unwatch(key, connection)
+
+    def __expire_connections(self):
+        # Forgets the clients idle for more than timeout seconds, oldest first. One that comes back finds its database
+        # deselected and its transaction gone, as after a restart, client.py then reconnects and selects it again.
+        deadline = time.time() - self.timeout
+        expired = []
+        for identity, connection in self.__connections.items():
+            if connection.last_seen >= deadline:
+                break
+            expired.append(identity)
+        for identity in expired:
+            self.drop_connection(identity)
+
+    def __unwatch_all(self):
+        connection = self.__connection
+        for database, key in connection.watched:
+            database.unwatch(key, connection)
+        connection.watched = []
+        connection.dirty = False
+
+    def __cmd_multi(self, args):
+        if self.__connection.queue is not None:
+            return ErrorReply('ERR MULTI calls can not be nested')
+        self.__connection.queue = []
+        self.__connection.failed = False
+        return OK
+
+    def __cmd_exec(self, args):
+        # Runs the queued commands back to back, nothing else gets in between, and logs them as a single record.
+        # Nothing runs if a command failed validation while queueing or a WATCHed key was modified since.
+        connection = self.__connection
+        if connection.queue is None:
+            return ErrorReply('ERR EXEC without MULTI')
+        queue, connection.queue = connection.queue, None
+        dirty = connection.dirty
+        self.__unwatch_all()
+        if connection.failed:
+            return ErrorReply('EXECABORT Transaction discarded because of previous errors.')
+        if dirty:
+            return None
+        with self.__connection.database.batch():
+            return [self.__call(cmd, parsed_args) for cmd, parsed_args in queue]
+
+    def __cmd_discard(self, args):
+        if self.__connection.queue is None:
+            return ErrorReply('ERR DISCARD without MULTI')
+        self.__connection.queue = None
+        self.__unwatch_all()
+        return OK
+
+    def __cmd_watch(self, args):
+        if self.__connection.queue is not None:
+            return ErrorReply('ERR WATCH inside MULTI is not allowed')
+        for key in args.keys:
+            self.__connection.database.watch(key, self.__connection)
+            self.__connection.watched.append((self.__connection.database, key))
+        return OK
+
+    def __cmd_unwatch(self, args):
+        self.__unwatch_all()
+        return OK
+
+    def __cmd_scan(self, args):
+        return self.__connection.database.scan(args.cursor, args.MATCH, args.COUNT, args.TYPE)
+
+    def __cmd_zscan(self, args):
+        return self.__connection.database.zscan(args.key, args.cursor, args.MATCH, args.COUNT)
 
     def __cmd_zadd(self, args):
-        return self.__cur_database.zadd(args.key, args)
+        return self.__connection.database.zadd(args.key, args)
 
     def __cmd_del(self, args):
-        for key in args.keys:
-            self.__cur_database.delete(key)
+        return self.__connection.database.delete_many(args.keys)
+
+    def __cmd_unlink(self, args):
+        return self.__connection.database.delete_many(args.keys, lazy=True)
+
+    def __cmd_mget(self, args):
+        return self.__connection.database.mget(args.keys)
+
+    def __cmd_mset(self, args):
+        return self.__connection.database.mset(args.key_value)
+
+    def __cmd_msetnx(self, args):
+        return self.__connection.database.msetnx(args.key_value)
 
     def __cmd_ttl(self, args):
-        return self.__cur_database.ttl(args.key)
+        return self.__connection.database.ttl(args.key)
 
     def __cmd_get(self, args):
         try:
-            return self.__cur_database.get(args.key)
+            return self.__connection.database.get(args.key)
         except KeyError:
-            return '(nil)'
+            return None
         except Exception as e:
-            return f"Error: {e}"
+            return ErrorReply(f"Error: {e}")
 
     def __cmd_set(self, args):
-        if self.__cur_database:
+        if self.__connection.database:
             try:
-                return self.__cur_database.set(args.key, args.value, args)
+                return self.__connection.database.set(args.key, args.value, args)
             except KeyError:
-                return '(nil)'
+                return None
             except Exception as e:
-                return f"Error: {e}"
+                return ErrorReply(f"Error: {e}")
 
         else:
-            return 'Error: No dataset currently loaded.'
+            return ErrorReply('Error: No dataset currently loaded.')
 
     def __cmd_expire(self, args):
         try:
-            return self.__cur_database.expire(args.key, args.seconds)
+            return self.__connection.database.expire(args.key, args.seconds)
         except KeyError:
-            return '(nil)'
+            return None
         except Exception as e:
-            return f"Error: {e}"
+            return ErrorReply(f"Error: {e}")
+
+    def __cmd_bgsave(self, args):
+        return self.__rdb_routine(self.__connection.database)
+
+    def __cmd_bgrewriteaof(self, args):
+        return self.__connection.database.bgrewriteaof()
 
     def __cmd_select(self, args):
-        if self.__cur_database is not None:
-            return f'Error: dataset `{self.__cur_database.name}` currently in use, cannot use multiple datasets.'
-        else:
-            self.restore(args.db_name)
-            return f"Loaded Dataset `{self.__cur_database.name}`"
+        # Selects a database for this client only, opening it first unless another client already did
+        try:
+            self.__connection.database = self.restore(args.db_name)
+        except ConnectionError as e:
+            return ErrorReply(f'ERR {e}')
+        return f"Loaded Dataset `{args.db_name}`"
+
+    def __cmd_sync(self, args):
+        # Asked by a replica: the stream port, and the id of a snapshot of the database being taken in the background
+        # with the stream offset it is at. The replica then reads the snapshot a chunk at a time with -CHUNK.
+        if self.replication is None:
+            return ErrorReply('ERR replication is not enabled, start the server with --replication_port')
+        database = self.restore(args.db_name)
+        if args.CHUNK is not None:
+            return database.sync_chunk(*args.CHUNK)
+        snapshot, offset = database.sync_snapshot()
+        return [self.replication.port, offset, snapshot]
+
+    def __cmd_role(self, args):
+        # The primary lists every open database with its offset, a replica how far behind the primary each one is,
+        # in records and in milliseconds
+        if self.replica is None:
+            return ['primary', [[name, database.replication_offset] for name, database in db_map.items()]]
+        now = time.time()
+        return ['replica', self.replica.primary,
+                [[name, state.offset, state.primary_offset - state.offset, int(state.lag * 1000),
+                  int((now - state.last_io) * 1000)] for name, state in self.replica.states()]]
+
+    def __cmd_client(self, args):
+        # CLIENT TRACKING ON: the keys this client reads from now on are tracked, the reply is the port and topic
+        # their invalidations are published on. OFF stops tracking, keys already tracked are still invalidated once.
+        if self.tracking is None:
+            return ErrorReply('ERR tracking is not enabled, start the server with --tracking_port')
+        if args.state == 'OFF':
+            self.__connection.tracking = None
+            return OK
+        self.__connection.tracking = args.REDIRECT or self.tracking.new_topic()
+        return [self.tracking.port, self.__connection.tracking]
+
+    def __cmd_info(self, args):
+        # Redis' INFO text: `# Section` headers and `field:value` lines. Databases report keyspace and persistence
+        # each on a line of their own, as `name:field=value,...`.
+        sections = set(args.sections) or {'server', 'memory', 'stats', 'replication', 'persistence', 'keyspace'}
+        if sections & {'all', 'everything'}:
+            sections = {'server', 'memory', 'stats', 'replication', 'persistence', 'commandstats', 'latencystats',
+                        'keyspace'}
+        databases = list(db_map.items())
+        lines = []
+
+        def section(title, fields):
+            if title.lower() in sections:
+                lines.append(f'# {title}')
+                lines.extend(f'{name}:{value}' for name, value in fields)
+                lines.append('')
+
+        def joined(fields):
+            return ','.join(f'{name}={-1 if value is None else value}' for name, value in fields.items())
+
+        stats = self.stats
+        section('Server', [('process_id', os.getpid()), ('python_version', sys.version.split()[0]),
+                           ('uptime_in_seconds', int(time.time() - stats.started))])
+        section('Memory', [('used_memory', sum(database.used_memory for _, database in databases)),
+                           ('maxmemory', self.maxmemory), ('maxmemory_policy', self.maxmemory_policy),
+                           ('lazyfree_pending_objects',
+                            sum(database.lazyfree_pending_objects for _, database in databases)),
+                           ('lazyfreed_objects', sum(database.lazyfreed_objects for _, database in databases))])
+        section('Stats', [('total_commands_processed', stats.total_commands),
+                          ('expired_keys', sum(database.expired_keys for _, database in databases)),
+                          ('evicted_keys', sum(database.evicted_keys for _, database in databases)),
+                          ('slowlog_len', len(stats.slowlog))])
+        section('Replication', [('role', 'primary' if self.replica is None else 'replica')] +
+                [(name, f'offset={database.replication_offset}') for name, database in databases])
+        section('Persistence', [(name, joined(database.persistence_stats())) for name, database in databases])
+        section('Commandstats', [(f'cmdstat_{command.lower()}',
+                                  f'calls={command_stats.calls},usec={command_stats.usec},'
+                                  f'usec_per_call={command_stats.usec / command_stats.calls:.2f},'
+                                  f'failed_calls={command_stats.failed_calls}')
+                                 for command, command_stats in sorted(stats.commands.items())])
+        section('Latencystats', [(f'latency_percentiles_usec_{command.lower()}',
+                                  ','.join(f'p{percentile}={command_stats.percentile(percentile / 100)}'
+                                           for percentile in (50, 99, 99.9)))
+                                 for command, command_stats in sorted(stats.commands.items())
+                                 if any(command_stats.histogram)])
+        section('Keyspace', [(name, joined(database.keyspace_stats())) for name, database in databases])
+        return '\r\n'.join(lines)
+
+    def __cmd_slowlog(self, args):
+        slowlog = self.stats.slowlog
+        if args.subcommand == 'LEN':
+            return len(slowlog)
+        if args.subcommand == 'RESET':
+            slowlog.clear()
+            return OK
+        entries = list(slowlog) if args.count < 0 else list(slowlog)[:args.count]
+        return [entry.reply() for entry in entries]
+
+    def __cmd_latency(self, args):
+        # Commands that never ran, or ran with latency tracking off, are left out
+        commands = args.commands or sorted(self.stats.commands)
+        return [[command, self.stats.histogram(command)] for command in commands
+                if command in self.stats.commands and any(self.stats.commands[command].histogram)]
 
     def __cmd_deselect(self, args):
-        if self.__cur_database is None:
-            return 'Error: No database currently loaded'
-        else:
-            self.__rdb_routine()
-            self.__cur_database = None
-
-    def process_command(self, cmd, parsed_args):
-        return self.__command_processors[cmd](parsed_args)
+        # The database stays open and keeps its persistence schedule, other clients may still be using it
+        if self.__connection.database is None:
+            return ErrorReply('Error: No database currently loaded')
+        self.__connection.database = None
+        return OK
+
+    def cron(self):
+        # Housekeeping between commands for every open database: expiry, lazy freeing, reaping background saves and
+        # rewrites and triggering the automatic ones, each on the database's own schedule
+        for database in list(db_map.values()):
+            database.cron()
+        if self.timeout and self.__connections:
+            self.__expire_connections()
+        if self.replication is not None:
+            self.replication.heartbeat(db_map.values())
+        if self.tracking is not None:
+            self.tracking.heartbeat()
+
+    def __call(self, cmd, parsed_args, tokens=None):
+        # Runs a command, timed and counted for INFO commandstats, latencystats and the slow log
+        start = time.perf_counter_ns()
+        reply = self.__command_processors[cmd](parsed_args)
+        usec = (time.perf_counter_ns() - start) // 1000
+        if self.stats.record(cmd, usec, reply):
+            self.stats.log_slow(usec, tokens or [cmd], self.__client_name())
+        return reply
+
+    def __client_name(self):
+        # How the slow log names the client: its identity frames in hex, empty for the shell
+        if not self.__connection_id:
+            return ''
+        return ':'.join(frame.hex() for frame in self.__connection_id)
+
+    def process_command(self, cmd, parsed_args, tokens=None):
+        # tokens: the command as sent, for the slow log
+        if self.replica is not None and cmd in self.__write_commands:
+            if self.__connection.queue is not None:
+                self.__connection.failed = True
+            return ErrorReply("READONLY You can't write against a read only replica.")
+        if self.__connection.queue is not None and cmd not in self.__transaction_commands:
+            if cmd in ('SELECT', 'DESELECT'):
+                self.__connection.failed = True
+                return ErrorReply(f'ERR {cmd} inside MULTI is not allowed')
+            self.__connection.queue.append((cmd, parsed_args))
+            return 'QUEUED'
+        reply = self.__call(cmd, parsed_args, tokens)
+        if self.__connection.tracking is not None and cmd in self.__read_commands:
+            database, topic = self.__connection.database, self.__connection.tracking
+            for key in (parsed_args.keys if cmd == 'MGET' else (parsed_args.key,)):
+                database.track(key, topic)
+        return reply
 
     def validate_cmd(self, cmd):
-        command = shlex.split(cmd, comments=True)
+        try:
+            command = tokenize(cmd)
+        except ValueError as e:
+            return None, ErrorReply(f'Error: {e}')
+        return self.validate_tokens(command)
+
+    def validate_tokens(self, command):
+        # Entry point for already tokenized commands, eg. ones decoded off the wire protocol. A command that fails
+        # validation inside MULTI fails the whole transaction.
+        validated_cmd, parsed_args = self.__validate(command)
+        if validated_cmd is None and self.__connection.queue is not None:
+            self.__connection.failed = True
+        return validated_cmd, parsed_args
+
+    def __validate(self, command):
         if command == [] or command[0] not in self.__known_commands:
             ret_val = f'Unrecognized Command\n' + f'The known commands are:\n' + ' '.join(self.__known_commands)
-            return None, ret_val
+            return None, ErrorReply(ret_val)
         else:
-            if self.__cur_database is None and command[0] not in ('EXIT', 'SELECT'):
+            if self.__connection.database is None and command[0] not in ('EXIT', 'SELECT', 'SYNC', 'ROLE', 'CLIENT', 'INFO',
+                                                                          'SLOWLOG', 'LATENCY'):
                 ret_val = f"Select a database first before running operations."
-                return None, ret_val
-            parsed_args = self.__parsers[command[0]].parse(command[1:])
+                return None, ErrorReply(ret_val)
+            parser = self.__parsers[command[0]]
+            parsed_args = parser.parse(command[1:])
             if parsed_args is not None:
                 return command, parsed_args
             else:
-                return None, None
+                return None, ErrorReply(parser.last_error)
 
-    def __rdb_routine(self):
-
-        if self.__cur_database is None:
-            return
-
-        # Store old logs for safety, renew current logs from scratch
-        self.__cur_database.backup_logs()
-
-        # Hand over data to child process, note that this is still suboptimal
-        child = Process(target=rdb_serialize, args=(self.__cur_database.data, self.__cur_database.dump_path, self.lock))
-        child.start()
-
-        os.remove(self.__cur_database.log_path+'.bkp')
-        self.last_save = time.time()
-        if self.debug:
-            print(f'RDB started at {self.last_save}')
+    def __rdb_routine(self, database):
+        # Forks a child which streams the snapshot to disk, the log is rotated to .bkp until it lands
+        ret_val = database.bgsave()
+        if self.debug_mode:
+            print(f'RDB of `{database.name}` started at {database.last_save}')
+        return ret_val
 
     def restore(self, name):
-
+        # Returns the database called name, loaded from its snapshot and log if it is not open yet. On a replica it is
+        # synced from the primary before first use, ConnectionError if the primary can't be reached.
+        database = db_map[name] if name in db_map else self.__open(name)
+        if self.replica is not None and not self.replica.following(name):
+            self.replica.sync(database)
+        return database
+
+    def __open(self, name):
+        start = time.perf_counter()
         if name+'.rdb' in os.listdir(self.__dump_path):
-            rdb_data = pickle.load(open(os.path.join(self.__dump_path, name+'.rdb'), 'rb'))
+            rdb_data = rdb.load(os.path.join(self.__dump_path, name+'.rdb'))
         else:
             rdb_data = {}
-
-        self.__cur_database = init_database(name, self.__log_path, self.__dump_path)
-        self.__cur_database.data = rdb_data
-        self.__cur_database.backup_logs()
-
-        if name + '.log.bkp' in os.listdir(self.__log_path):
-            with open(os.path.join(self.__log_path, name+'.log.bkp')) as f:
-                for line in f:
-                    command = ' '.join(line.strip().split()[3:])
-                    validated_cmd, parsed_args = self.validate_cmd(command)
-                    if validated_cmd is None:
-                        continue
-                    _ = self.process_command(validated_cmd[0], parsed_args)
-            os.remove(self.__cur_database.log_path+'.bkp')
-        else:
-            print('Error: Could not load previous log file.')
-
-        return
+        loaded = time.perf_counter()
+
+        database = init_database(name, self.__log_path, self.__dump_path, self.appendfsync, self.AOF_persistence)
+        database.maxmemory = self.maxmemory
+        database.maxmemory_policy = self.maxmemory_policy
+        database.maxmemory_samples = self.maxmemory_samples
+        database.lazyfree = self.lazyfree
+        database.lazyfree_threshold = self.lazyfree_threshold
+        database.bloom_error_rate = self.bloom_error_rate
+        database.compression = self.compression
+        database.compression_min_size = self.compression_min_size
+        database.load_data(rdb_data)
+        database.auto_rewrite_percentage = self.auto_aof_rewrite_percentage
+        database.auto_rewrite_min_size = self.auto_aof_rewrite_min_size
+        # Snapshot schedule counts from when this database was opened, so databases opened at different times don't
+        # all fork at once
+        database.save_interval = self.RDB_timeout if self.RDB_persistence else None
+        database.last_save = time.time()
+        if self.replication is not None:
+            database.replication_feed = self.replication.publish
+        if self.tracking is not None:
+            database.invalidation_feed = self.tracking.invalidate
+
+        # A leftover .bkp holds writes from before a snapshot that never completed, it goes before the current log
+        log_paths = [path for path in (database.log_path + '.bkp', database.log_path) if os.path.exists(path)]
+        read, applied = database.replay_logs(log_paths)
+        replayed = time.perf_counter()
+
+        print(f'Startup `{name}`: snapshot {len(rdb_data)} keys in {loaded - start:.3f}s, '
+              f'log {applied}/{read} records applied in {replayed - loaded:.3f}s, total {replayed - start:.3f}s')
+        return database
 
     def shell(self):
         prompt = 'Redis> '
@@ -230,12 +614,10 @@ class Session:
                 print(parsed_args)
                 continue
 
-            output = self.process_command(validated_cmd[0], parsed_args)
-            if output or output == 0:
-                print(output)
+            output = self.process_command(validated_cmd[0], parsed_args, validated_cmd)
+            print(encode_text(output))
 
-            if time.time() - self.last_save >= self.RDB_timeout:
-                self.__rdb_routine()
+            self.cron()
 
     def debug(self):
         prompt = 'Redis> '
@@ -249,11 +631,12 @@ class Session:
             if validated_cmd is None:
                 continue
 
-            output = self.process_command(validated_cmd[0], parsed_args)
+            output = self.process_command(validated_cmd[0], parsed_args, validated_cmd)
             if output:
                 print(output)
 
-        self.__rdb_routine()
+        if self.__connection.database is not None:
+            self.__rdb_routine(self.__connection.database)
         print('hello')
 
 
@@ -285,6 +668,39 @@ if __name__=="__main__":
     parser.add_argument('--RDB_persistence', type=bool, default=True, help="True if RDB persistence needed.")
     parser.add_argument('--RDB_timeout', default=30, type=int, help="Save dataset state every x minutes")
     parser.add_argument('--AOF_persistence', type=bool, default=True, help="True if AOF persistence needed.")
+    parser.add_argument('--appendfsync', default='everysec', choices=['always', 'everysec', 'no'],
+                        help="When to fsync the append only log: every write, once a second, or leave it to the OS.")
+    parser.add_argument('--auto_aof_rewrite_percentage', default=100, type=int,
+                        help="Rewrite the log in the background once it grew this many percent since the last "
+                             "rewrite, 0 disables automatic rewrites.")
+    parser.add_argument('--auto_aof_rewrite_min_size', default=64, type=int,
+                        help="Minimum log size in MB for automatic rewrites.")
+    parser.add_argument('--maxmemory', default=0, type=int,
+                        help="Memory limit in MB for the dataset, 0 for no limit.")
+    parser.add_argument('--maxmemory_policy', default='noeviction',
+                        choices=['noeviction', 'allkeys-lru', 'allkeys-lfu', 'allkeys-random', 'volatile-lru',
+                                 'volatile-lfu', 'volatile-random', 'volatile-ttl'],
+                        help="Which keys to evict once maxmemory is reached, noeviction rejects writes instead.")
+    parser.add_argument('--maxmemory_samples', default=5, type=int,
+                        help="Keys sampled per eviction, more is closer to exact LRU/LFU but slower.")
+    parser.add_argument('--lazyfree', action='store_true',
+                        help="Free big values dropped by DEL, overwrites, expiry and eviction incrementally between "
+                             "commands, as UNLINK always does.")
+    parser.add_argument('--lazyfree_threshold', default=1024, type=int,
+                        help="Sorted sets of more members than this are freed lazily by UNLINK and --lazyfree.")
+    parser.add_argument('--bloom_error_rate', default=None, type=float,
+                        help="Keep a Bloom filter over each database's keys with this false positive rate, eg. 0.01, "
+                             "so lookups of absent keys skip the keyspace. Off by default.")
+    parser.add_argument('--compression', default=None, choices=['zlib', 'lzma'],
+                        help="Keep big string values compressed with this codec, in memory, the log and snapshots.")
+    parser.add_argument('--compression_min_size', default=1024, type=int,
+                        help="Characters a string value needs for --compression to apply to it.")
+    parser.add_argument('--slowlog_log_slower_than', default=10000, type=int,
+                        help="Log commands taking longer than this many microseconds to SLOWLOG, 0 logs every "
+                             "command, a negative value none.")
+    parser.add_argument('--slowlog_max_len', default=128, type=int, help="Entries SLOWLOG keeps.")
+    parser.add_argument('--no_latency_tracking', dest='latency_tracking', action='store_false',
+                        help="Skip the per command latency histograms of INFO latencystats and LATENCY HISTOGRAM.")
     parser.add_argument('--debug', action='store_true')
 
     main_args = parser.parse_args()
@@ -0,0 +1,228 @@
+import os
+import shutil
+import threading
+import atexit
+from .protocol import encode_command, iter_commands, ProtocolError
+
+FSYNC_POLICIES = ('always', 'everysec', 'no')
+
+
+class AppendOnlyFile:
+    """
+    Append only log of the writes applied to a Database.
+    Records are the framed command arrays from modules/protocol.py, so they are compact, length prefixed and safe for
+    values containing spaces or newlines.
+    fsync_policy, as Redis' appendfsync:
+        always: every record is written and fsync'ed before the command returns
+        everysec: records are buffered in memory and a background thread writes and fsyncs them once a second,
+                  one group commit for everything that arrived in that second
+        no: every record is handed to the OS straight away, flushing to disk is left to the OS
+    """
+    def __init__(self, path, fsync_policy='everysec'):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f'Unknown fsync policy {fsync_policy}, expected one of {FSYNC_POLICIES}')
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.__lock = threading.Lock()
+        self.__buffer = []
+        self.__fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.__closed = threading.Event()
+        # Records that arrive while a background rewrite runs, appended to the rewritten file before it is swapped in
+        self.__rewrite_buffer = None
+        self.size = os.fstat(self.__fd).st_size
+        # Size right after the last rewrite (or at open), the automatic rewrite trigger measures growth against it
+        self.base_size = self.size
+
+        if fsync_policy == 'everysec':
+            self.__committer = threading.Thread(target=self.__group_commit, daemon=True)
+            self.__committer.start()
+        atexit.register(self.close)
+
+    def __group_commit(self):
+        while not self.__closed.wait(1.0):
+            self.flush()
+
+    def append(self, *tokens):
+        record = encode_command(tokens)
+        self.size += len(record)
+        if self.__rewrite_buffer is not None:
+            self.__rewrite_buffer.append(record)
+        if self.fsync_policy == 'everysec':
+            with self.__lock:
+                self.__buffer.append(record)
+        else:
+            with self.__lock:
+                os.write(self.__fd, record)
+                if self.fsync_policy == 'always':
+                    os.fsync(self.__fd)
+
+    def flush(self, fsync=True):
+        # Writes out anything buffered, fsyncs unless told otherwise
+        with self.__lock:
+            if self.__buffer:
+                os.write(self.__fd, b''.join(self.__buffer))
+                self.__buffer = []
+            if fsync and self.__fd is not None:
+                os.fsync(self.__fd)
+
+    def rotate(self, backup_path):
+        # Moves the current log to backup_path and starts afresh in an empty file at the same path. A backup left over
+        # from a snapshot that never completed is still needed, the current log is appended to it instead
+        with self.__lock:
+            if self.__buffer:
+                os.write(self.__fd, b''.join(self.__buffer))
+                self.__buffer = []
+            os.fsync(self.__fd)
+            os.close(self.__fd)
+            if os.path.exists(backup_path):
+                with open(self.path, 'rb') as current, open(backup_path, 'ab') as backup:
+                    shutil.copyfileobj(current, backup)
+                    backup.flush()
+                    os.fsync(backup.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, backup_path)
+            self.__fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self.size = self.base_size = 0
+
+    @property
+    def rewrite_in_progress(self):
+        return self.__rewrite_buffer is not None
+
+    def start_rewrite(self):
+        # Called right when the rewrite snapshot is taken, from here on records are also kept for the new file
+        self.__rewrite_buffer = []
+
+    def abort_rewrite(self):
+        self.__rewrite_buffer = None
+
+    def finish_rewrite(self, rewritten_path):
+        # Appends the writes buffered during the rewrite to rewritten_path, then atomically swaps it in for the log
+        with self.__lock:
+            if self.__buffer:
+                os.write(self.__fd, b''.join(self.__buffer))
+                self.__buffer = []
+            with open(rewritten_path, 'ab') as f:
+                f.write(b''.join(self.__rewrite_buffer))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(rewritten_path, self.path)
+            os.close(self.__fd)
+            self.__fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self.__rewrite_buffer = None
+            self.size = self.base_size = os.fstat(self.__fd).st_size
+
+    def close(self):
+        if self.__closed.is_set():
+            return
+        self.flush()
+        self.__closed.set()
+        with self.__lock:
+            os.close(self.__fd)
+            self.__fd = None
+
+
+def write_records(path, records):
+    """Writes an iterable of token sequences to a fresh log at path, fsync'ed before returning"""
+    with open(path, 'wb', buffering=1 << 20) as f:
+        for tokens in records:
+            f.write(encode_command(tokens))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_records(path):
+    """
+    Yields the records of the log at path. A torn final record (crash mid write) is cut off the file with a warning,
+    so later appends land on a clean boundary, as Redis does with aof-load-truncated.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data and data[:1] != b'*':
+        legacy_path = path + '.legacy'
+        os.replace(path, legacy_path)
+        print(f'Warning: {path} is not an append only file, moved it to {legacy_path}')
+        return
+
+    valid = 0
+    try:
+        for record, valid in iter_commands(data):
+            yield record
+    except (ProtocolError, ValueError):
+        print(f'Warning: truncating {len(data) - valid} bytes of incomplete records at the end of {path}')
+        with open(path, 'r+b') as f:
+            f.truncate(valid)
+
+
+def batch_record(records):
+    """
+    Packs records into a single EXEC record, each one prefixed with its token count. The batch is appended as one
+    write and a torn tail is cut as a whole, so after a crash it is found either complete or not at all.
+    """
+    tokens = ['EXEC']
+    for record in records:
+        tokens.append(str(len(record)))
+        tokens.extend(record)
+    return tokens
+
+
+def unbatch_records(records):
+    """Yields the records with every EXEC batch unpacked into the records it holds"""
+    for record in records:
+        if record[0] != 'EXEC':
+            yield record
+            continue
+        index = 1
+        while index < len(record):
+            count = int(record[index])
+            yield record[index + 1:index + 1 + count]
+            index += 1 + count
+
+
+def collapse_records(records):
+    """
+    Drops the records a later record makes irrelevant: everything before the last FLUSHALL, and every write to a key
+    that a later SET, SETC, MSET or DEL replaces wholesale. Applying the result gives the same data as applying all
+    records.
+    """
+    start = 0
+    for index in range(len(records) - 1, -1, -1):
+        if records[index][0] == 'FLUSHALL':
+            start = index
+            break
+
+    last_overwrite = {}
+    for index in range(start, len(records)):
+        record = records[index]
+        op = record[0]
+        if op in ('SET', 'SETC'):
+            last_overwrite[record[1]] = index
+        elif op == 'MSET':
+            for key in record[1::2]:
+                last_overwrite[key] = index
+        elif op == 'DEL':
+            for key in record[1:]:
+                last_overwrite[key] = index
+
+    collapsed = []
+    for index in range(start, len(records)):
+        record = records[index]
+        op = record[0]
+        if op in ('SET', 'SETC'):
+            if last_overwrite[record[1]] == index:
+                collapsed.append(record)
+        elif op == 'MSET':
+            tokens = [token for key, val in zip(record[1::2], record[2::2]) if last_overwrite[key] == index
+                      for token in (key, val)]
+            if tokens:
+                collapsed.append(['MSET'] + tokens)
+        elif op == 'DEL':
+            keys = [key for key in record[1:] if last_overwrite[key] == index]
+            if keys:
+                collapsed.append(['DEL'] + keys)
+        elif op == 'FLUSHALL':
+            collapsed.append(record)
+        elif last_overwrite.get(record[1], -1) < index:
+            # EXPIREAT and ZADD build on the key's current state, only the ones after its last overwrite count
+            collapsed.append(record)
+    return collapsed
@@ -0,0 +1,286 @@
+"""
+Hash sharding of the keyspace over several server processes, as Redis Cluster.
+
+Every key maps to one of HASH_SLOTS slots by the CRC16 of the key (binascii.crc_hqx is the XMODEM CRC16 Redis uses),
+or of its hash tag: the part between the first `{` and the next `}` when not empty, so `{user1}.name` and
+`{user1}.age` always land on the same shard. Slots are split in contiguous ranges, one per shard.
+
+ShardRouter turns a client command into the commands each shard runs plus the function merging their replies. It does
+no I/O, both the front of a sharded server.py and client.py's cluster mode drive it.
+"""
+import binascii
+
+from .protocol import OK, ErrorReply, ENCODING, ERRORS
+
+HASH_SLOTS = 16384
+
+# Commands whose first argument is their only key
+KEY_COMMANDS = frozenset({'GET', 'SET', 'EXPIRE', 'TTL', 'ZADD', 'ZRANK', 'ZRANGE', 'ZREVRANK', 'ZSCORE', 'ZREVRANGE',
+                          'ZRANGEBYSCORE', 'ZREVRANGEBYSCORE', 'ZCOUNT', 'ZRANGEBYLEX', 'ZLEXCOUNT', 'ZREM',
+                          'ZREMRANGEBYSCORE', 'ZREMRANGEBYRANK', 'ZSCAN'})
+# Commands run by every shard, eg. every shard has its own copy of each database
+BROADCAST_COMMANDS = frozenset({'SELECT', 'DESELECT', 'BGSAVE', 'BGREWRITEAOF'})
+
+CROSS_SHARD = "CROSSSLOT Keys in request don't hash to the same shard"
+# Invalidations come from the shard holding the key, a client has to track on every shard it reads from itself
+NO_TRACKING = 'ERR CLIENT TRACKING is not supported across shards, turn it on with each shard directly'
+
+
+def key_slot(key):
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return binascii.crc_hqx(key.encode(ENCODING, ERRORS), 0) % HASH_SLOTS
+
+
+def command_keys(tokens):
+    # The keys a command touches, empty for keyless ones
+    command = tokens[0]
+    if command in KEY_COMMANDS:
+        return tokens[1:2]
+    if command in ('DEL', 'UNLINK', 'MGET', 'WATCH'):
+        return tokens[1:]
+    if command in ('MSET', 'MSETNX'):
+        return tokens[1::2]
+    return []
+
+
+class ClusterConnection:
+    """
+    Transaction state a client of a sharded server keeps across its requests
+    queue: commands queued since MULTI, None outside a transaction. They are only sent, with MULTI and EXEC around
+           them, once EXEC comes, so a transaction still runs on one shard back to back
+    shard: the shard WATCH or the queued commands pinned the transaction to, None while nothing did
+    failed: a command could not be queued, EXEC discards the transaction
+    last_seen: time of the client's latest request, see ShardedServer.timeout
+    """
+    def __init__(self):
+        self.queue = None
+        self.shard = None
+        self.failed = False
+        self.last_seen = 0.0
+
+    @property
+    def idle(self):
+        return self.queue is None and self.shard is None
+
+
+def _local(reply):
+    # A reply that needs no shard at all
+    return [], lambda replies: reply
+
+
+def _first_error(replies):
+    for part in replies:
+        for reply in part:
+            if isinstance(reply, ErrorReply):
+                return reply
+    return None
+
+
+class ShardRouter:
+    """
+    Plans commands over `shards` shards. route() returns (parts, merge): parts is a list of (shard, commands) with the
+    commands (token lists) that shard has to run, merge takes the shards' replies, one list per part, and returns the
+    reply to the client. merge is None when there is a single part with a single command whose reply is passed on as is.
+    Commands over keys on different shards are split (DEL, UNLINK, MGET, MSET) or rejected with a CROSSSLOT error where
+    they must be atomic (MSETNX, WATCH, transactions). SCAN walks the shards one after the other, the shard is kept in
+    the low digits of the cursor.
+    """
+    def __init__(self, shards):
+        self.shards = shards
+        self.__transaction_handlers = {
+            'MULTI': self.__multi,
+            'EXEC': self.__exec,
+            'DISCARD': self.__discard,
+            'WATCH': self.__watch,
+        }
+
+    def shard(self, key):
+        return key_slot(key) * self.shards // HASH_SLOTS
+
+    def route(self, tokens, connection):
+        command = tokens[0] if tokens else ''
+        if command in self.__transaction_handlers:
+            return self.__transaction_handlers[command](tokens, connection)
+        if connection.queue is not None:
+            return self.__queue(tokens, connection)
+        if command == 'UNWATCH':
+            return self.__unwatch(tokens, connection)
+        if command in KEY_COMMANDS and len(tokens) > 1:
+            return [(self.shard(tokens[1]), [tokens])], None
+        if command in ('DEL', 'UNLINK', 'MGET') and len(tokens) > 1:
+            return self.__split(tokens, 1)
+        if command == 'MSET' and len(tokens) > 1 and len(tokens) % 2:
+            return self.__split(tokens, 2)
+        if command == 'MSETNX' and len(tokens) > 1:
+            shards = {self.shard(key) for key in command_keys(tokens)}
+            if len(shards) > 1:
+                return _local(ErrorReply(CROSS_SHARD))
+            return [(shards.pop(), [tokens])], None
+        if command in BROADCAST_COMMANDS:
+            return [(shard, [tokens]) for shard in range(self.shards)], self.__merge_broadcast
+        if command == 'CLIENT':
+            return _local(ErrorReply(NO_TRACKING))
+        if command == 'SCAN' and len(tokens) > 1 and tokens[1].isdigit():
+            return self.__scan(tokens)
+        # Anything else, including malformed commands, goes to the first shard which answers it or rejects it
+        return [(0, [tokens])], None
+
+    def __split(self, tokens, width):
+        # Groups the arguments of a multi key command by the shard of their key, width arguments per key
+        groups = {}
+        for index in range(1, len(tokens), width):
+            groups.setdefault(self.shard(tokens[index]), []).append(index)
+        if len(groups) == 1:
+            return [(next(iter(groups)), [tokens])], None
+        command = tokens[0]
+        parts = [(shard, [[command] + [token for index in indexes for token in tokens[index:index + width]]])
+                 for shard, indexes in groups.items()]
+
+        def merge(replies):
+            error = _first_error(replies)
+            if error is not None:
+                return error
+            if command in ('DEL', 'UNLINK'):
+                return sum(part[0] for part in replies)
+            if command == 'MSET':
+                return OK
+            values = [None] * (len(tokens) - 1)
+            for indexes, part in zip(groups.values(), replies):
+                for index, value in zip(indexes, part[0]):
+                    values[index - 1] = value
+            return values
+        return parts, merge
+
+    @staticmethod
+    def __merge_broadcast(replies):
+        error = _first_error(replies)
+        return error if error is not None else replies[0][0]
+
+    def __scan(self, tokens):
+        cursor = int(tokens[1])
+        shard, shard_cursor = cursor % self.shards, cursor // self.shards
+
+        def merge(replies):
+            reply = replies[0][0]
+            if isinstance(reply, ErrorReply):
+                return reply
+            next_cursor, keys = reply
+            next_cursor = int(next_cursor)
+            if next_cursor:
+                next_cursor = next_cursor * self.shards + shard
+            elif shard + 1 < self.shards:
+                # Done with this shard, start over on the next one
+                next_cursor = shard + 1
+            return [str(next_cursor), keys]
+        return [(shard, [[tokens[0], str(shard_cursor)] + tokens[2:]])], merge
+
+    def __pin(self, tokens, connection):
+        # Shard the transaction runs on with this command in it, None if its keys span more than one
+        shards = {self.shard(key) for key in command_keys(tokens)}
+        if connection.shard is not None:
+            shards.add(connection.shard)
+        if len(shards) > 1:
+            return None
+        return shards.pop() if shards else 0
+
+    def __multi(self, tokens, connection):
+        if connection.queue is not None:
+            return _local(ErrorReply('ERR MULTI calls can not be nested'))
+        connection.queue = []
+        connection.failed = False
+        return _local(OK)
+
+    def __queue(self, tokens, connection):
+        command = tokens[0] if tokens else ''
+        if command in ('SELECT', 'DESELECT'):
+            connection.failed = True
+            return _local(ErrorReply(f'ERR {command} inside MULTI is not allowed'))
+        if command_keys(tokens):
+            shard = self.__pin(tokens, connection)
+            if shard is None:
+                connection.failed = True
+                return _local(ErrorReply(CROSS_SHARD))
+            connection.shard = shard
+        connection.queue.append(tokens)
+        return _local('QUEUED')
+
+    def __exec(self, tokens, connection):
+        # Sends the whole transaction to its shard in one go, the reply to EXEC is the reply
+        if connection.queue is None:
+            return _local(ErrorReply('ERR EXEC without MULTI'))
+        queue, shard, failed = connection.queue, connection.shard, connection.failed
+        connection.queue = connection.shard = None
+        connection.failed = False
+        if failed:
+            abort = ErrorReply('EXECABORT Transaction discarded because of previous errors.')
+            if shard is None:
+                return _local(abort)
+            return [(shard, [['UNWATCH']])], lambda replies: abort
+        return [(shard or 0, [['MULTI'], *queue, ['EXEC']])], lambda replies: replies[0][-1]
+
+    def __discard(self, tokens, connection):
+        if connection.queue is None:
+            return _local(ErrorReply('ERR DISCARD without MULTI'))
+        shard = connection.shard
+        connection.queue = connection.shard = None
+        if shard is None:
+            return _local(OK)
+        return [(shard, [['UNWATCH']])], lambda replies: OK
+
+    def __watch(self, tokens, connection):
+        if connection.queue is not None:
+            return _local(ErrorReply('ERR WATCH inside MULTI is not allowed'))
+        if len(tokens) < 2:
+            return [(connection.shard or 0, [tokens])], None
+        shard = self.__pin(tokens, connection)
+        if shard is None:
+            return _local(ErrorReply(CROSS_SHARD))
+        connection.shard = shard
+        return [(shard, [tokens])], None
+
+    def __unwatch(self, tokens, connection):
+        shard, connection.shard = connection.shard, None
+        if shard is None:
+            return _local(OK)
+        return [(shard, [tokens])], None
+
+
+class Batch:
+    """
+    The commands of one client request spread over the shards. commands maps each shard to what it runs, in request
+    order, replies() puts the shards' replies back together into one reply per command.
+    """
+    def __init__(self, plans):
+        self.plans = plans
+        self.commands = {}
+        for parts, _ in plans:
+            for shard, commands in parts:
+                self.commands.setdefault(shard, []).extend(commands)
+
+    @property
+    def passthrough(self):
+        # The one shard whose reply frame is the reply as is, None if replies have to be merged
+        if len(self.commands) == 1 and all(merge is None for _, merge in self.plans):
+            return next(iter(self.commands))
+        return None
+
+    def replies(self, shard_replies):
+        # shard_replies maps each shard to the decoded list of its replies
+        for shard, commands in self.commands.items():
+            if len(shard_replies[shard]) != len(commands):
+                # A shard rejected the frame as a whole, eg. with a protocol error, every command gets its reply
+                shard_replies[shard] = shard_replies[shard][:1] * len(commands)
+        offsets = dict.fromkeys(shard_replies, 0)
+        results = []
+        for parts, merge in self.plans:
+            part_replies = []
+            for shard, commands in parts:
+                start = offsets[shard]
+                offsets[shard] = start + len(commands)
+                part_replies.append(shard_replies[shard][start:start + len(commands)])
+            results.append(part_replies[0][0] if merge is None else merge(part_replies))
+        return results
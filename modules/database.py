@@ -1,12 +1,64 @@
+import fnmatch
+import gc
+import heapq
+import itertools
+import math
 import os
-import shutil
-import logging
+import random
+import re
+import struct
+from contextlib import contextmanager
+import sys
 from multiprocessing import Lock
 import time
-from .datastructures import Value, MySortedSet
+from collections import deque
+from .datastructures import Value, MySortedSet, BloomFilter, CompressedString
+from .protocol import OK, ErrorReply, ENCODING, ERRORS
+from .aof import AppendOnlyFile, read_records, write_records, collapse_records, batch_record, unbatch_records
+from . import rdb
 
 db_map = {}
 db_lock = Lock()
+_double = struct.Struct('>d')
+
+EVICTION_POLICIES = ('noeviction', 'allkeys-lru', 'allkeys-lfu', 'allkeys-random', 'volatile-lru', 'volatile-lfu',
+                     'volatile-random', 'volatile-ttl')
+
+# Estimated bytes a key costs beyond its key and value strings: the Value object, the data dict entry and the key list
+# slot. A sorted set costs, by encoding, a fixed amount for its structures plus a fixed amount per member.
+KEY_OVERHEAD = 200
+ZSET_OVERHEAD = {'listpack': (150, 100), 'skiplist': (1500, 170)}
+
+# LFU counter as in Redis: 8 bit logarithmic counter, new keys start at LFU_INIT_VAL, the counter drops by one per
+# LFU_DECAY_TIME minutes without access. Value.access packs the minute of the last decay above the counter.
+LFU_INIT_VAL = 5
+LFU_LOG_FACTOR = 10
+LFU_DECAY_TIME = 1
+
+# Seconds expired_keys_per_sec is averaged over, cron moves the window on
+EXPIRE_RATE_WINDOW = 1
+
+# Fewest keys a Bloom filter is sized for, see Database.bloom_error_rate
+BLOOM_MIN_CAPACITY = 1024
+
+# Bytes of a replica snapshot sent per SYNC -CHUNK reply
+SYNC_CHUNK_SIZE = 1 << 20
+
+# Members a lazily freed value gives up per lazyfree_cycle step, a step takes about half a millisecond
+LAZYFREE_STEP = 1024
+
+
+def lfu_decayed(access, minutes):
+    elapsed = (minutes - (access >> 8)) & 0xFFFF
+    return max(0, (access & 0xFF) - elapsed // LFU_DECAY_TIME)
+
+
+def lfu_increment(access, minutes):
+    counter = lfu_decayed(access, minutes)
+    if counter < 255 and random.random() < 1.0 / ((counter - LFU_INIT_VAL if counter > LFU_INIT_VAL else 0)
+                                                   * LFU_LOG_FACTOR + 1):
+        counter += 1
+    return (minutes << 8) | counter
 
 
 class Database:
@@ -14,63 +66,411 @@ class Database:
     Database class, holds key `str` value `Value` pairs
     name: name identifier to select, log and dump path
     log_path, dump_path: full paths to log and dump files
+    appendfsync: fsync policy of the append only log, see AppendOnlyFile
+    aof_enabled: False to skip write logging altogether
     """
-    def __init__(self, name, log_path, dump_path):
+    def __init__(self, name, log_path, dump_path, appendfsync='everysec', aof_enabled=True):
         self.name = name
         self.log_path = log_path
         self.dump_path = dump_path
         self.data = {}
-        self.logger = None
-        self.file_handler = None
-        self.setup_logger()
+        self.aof = AppendOnlyFile(log_path, appendfsync) if aof_enabled else None
+
+        # TTL index: min-heap of (timeout, key). Entries go stale when a key is deleted or its timeout changes, they
+        # are skipped when popped and compacted away once they outnumber the live ones.
+        self.__expires = []
+        self.__volatile = 0
+        self.expired_keys = 0
+        # Keys expired per second over the last complete EXPIRE_RATE_WINDOW, and where the current window started:
+        # (time, expired_keys)
+        self.expired_keys_per_sec = 0.0
+        self.__expire_window = (time.time(), 0)
+        # Wall clock seconds a single active expire cycle may spend between two commands
+        self.active_expire_budget = 0.001
+
+        # Memory limit in bytes of estimated dataset size, 0 for none, and what to do when a write would exceed it.
+        # Eviction samples maxmemory_samples keys at random and drops the worst one, as Redis' maxmemory-samples.
+        self.maxmemory = 0
+        self.maxmemory_policy = 'noeviction'
+        self.maxmemory_samples = 5
+        self.used_memory = 0
+        self.evicted_keys = 0
+        self.__keys = []
+        self.__lru_clock = 0
+
+        # WATCH support: key -> watchers, objects with a `dirty` flag that is raised when the key is modified
+        self.__watchers = {}
+        # Records logged inside batch(), written out as one record when it ends
+        self.__batch = None
+        # Replication: every record logged is also handed to replication_feed(database, record) when set, the offset
+        # counts them, see modules/replication.py
+        self.replication_feed = None
+        self.replication_offset = 0
+        # CLIENT TRACKING: key -> topics of the clients that read it since it last changed, see modules/tracking.py.
+        # invalidation_feed(database, key, topics) tells them once it changes, key None for every key. The table holds
+        # at most tracking_table_max_keys keys, the oldest are invalidated early to make room.
+        self.__tracked = {}
+        self.invalidation_feed = None
+        self.tracking_table_max_keys = 1000000
+        # Lazy freeing, as Redis' lazyfree: sorted sets of more than lazyfree_threshold members dropped by UNLINK, or
+        # with lazyfree on by DEL, overwrites, expiry, eviction and replicated deletes, are queued rather than freed at
+        # once, then released LAZYFREE_STEP members at a time by lazyfree_cycle between commands. Freeing a set of a
+        # million members in one go stalls the server for about 100ms. A dataset replaced by load_data is queued too.
+        self.lazyfree = False
+        self.lazyfree_threshold = 1024
+        self.lazyfree_budget = 0.001
+        self.lazyfreed_objects = 0
+        self.__lazyfree = deque()
+        # Negative lookup cache: with bloom_error_rate set, a counting Bloom filter over the keys answers lookups of
+        # absent keys before self.data is consulted, that fraction of them gets through anyway. It is built by
+        # load_data for twice the keys loaded and rebuilt twice as big whenever the keys outgrow it.
+        self.bloom_error_rate = None
+        self.__bloom = None
+        # Compression of big strings: with compression set to one of CODECS, string values of at least
+        # compression_min_size characters are kept as CompressedString in memory, in the log (SETC records) and in
+        # snapshots, values that don't shrink stay as they are. Reads returning them decompress a copy. The stats count
+        # compressions tried, sizes before and after them, decompressions, and the nanoseconds spent on both.
+        self.compression = None
+        self.compression_min_size = 1024
+        self.compression_stats = {'compress_calls': 0, 'raw_bytes': 0, 'compressed_bytes': 0, 'compress_ns': 0,
+                                  'decompress_calls': 0, 'decompress_ns': 0}
+
+        # Automatic BGREWRITEAOF once the log grew this many percent over its size after the last rewrite and is at
+        # least this many bytes, as Redis' auto-aof-rewrite-percentage and auto-aof-rewrite-min-size
+        self.auto_rewrite_percentage = 100
+        self.auto_rewrite_min_size = 64 * 1024 * 1024
+        # Seconds between automatic background snapshots, None for none, and when the last one started
+        self.save_interval = None
+        self.last_save = time.time()
+        self.__rewrite_child = None
+        self.__save_child = None
+        self.__save_started = None
+        # Outcome of the most recent snapshot: status, duration and fork time in seconds, peak RSS of the child in KB
+        self.save_stats = {'last_bgsave_status': None, 'last_save_duration': None, 'last_fork_time': None,
+                           'last_save_peak_rss_kb': None}
+        # Snapshots for replicas, see sync_snapshot: id -> [child pid (None once written), offset, path, start time].
+        # Written ones are deleted sync_snapshot_ttl seconds after they were started.
+        self.__sync_snapshots = {}
+        self.__sync_ids = itertools.count(1)
+        self.sync_snapshot_ttl = 60
 
     @staticmethod
-    def get_instance(name, log_path, dump_path):
+    def get_instance(name, log_path, dump_path, appendfsync='everysec', aof_enabled=True):
         if name not in db_map.keys():
             db_lock.acquire()
             if name not in db_map.keys():
-                db_map[name] = Database(name, log_path, dump_path)
+                db_map[name] = Database(name, log_path, dump_path, appendfsync, aof_enabled)
             db_lock.release()
         return db_map[name]
 
-    def setup_logger(self):
-        self.logger = logging.getLogger(self.name)
-        self.logger.setLevel(logging.INFO)
-        self.file_handler = logging.FileHandler(self.log_path)
-        log_format = logging.Formatter('%(asctime)s %(name)s %(message)s')
-        self.file_handler.setFormatter(log_format)
-        self.logger.addHandler(self.file_handler)
+    def __log(self, *tokens):
+        if self.__batch is not None:
+            self.__batch.append(tokens)
+            return
+        if self.aof is not None:
+            self.aof.append(*tokens)
+        if self.replication_feed is not None:
+            self.replication_offset += 1
+            self.replication_feed(self, tokens)
+
+    def __log_together(self, records):
+        # Logs records that make up a single write as one, unless they already are part of a batch
+        if len(records) == 1 or self.__batch is not None:
+            for record in records:
+                self.__log(*record)
+        else:
+            self.__log(*batch_record(records))
+
+    @contextmanager
+    def batch(self):
+        # Everything logged inside the block goes to the log as a single record, eg. the commands of an EXEC
+        self.__batch = []
+        try:
+            yield
+        finally:
+            records, self.__batch = self.__batch, None
+            if len(records) == 1:
+                self.__log(*records[0])
+            elif records:
+                self.__log(*batch_record(records))
+
+    def watch(self, key, watcher):
+        self.__watchers.setdefault(key, set()).add(watcher)
+
+    def unwatch(self, key, watcher):
+        watchers = self.__watchers.get(key)
+        if watchers is not None:
+            watchers.discard(watcher)
+            if not watchers:
+                del self.__watchers[key]
+
+    def track(self, key, topic):
+        # Remembers that the client behind topic read key, it is told once key changes
+        topics = self.__tracked.get(key)
+        if topics is None:
+            if len(self.__tracked) >= self.tracking_table_max_keys:
+                oldest = next(iter(self.__tracked))
+                self.invalidation_feed(self, oldest, self.__tracked.pop(oldest))
+            topics = self.__tracked[key] = set()
+        topics.add(topic)
+
+    def __touched(self, key):
+        # Called for every modification of key, flags whoever watches it and invalidates it for whoever read it
+        if self.__watchers:
+            for watcher in self.__watchers.pop(key, ()):
+                watcher.dirty = True
+        if self.__tracked:
+            topics = self.__tracked.pop(key, None)
+            if topics:
+                self.invalidation_feed(self, key, topics)
+
+    def __store(self, key, value):
+        # Single entry point for putting a key into self.data, keeps the TTL index, key list and memory count in step
+        old = self.data.get(key)
+        if old is not None:
+            if old.timeout:
+                self.__volatile -= 1
+            self.used_memory -= self.__sizeof(key, old)
+            value.slot = old.slot
+            # An overwrite keeps the key's access frequency, as Redis does under LFU
+            value.access = old.access if self.maxmemory_policy.endswith('lfu') else self.__new_access()
+            self.__release(old, self.lazyfree)
+        else:
+            if self.__bloom is not None:
+                # Grown before the key joins the key list the new filter is built from, so it is added just once
+                if self.__bloom.count >= self.__bloom.capacity:
+                    self.__build_bloom(2 * self.__bloom.capacity)
+                self.__bloom.add(key)
+            value.slot = len(self.__keys)
+            self.__keys.append(key)
+            value.access = self.__new_access()
+        self.data[key] = value
+        self.used_memory += self.__sizeof(key, value)
+        if value.timeout:
+            self.__index_timeout(key, value.timeout)
+        self.__touched(key)
+
+    def __drop(self, key, lazy=None):
+        # Single exit point for keys leaving self.data, returns the removed Value or None. lazy overrides lazyfree.
+        value = self.data.pop(key, None)
+        if value is not None:
+            if value.timeout:
+                self.__volatile -= 1
+            self.used_memory -= self.__sizeof(key, value)
+            last = self.__keys.pop()
+            if value.slot < len(self.__keys):
+                self.__keys[value.slot] = last
+                self.data[last].slot = value.slot
+            if self.__bloom is not None:
+                self.__bloom.remove(key)
+            self.__touched(key)
+            self.__release(value, self.lazyfree if lazy is None else lazy)
+        return value
+
+    def __release(self, value, lazy):
+        # Queues a value that just left the data for lazyfree_cycle, when lazy and big enough to be worth it
+        if lazy and type(value.val) == MySortedSet and len(value.val) > self.lazyfree_threshold:
+            self.__lazyfree.append(value.val)
+
+    @staticmethod
+    def __sizeof(key, value):
+        if type(value.val) == MySortedSet:
+            fixed, per_member = ZSET_OVERHEAD[value.val.encoding]
+            return KEY_OVERHEAD + sys.getsizeof(key) + fixed + per_member * len(value.val)
+        return KEY_OVERHEAD + sys.getsizeof(key) + sys.getsizeof(value.val)
+
+    def __new_access(self):
+        if self.maxmemory_policy.endswith('lfu'):
+            return (int(time.time() // 60) & 0xFFFF) << 8 | LFU_INIT_VAL
+        self.__lru_clock += 1
+        return self.__lru_clock
+
+    def __touch(self, value):
+        # Records an access for the eviction policy
+        if self.maxmemory_policy.endswith('lfu'):
+            value.access = lfu_increment(value.access, int(time.time() // 60) & 0xFFFF)
+        else:
+            self.__lru_clock += 1
+            value.access = self.__lru_clock
+
+    def __set_timeout(self, key, timeout):
+        value = self.data[key]
+        if value.timeout:
+            self.__volatile -= 1
+        value.timeout = timeout
+        if timeout:
+            self.__index_timeout(key, timeout)
+        self.__touched(key)
+
+    def __index_timeout(self, key, timeout):
+        self.__volatile += 1
+        heapq.heappush(self.__expires, (timeout, key))
+        if len(self.__expires) > 2 * self.__volatile + 1024:
+            data = self.data
+            self.__expires = [(t, k) for t, k in self.__expires if k in data and data[k].timeout == t]
+            heapq.heapify(self.__expires)
+
+    def load_data(self, data):
+        # Replaces the whole dataset, eg. with a freshly loaded snapshot, and rebuilds the indexes over it
+        for watchers in self.__watchers.values():
+            for watcher in watchers:
+                watcher.dirty = True
+        self.__watchers = {}
+        if self.__tracked:
+            self.invalidation_feed(self, None, set().union(*self.__tracked.values()))
+            self.__tracked = {}
+        if self.lazyfree and len(self.data) > self.lazyfree_threshold:
+            self.__lazyfree.append(self.data)
+        self.data = data
+        self.__keys = list(data)
+        self.__expires = []
+        self.used_memory = 0
+        for slot, key in enumerate(self.__keys):
+            value = data[key]
+            value.slot = slot
+            if self.compression is not None and type(value.val) == str:
+                value.val = self.__compress(value.val)
+            value.access = self.__new_access()
+            self.used_memory += self.__sizeof(key, value)
+            if value.timeout:
+                self.__expires.append((value.timeout, key))
+        heapq.heapify(self.__expires)
+        self.__volatile = len(self.__expires)
+        if self.bloom_error_rate:
+            self.__build_bloom(2 * len(data))
+
+    def __build_bloom(self, capacity):
+        # Replaces the Bloom filter with one for capacity keys holding the current ones, counters carried over
+        bloom = BloomFilter(max(BLOOM_MIN_CAPACITY, capacity), self.bloom_error_rate)
+        if self.__bloom is not None:
+            bloom.negatives = self.__bloom.negatives
+            bloom.false_positives = self.__bloom.false_positives
+        for key in self.__keys:
+            bloom.add(key)
+        self.__bloom = bloom
+
+    def __compress(self, val):
+        # The form a string is stored in, a CompressedString when compression applies and pays off
+        if len(val) < self.compression_min_size:
+            return val
+        start = time.perf_counter_ns()
+        compressed = CompressedString.compress(self.compression, val)
+        stats = self.compression_stats
+        stats['compress_ns'] += time.perf_counter_ns() - start
+        stats['compress_calls'] += 1
+        stats['raw_bytes'] += len(val)
+        stats['compressed_bytes'] += len(compressed.payload)
+        return compressed if len(compressed.payload) < len(val) else val
+
+    def __read(self, val):
+        # A stored value as returned to clients
+        if type(val) != CompressedString:
+            return val
+        start = time.perf_counter_ns()
+        text = val.decompress()
+        self.compression_stats['decompress_ns'] += time.perf_counter_ns() - start
+        self.compression_stats['decompress_calls'] += 1
+        return text
 
     def __check_life(self, key):
         val_obj = self.data[key]
         if val_obj.timeout and time.time() > val_obj.timeout:
-            self.logger.info(f'DEL {key}')
-            del self.data[key]
+            self.__log('DEL', key)
+            self.__drop(key)
+            self.expired_keys += 1
             return False
         else:
             return True
 
     def __check_active(self, key):
+        bloom = self.__bloom
+        if bloom is not None:
+            if not bloom.check(key):
+                return False
+            if key not in self.data:
+                bloom.false_positives += 1
+                return False
         if key in self.data and self.__check_life(key):
+            self.__touch(self.data[key])
             return True
         else:
             return False
 
+    def __eviction_sample(self):
+        # Up to maxmemory_samples live keys picked at random from the keys the policy may evict
+        samples = self.maxmemory_samples
+        if self.maxmemory_policy.startswith('allkeys'):
+            keys = self.__keys
+            return [keys[random.randrange(len(keys))] for _ in range(samples)] if keys else []
+        if not self.__volatile:
+            return []
+        # Volatile keys are drawn from the TTL heap, where entries of deleted keys or changed timeouts are skipped
+        data, expires = self.data, self.__expires
+        sample = []
+        for _ in range(4 * samples):
+            timeout, key = expires[random.randrange(len(expires))]
+            if key in data and data[key].timeout == timeout:
+                sample.append(key)
+                if len(sample) == samples:
+                    break
+        if not sample:
+            self.__expires = [(t, k) for t, k in expires if k in data and data[k].timeout == t]
+            heapq.heapify(self.__expires)
+            sample = [k for _, k in self.__expires[:samples]]
+        return sample
+
+    def __free_memory(self):
+        # Evicts keys by maxmemory_policy until the estimated size is under maxmemory, the evicted keys share a single
+        # DEL record. Returns an OOM error when that is not possible, None otherwise.
+        if not self.maxmemory or self.used_memory <= self.maxmemory:
+            return None
+        policy = self.maxmemory_policy
+        evicted = []
+        if policy != 'noeviction':
+            minutes = int(time.time() // 60) & 0xFFFF
+            while self.used_memory > self.maxmemory:
+                sample = self.__eviction_sample()
+                if not sample:
+                    break
+                if policy.endswith('random'):
+                    key = sample[0]
+                elif policy.endswith('ttl'):
+                    key = min(sample, key=lambda k: self.data[k].timeout)
+                elif policy.endswith('lfu'):
+                    key = min(sample, key=lambda k: lfu_decayed(self.data[k].access, minutes))
+                else:
+                    key = min(sample, key=lambda k: self.data[k].access)
+                self.__drop(key)
+                evicted.append(key)
+        if evicted:
+            self.__log('DEL', *evicted)
+            self.evicted_keys += len(evicted)
+        if self.used_memory > self.maxmemory:
+            return ErrorReply("OOM command not allowed when used memory > 'maxmemory'.")
+        return None
+
     def get(self, key):
 
         if self.__check_active(key):
-            return self.data[key].val
+            val = self.data[key].val
+            if type(val) == MySortedSet:
+                return ErrorReply('WRONGTYPE Operation against a key holding the wrong kind of value')
+            return self.__read(val)
         else:
-            return '(nil)'
+            return None
 
     def set(self, key, val, args):
 
+        oom = self.__free_memory()
+        if oom:
+            return oom
+
         active = self.__check_active(key)
 
         if args.NX and active:
-            return '(nil)'
+            return None
         elif args.XX and not active:
-            return '(nil)'
+            return None
 
         timeout = None
         if args.KEEPTTL and active:
@@ -81,15 +481,21 @@ class Database:
             elif args.PX:
                 timeout = time.time() + 0.001*args.PX
 
-        self.logger.info(f'SET {key} {val} {timeout}')
-        self.data[key] = Value(val, timeout)
-        return 'OK'
+        if self.compression is not None:
+            val = self.__compress(val)
+        record = ('SET', key, val) if type(val) == str else ('SETC', key, val.codec, val.payload)
+        if timeout is None:
+            self.__log(*record)
+        else:
+            self.__log(*record, repr(timeout))
+        self.__store(key, Value(val, timeout))
+        return OK
 
     def expire(self, key, age):
         if self.__check_active(key):
             timeout = time.time() + int(age)
-            self.logger.info(f'EXPIRE {key} {timeout}')
-            self.data[key].timeout = timeout
+            self.__log('EXPIREAT', key, repr(timeout))
+            self.__set_timeout(key, timeout)
             return 1
         else:
             return 0
@@ -100,47 +506,110 @@ class Database:
             if timeout:
                 return int(timeout - time.time())
             else:
-                return '-1'
+                return -1
         else:
-            return '-2'
+            return -2
 
     def delete(self, key):
-        try:
-            self.logger.info(f'DEL {key}')
-            del self.data[key]
-        except KeyError:
-            pass
+        if self.__drop(key) is not None:
+            self.__log('DEL', key)
+
+    def delete_many(self, keys, lazy=None):
+        # Batched DEL, a single log record for the whole batch. Returns the number of keys removed. lazy overrides
+        # lazyfree, UNLINK passes True.
+        removed = [key for key in keys if self.__check_active(key)]
+        for key in removed:
+            self.__drop(key, lazy)
+        if removed:
+            self.__log('DEL', *removed)
+        return len(removed)
+
+    def mget(self, keys):
+        return [self.__read(self.data[key].val) if self.__check_active(key) and type(self.data[key].val) != MySortedSet
+                else None for key in keys]
+
+    def mset(self, pairs):
+        # Batched SET without options, a single log record for the whole batch
+        oom = self.__free_memory()
+        if oom:
+            return oom
+        if self.compression is not None:
+            pairs = [(key, self.__compress(val)) for key, val in pairs]
+            if any(type(val) == CompressedString for _, val in pairs):
+                return self.__mset_compressed(pairs)
+        for key, val in pairs:
+            self.__store(key, Value(val))
+        self.__log('MSET', *[token for pair in pairs for token in pair])
+        return OK
+
+    def __mset_compressed(self, pairs):
+        # MSET with compressed values, logged as an MSET of the rest and a SETC each, one record together. Only the
+        # last value of a key given twice is logged, so the records can't reorder its writes.
+        for key, val in pairs:
+            self.__store(key, Value(val))
+        final = dict(pairs)
+        records = [('SETC', key, val.codec, val.payload) for key, val in final.items() if type(val) != str]
+        plain = [token for key, val in final.items() if type(val) == str for token in (key, val)]
+        if plain:
+            records.insert(0, ('MSET', *plain))
+        self.__log_together(records)
+        return OK
+
+    def msetnx(self, pairs):
+        # All or nothing, returns 1 if every key was set, 0 if any of them already existed
+        oom = self.__free_memory()
+        if oom:
+            return oom
+        if any(self.__check_active(key) for key, _ in pairs):
+            return 0
+        self.mset(pairs)
+        return 1
 
     def zadd(self, key, args):
 
+        oom = self.__free_memory()
+        if oom:
+            return oom
+
         active = self.__check_active(key)
 
         if active and type(self.data[key].val) != MySortedSet:
-            return f"ERR: Value at {key} is not a MySortedSet object."
+            return ErrorReply(f"ERR: Value at {key} is not a MySortedSet object.")
 
         if args.NX and active:
-            return '(nil)'
+            return None
         elif args.XX and not active:
-            return '(nil)'
+            return None
 
         if active:
+            size_before = self.__sizeof(key, self.data[key])
             if args.INCR:
+                zset = self.data[key].val
+                if any(math.isnan((zset.score(member) or 0.0) + increment) for increment, member in args.score_member):
+                    return ErrorReply('ERR resulting score is not a number (NaN)')
                 ret_val = self.data[key].val.incr_update(args.score_member)
             else:
                 ret_val = self.data[key].val.update(args.score_member, args.CH)
+            self.used_memory += self.__sizeof(key, self.data[key]) - size_before
+            self.__touched(key)
         else:
-            self.data[key] = Value(MySortedSet())
-            ret_val = self.data[key].val.update(args.score_member)
+            zset = MySortedSet()
+            ret_val = zset.update(args.score_member)
+            self.__store(key, Value(zset))
 
+        # Logged as the resulting absolute scores, so replaying an INCR can't apply the increment twice
+        zset = self.data[key].val
+        self.__log('ZADD', key, *[token for _, member in args.score_member
+                                  for token in (repr(zset.score(member)), member)])
         return ret_val
 
     def zrank(self, key, member):
         active = self.__check_active(key)
 
         if not active:
-            return '(nil)'
+            return None
         if active and type(self.data[key].val) != MySortedSet:
-            return f"ERR: Value at {key} is not a MySortedSet object."
+            return ErrorReply(f"ERR: Value at {key} is not a MySortedSet object.")
 
         return self.data[key].val.rank(member)
 
@@ -149,20 +618,522 @@ class Database:
         if not active:
             return []
         if active and type(self.data[key].val) != MySortedSet:
-            return f"ERR: Value at {key} is not a MySortedSet object."
+            return ErrorReply(f"ERR: Value at {key} is not a MySortedSet object.")
 
         return self.data[key].val.range(args.start, args.stop, args.WITHSCORES)
 
+    @staticmethod
+    def __type_name(value):
+        return 'zset' if type(value.val) == MySortedSet else 'string'
+
+    def scan(self, cursor, pattern=None, count=10, type_name=None):
+        """
+        One SCAN step, returns the next cursor (0 once the walk is complete) and the live keys found matching the glob
+        pattern and type. Examines at most count slots of the key list, walking from the top slot down: a deletion
+        moves the last key, which was already visited, into the freed slot, so keys present for the whole walk are
+        returned at least once. Nothing is kept between calls.
+        """
+        if count < 1:
+            return ErrorReply('ERR syntax error')
+        keys = self.__keys
+        position = min(cursor, len(keys)) if cursor > 0 else len(keys)
+        stop = max(0, position - count)
+        match = re.compile(fnmatch.translate(pattern)).match if pattern is not None else None
+        now = time.time()
+        found = []
+        for slot in range(position - 1, stop - 1, -1):
+            key = keys[slot]
+            value = self.data[key]
+            if value.timeout and now > value.timeout:
+                continue
+            if match is not None and not match(key):
+                continue
+            if type_name is not None and self.__type_name(value) != type_name:
+                continue
+            found.append(key)
+        return [str(stop), found]
+
+    def zscan(self, key, cursor, pattern=None, count=10):
+        # One ZSCAN step. The cursor is '0' to start, else the last (score, member) returned, as the score's 8 bytes in
+        # hex (never mistaken for an option), ':' and the member, so the walk resumes by bisection. Small listpack
+        # encoded sets come back whole, as in Redis.
+        if count < 1:
+            return ErrorReply('ERR syntax error')
+        zset = self.__lookup_zset(key)
+        if zset is None or type(zset) == ErrorReply:
+            return ['0', []] if zset is None else zset
+        after = None
+        if cursor != '0':
+            try:
+                if cursor[16:17] != ':':
+                    raise ValueError(cursor)
+                after = (_double.unpack(bytes.fromhex(cursor[:16]))[0], cursor[17:])
+            except ValueError:
+                return ErrorReply('ERR invalid cursor')
+        pairs, resume = zset.scan(after, len(zset) if zset.encoding == 'listpack' else count)
+        if pattern is not None:
+            match = re.compile(fnmatch.translate(pattern)).match
+            pairs = [pair for pair in pairs if match(pair[0])]
+        return ['0' if resume is None else f'{_double.pack(resume[0]).hex()}:{resume[1]}', pairs]
+
+    def __lookup_zset(self, key):
+        # The sorted set at key, None if there is none, an ErrorReply if key holds something else
+        if not self.__check_active(key):
+            return None
+        if type(self.data[key].val) != MySortedSet:
+            return ErrorReply(f"ERR: Value at {key} is not a MySortedSet object.")
+        return self.data[key].val
+
+    @staticmethod
+    def __limit(start, end, limit, reverse):
+        # Narrows the index range [start, end) to LIMIT offset count, counted from the end when reverse
+        if limit is None:
+            return start, end
+        offset, count = limit
+        if offset < 0:
+            return start, start
+        if reverse:
+            end = max(start, end - offset)
+            return (start if count < 0 else max(start, end - count)), end
+        start = min(end, start + offset)
+        return start, (end if count < 0 else min(end, start + count))
+
+    def __removed_from_zset(self, key, size_before, removed):
+        # Bookkeeping after members left the sorted set at key: a single ZREM record, memory, and the key itself
+        # goes once the set is empty
+        if not removed:
+            return
+        self.__log('ZREM', key, *removed)
+        if len(self.data[key].val):
+            self.used_memory += self.__sizeof(key, self.data[key]) - size_before
+            self.__touched(key)
+        else:
+            self.__drop(key)
+
+    def zrevrank(self, key, member):
+        zset = self.__lookup_zset(key)
+        if zset is None or type(zset) == ErrorReply:
+            return zset
+        rank = zset.rank(member)
+        return None if rank is None else len(zset) - 1 - rank
+
+    def zscore(self, key, member):
+        zset = self.__lookup_zset(key)
+        if zset is None or type(zset) == ErrorReply:
+            return zset
+        score = zset.score(member)
+        return score
+
+    def zrevrange(self, key, args):
+        # Same exclusive stop as ZRANGE, counted from the highest score
+        zset = self.__lookup_zset(key)
+        if zset is None or type(zset) == ErrorReply:
+            return [] if zset is None else zset
+        start, stop, _ = slice(args.start, args.stop).indices(len(zset))
+        return zset.span(len(zset) - stop, len(zset) - start, args.WITHSCORES, reverse=True) if start < stop else []
+
+    def zrangebyscore(self, key, args, reverse=False):
+        zset = self.__lookup_zset(key)
+        if zset is None or type(zset) == ErrorReply:
+            return [] if zset is None else zset
+        start, end = self.__limit(*zset.score_span(args.min, args.max), args.LIMIT, reverse)
+        return zset.span(start, end, args.WITHSCORES, reverse)
+
+    def zcount(self, key, args):
+        zset = self.__lookup_zset(key)
+        if zset is None or type(zset) == ErrorReply:
+            return 0 if zset is None else zset
+        start, end = zset.score_span(args.min, args.max)
+        return end - start
+
+    def zrangebylex(self, key, args):
+        zset = self.__lookup_zset(key)
+        if zset is None or type(zset) == ErrorReply:
+            return [] if zset is None else zset
+        start, end = self.__limit(*zset.lex_span(args.min, args.max), args.LIMIT, False)
+        return zset.span(start, end, False)
+
+    def zlexcount(self, key, args):
+        zset = self.__lookup_zset(key)
+        if zset is None or type(zset) == ErrorReply:
+            return 0 if zset is None else zset
+        start, end = zset.lex_span(args.min, args.max)
+        return end - start
+
+    def zrem(self, key, members):
+        zset = self.__lookup_zset(key)
+        if zset is None or type(zset) == ErrorReply:
+            return 0 if zset is None else zset
+        size_before = self.__sizeof(key, self.data[key])
+        present = [member for member in dict.fromkeys(members) if zset.score(member) is not None]
+        zset.remove(present)
+        self.__removed_from_zset(key, size_before, present)
+        return len(present)
+
+    def zremrangebyscore(self, key, args):
+        zset = self.__lookup_zset(key)
+        if zset is None or type(zset) == ErrorReply:
+            return 0 if zset is None else zset
+        size_before = self.__sizeof(key, self.data[key])
+        removed = zset.remove_span(*zset.score_span(args.min, args.max))
+        self.__removed_from_zset(key, size_before, removed)
+        return len(removed)
+
+    def zremrangebyrank(self, key, args):
+        # Same exclusive stop as ZRANGE
+        zset = self.__lookup_zset(key)
+        if zset is None or type(zset) == ErrorReply:
+            return 0 if zset is None else zset
+        size_before = self.__sizeof(key, self.data[key])
+        start, stop, _ = slice(args.start, args.stop).indices(len(zset))
+        removed = zset.remove_span(start, stop) if start < stop else []
+        self.__removed_from_zset(key, size_before, removed)
+        return len(removed)
+
     def backup_logs(self):
-        # Useful during snapshot serialization, backs up existing log file to name.log.bkp,
-        # Reloads the Filehandler to restart logging from scratch in new file
-        if self.file_handler:
-            self.file_handler.close()
-            self.logger.removeHandler(self.file_handler)
-            shutil.copyfile(self.log_path, self.log_path+'.bkp')
-            os.remove(self.log_path)
-
-            self.file_handler = logging.FileHandler(self.log_path)
-            log_format = logging.Formatter('%(asctime)s %(name)s %(message)s')
-            self.file_handler.setFormatter(log_format)
-            self.logger.addHandler(self.file_handler)
+        # Useful during snapshot serialization, moves the existing log file to name.log.bkp and restarts logging
+        # from scratch in a new file
+        if self.aof is not None:
+            self.aof.rotate(self.log_path + '.bkp')
+
+    def apply_record(self, record):
+        # Applies one log record straight onto the data, no command parsing and no re-logging
+        op = record[0]
+        if op == 'SET':
+            val = record[2] if self.compression is None else self.__compress(record[2])
+            self.__store(record[1], Value(val, float(record[3]) if len(record) > 3 else None))
+        elif op == 'SETC':
+            # The payload is bytes as logged, or a str once read back from a log or the replication stream
+            payload = record[3] if type(record[3]) == bytes else record[3].encode(ENCODING, ERRORS)
+            self.__store(record[1], Value(CompressedString(record[2], payload),
+                                          float(record[4]) if len(record) > 4 else None))
+        elif op == 'MSET':
+            for i in range(1, len(record) - 1, 2):
+                self.__store(record[i], Value(record[i+1] if self.compression is None else
+                                              self.__compress(record[i+1])))
+        elif op == 'FLUSHALL':
+            self.load_data({})
+        elif op == 'DEL':
+            for key in record[1:]:
+                self.__drop(key)
+        elif op == 'EXPIREAT':
+            if record[1] in self.data:
+                self.__set_timeout(record[1], float(record[2]))
+        elif op == 'ZADD':
+            if record[1] not in self.data or type(self.data[record[1]].val) != MySortedSet:
+                self.__store(record[1], Value(MySortedSet()))
+            size_before = self.__sizeof(record[1], self.data[record[1]])
+            self.data[record[1]].val.update([(float(record[i]), record[i+1]) for i in range(2, len(record) - 1, 2)])
+            self.used_memory += self.__sizeof(record[1], self.data[record[1]]) - size_before
+        elif op == 'ZREM':
+            if record[1] in self.data and type(self.data[record[1]].val) == MySortedSet:
+                size_before = self.__sizeof(record[1], self.data[record[1]])
+                self.data[record[1]].val.remove(record[2:])
+                if len(self.data[record[1]].val):
+                    self.used_memory += self.__sizeof(record[1], self.data[record[1]]) - size_before
+                else:
+                    self.__drop(record[1])
+
+    def replicate(self, record):
+        # Applies a record streamed from a primary, and logs it as is to this database's own log and replicas
+        for applied in unbatch_records([record]):
+            self.apply_record(applied)
+        self.__log(*record)
+
+    def replay_logs(self, paths):
+        # Rebuilds state from the logs at paths, in order, on top of whatever is currently loaded. Superseded writes
+        # are collapsed away before anything is applied. Returns the number of records read and applied.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            records = list(unbatch_records(record for path in paths for record in read_records(path)))
+            collapsed = collapse_records(records)
+            for record in collapsed:
+                self.apply_record(record)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return len(records), len(collapsed)
+
+    def rewrite_records(self):
+        # Shortest record sequence that rebuilds the current data from nothing, expired keys are left out
+        yield 'FLUSHALL',
+        now = time.time()
+        for key, value in self.data.items():
+            if value.timeout and now > value.timeout:
+                continue
+            if type(value.val) == MySortedSet:
+                items = value.val.items()
+                for i in range(0, len(items), 64):
+                    yield ('ZADD', key, *[token for member, score in items[i:i+64] for token in (repr(score), member)])
+                if value.timeout:
+                    yield 'EXPIREAT', key, repr(value.timeout)
+            elif type(value.val) == CompressedString:
+                record = ('SETC', key, value.val.codec, value.val.payload)
+                yield (*record, repr(value.timeout)) if value.timeout else record
+            elif value.timeout:
+                yield 'SET', key, value.val, repr(value.timeout)
+            else:
+                yield 'SET', key, value.val
+
+    def bgrewriteaof(self):
+        # Rewrites the log from current state in a forked child, the copy-on-write fork is the consistent snapshot.
+        # Writes arriving meanwhile keep going to the old log and are also buffered, see AppendOnlyFile.finish_rewrite
+        if self.aof is None:
+            return ErrorReply('ERR append only file is disabled')
+        if self.aof.rewrite_in_progress:
+            return ErrorReply('ERR Background append only file rewriting already in progress')
+
+        rewrite_path = self.log_path + '.rewrite'
+        if not hasattr(os, 'fork'):
+            self.aof.start_rewrite()
+            write_records(rewrite_path, self.rewrite_records())
+            self.aof.finish_rewrite(rewrite_path)
+            return 'Append only file rewritten'
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                write_records(rewrite_path, self.rewrite_records())
+                os._exit(0)
+            except BaseException:
+                os._exit(1)
+        self.__rewrite_child = pid
+        self.aof.start_rewrite()
+        return 'Background append only file rewriting started'
+
+    def bgsave(self):
+        # Snapshots the data from a forked child, copy-on-write keeps the parent serving without copying the dataset.
+        # The log is rotated at the fork, so name.log.bkp holds exactly the writes the snapshot covers until it lands
+        if self.__save_child is not None:
+            return ErrorReply('ERR Background save already in progress')
+
+        self.backup_logs()
+        start = time.time()
+        self.last_save = start
+        if not hasattr(os, 'fork'):
+            rdb.dump(self.data, self.dump_path)
+            self.__finish_save(True, time.time() - start, None)
+            return 'Background saving finished'
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                rdb.dump(self.data, self.dump_path)
+                os._exit(0)
+            except BaseException:
+                os._exit(1)
+        self.__save_child = pid
+        self.__save_started = start
+        self.save_stats['last_fork_time'] = time.time() - start
+        return 'Background saving started'
+
+    def __finish_save(self, success, duration, peak_rss_kb):
+        self.save_stats['last_bgsave_status'] = 'ok' if success else 'err'
+        self.save_stats['last_save_duration'] = duration
+        self.save_stats['last_save_peak_rss_kb'] = peak_rss_kb
+        backup_path = self.log_path + '.bkp'
+        if success and os.path.exists(backup_path):
+            os.remove(backup_path)
+        elif not success:
+            print(f'Error: background save of {self.dump_path} failed, keeping {backup_path}')
+
+    def __check_save(self):
+        pid, status, usage = os.wait4(self.__save_child, os.WNOHANG)
+        if pid == 0:
+            return
+        self.__save_child = None
+        success = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+        self.__finish_save(success, time.time() - self.__save_started, usage.ru_maxrss)
+
+    def sync_snapshot(self):
+        # Snapshot for a replica's full resync, written by a forked child as in bgsave, so the data is never serialized
+        # on the request path. Replicas asking while nothing was written share one. Returns its id and the replication
+        # offset it holds, its contents are read with sync_chunk.
+        for snapshot_id, snapshot in self.__sync_snapshots.items():
+            if snapshot[1] == self.replication_offset:
+                return snapshot_id, snapshot[1]
+        snapshot_id = next(self.__sync_ids)
+        path = f'{self.dump_path}.sync-{snapshot_id}'
+        pid = None
+        if hasattr(os, 'fork'):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    rdb.dump(self.data, path)
+                    os._exit(0)
+                except BaseException:
+                    os._exit(1)
+        else:
+            rdb.dump(self.data, path)
+        self.__sync_snapshots[snapshot_id] = [pid, self.replication_offset, path, time.time()]
+        return snapshot_id, self.replication_offset
+
+    def sync_chunk(self, snapshot_id, position):
+        # Up to SYNC_CHUNK_SIZE bytes of a replica snapshot from position on, empty past its end, nil while the child
+        # is still writing it
+        snapshot = self.__sync_snapshots.get(snapshot_id)
+        if snapshot is None:
+            return ErrorReply(f'ERR no sync snapshot {snapshot_id}, it failed or expired')
+        if snapshot[0] is not None:
+            return None
+        with open(snapshot[2], 'rb') as f:
+            f.seek(position)
+            return f.read(SYNC_CHUNK_SIZE)
+
+    def __check_sync_snapshots(self):
+        # Reaps the children writing replica snapshots and deletes the snapshots past sync_snapshot_ttl
+        now = time.time()
+        for snapshot_id, snapshot in list(self.__sync_snapshots.items()):
+            pid, _, path, started = snapshot
+            if pid is not None:
+                reaped, status = os.waitpid(pid, os.WNOHANG)
+                if reaped == 0:
+                    continue
+                snapshot[0] = None
+                if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                    continue
+                print(f'Error: replica snapshot {path} failed')
+            elif now - started < self.sync_snapshot_ttl:
+                continue
+            del self.__sync_snapshots[snapshot_id]
+            if os.path.exists(path):
+                os.remove(path)
+
+    @property
+    def save_in_progress(self):
+        return self.__save_child is not None
+
+    def __check_rewrite(self):
+        pid, status = os.waitpid(self.__rewrite_child, os.WNOHANG)
+        if pid == 0:
+            return
+        self.__rewrite_child = None
+        rewrite_path = self.log_path + '.rewrite'
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            self.aof.finish_rewrite(rewrite_path)
+        else:
+            self.aof.abort_rewrite()
+            if os.path.exists(rewrite_path):
+                os.remove(rewrite_path)
+            print(f'Error: background rewrite of {self.log_path} failed')
+
+    def active_expire_cycle(self):
+        # Deletes keys that are due off the top of the TTL index, until none are left or the time budget is spent.
+        # All keys removed in one cycle share a single DEL record.
+        expires = self.__expires
+        now = time.time()
+        if not expires or expires[0][0] > now:
+            return 0
+
+        deadline = time.perf_counter() + self.active_expire_budget
+        expired = []
+        popped = 0
+        while expires and expires[0][0] <= now:
+            timeout, key = heapq.heappop(expires)
+            value = self.data.get(key)
+            if value is not None and value.timeout == timeout:
+                self.__drop(key)
+                expired.append(key)
+            popped += 1
+            if popped % 32 == 0 and time.perf_counter() > deadline:
+                break
+
+        if expired:
+            self.__log('DEL', *expired)
+            self.expired_keys += len(expired)
+        return len(expired)
+
+    def lazyfree_cycle(self):
+        # Releases queued values a step at a time, until none are left or the time budget is spent. Returns the number
+        # of values fully released.
+        queue = self.__lazyfree
+        if not queue:
+            return 0
+        deadline = time.perf_counter() + self.lazyfree_budget
+        freed = 0
+        while queue and time.perf_counter() < deadline:
+            item = queue[0]
+            if type(item) == dict:
+                # A whole dataset, its big sorted sets join the queue rather than being freed along with their key
+                for _ in range(min(LAZYFREE_STEP, len(item))):
+                    self.__release(item.popitem()[1], True)
+                done = not item
+            else:
+                done = item.free_step(LAZYFREE_STEP)
+            if done:
+                queue.popleft()
+                freed += 1
+        self.lazyfreed_objects += freed
+        return freed
+
+    @property
+    def lazyfree_pending_objects(self):
+        return len(self.__lazyfree)
+
+    def __update_expire_rate(self):
+        # Closes the expire rate window once it is EXPIRE_RATE_WINDOW long, called from cron
+        now = time.time()
+        since, expired_then = self.__expire_window
+        if now - since >= EXPIRE_RATE_WINDOW:
+            self.expired_keys_per_sec = (self.expired_keys - expired_then) / (now - since)
+            self.__expire_window = (now, self.expired_keys)
+
+    def expiry_stats(self):
+        return {'expired_keys': self.expired_keys, 'expired_keys_per_sec': self.expired_keys_per_sec,
+                'keys_pending_expiry': self.__volatile}
+
+    def keyspace_stats(self):
+        stats = {'keys': len(self.data), 'expires': self.__volatile, 'expired': self.expired_keys,
+                 'expired_keys_per_sec': round(self.expired_keys_per_sec, 2),
+                 'evicted': self.evicted_keys, 'used_memory': self.used_memory}
+        bloom = self.__bloom
+        if bloom is not None:
+            # Observed false positive rate: absent keys let through over all lookups of absent keys
+            absent = bloom.negatives + bloom.false_positives
+            stats.update({'bloom_bytes': bloom.size, 'bloom_capacity': bloom.capacity,
+                          'bloom_expected_fpr': round(bloom.expected_error_rate(), 6),
+                          'bloom_negatives': bloom.negatives, 'bloom_false_positives': bloom.false_positives,
+                          'bloom_observed_fpr': round(bloom.false_positives / absent, 6) if absent else 0.0})
+        if self.compression is not None:
+            compression = self.compression_stats
+            stats.update({'compression': self.compression, 'compress_calls': compression['compress_calls'],
+                          'compression_ratio': round(compression['raw_bytes'] / compression['compressed_bytes'], 2)
+                          if compression['compressed_bytes'] else 0.0,
+                          'compress_usec': compression['compress_ns'] // 1000,
+                          'decompress_calls': compression['decompress_calls'],
+                          'decompress_usec': compression['decompress_ns'] // 1000})
+        return stats
+
+    def persistence_stats(self):
+        # Outcome of the last snapshot and the state of the log, for INFO persistence
+        stats = {'rdb_bgsave_in_progress': int(self.save_in_progress), 'rdb_last_save_time': int(self.last_save),
+                 'rdb_last_bgsave_status': self.save_stats['last_bgsave_status'] or 'none',
+                 'rdb_last_save_duration_sec': self.save_stats['last_save_duration'],
+                 'rdb_last_fork_usec': None if self.save_stats['last_fork_time'] is None else
+                 int(self.save_stats['last_fork_time'] * 1000000),
+                 'rdb_last_save_peak_rss_kb': self.save_stats['last_save_peak_rss_kb'],
+                 'aof_enabled': int(self.aof is not None)}
+        if self.aof is not None:
+            stats.update({'aof_rewrite_in_progress': int(self.aof.rewrite_in_progress),
+                          'aof_current_size': self.aof.size, 'aof_base_size': self.aof.base_size})
+        return stats
+
+    def cron(self):
+        # Periodic housekeeping, run between commands
+        self.active_expire_cycle()
+        self.__update_expire_rate()
+        self.lazyfree_cycle()
+        if self.__sync_snapshots:
+            self.__check_sync_snapshots()
+        if self.__save_child is not None:
+            self.__check_save()
+        elif self.save_interval and time.time() - self.last_save >= self.save_interval:
+            self.bgsave()
+        if self.aof is None:
+            return
+        if self.__rewrite_child is not None:
+            self.__check_rewrite()
+        elif self.auto_rewrite_percentage and self.aof.size >= self.auto_rewrite_min_size and \
+                self.aof.size >= self.aof.base_size * (1 + self.auto_rewrite_percentage / 100.0):
+            self.bgrewriteaof()
@@ -1,76 +1,365 @@
-from sortedcontainers import SortedSet
+import lzma
+import math
+import sys
+import zlib
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from itertools import islice
+from sortedcontainers import SortedList
+from .protocol import ENCODING, ERRORS
+
+# Codecs string values can be compressed with, name -> (compress, decompress) over bytes
+CODECS = {'zlib': (zlib.compress, zlib.decompress), 'lzma': (lzma.compress, lzma.decompress)}
 
 
 class MySortedSet:
-    """Custom class to abstract redis sorted sets"""
+    """
+    Custom class to abstract redis sorted sets
+    Members are ordered by score, then by member, as (score, member) tuples that compare natively, no key function.
+    Small sets keep them in a single sorted list, like Redis' listpack encoding, and are converted to a SortedList plus
+    a member -> score dict once they grow past max_listpack_entries members.
+    """
+    __slots__ = ('members', 'scoremap', 'listpack')
+    max_listpack_entries = 128
+
     def __init__(self):
-        self.members = SortedSet(key=self.sortedset_key)
-        self.scoremap = {}
+        self.members = None
+        self.scoremap = None
+        self.listpack = []
+
+    @property
+    def encoding(self):
+        return 'listpack' if self.listpack is not None else 'skiplist'
+
+    def __len__(self):
+        return len(self.listpack) if self.listpack is not None else len(self.scoremap)
+
+    def __convert(self):
+        self.scoremap = {member: score for score, member in self.listpack}
+        self.members = SortedList(self.listpack)
+        self.listpack = None
+
+    def __listpack_index(self, member):
+        for index, entry in enumerate(self.listpack):
+            if entry[1] == member:
+                return index
+        return -1
 
-    def sortedset_key(self, x):
-        return self.scoremap[x]
+    def score(self, member):
+        # Score of member, None if it is not in the set
+        if self.listpack is None:
+            return self.scoremap.get(member)
+        index = self.__listpack_index(member)
+        return self.listpack[index][0] if index >= 0 else None
+
+    def items(self):
+        # (member, score) pairs in set order
+        entries = self.listpack if self.listpack is not None else self.members
+        return [(member, score) for score, member in entries]
 
     def update(self, iterable, ch_flag=False):
-        # Emulates set update
-        scores, members = zip(*iterable)
-        exist_count = 0
-        for ikey, key in enumerate(members):
-            if key in self.scoremap:
-                if ch_flag:
-                    if self.scoremap[key] == scores[ikey]:
-                        exist_count += 1
+        # Emulates set update, returns the number of members added, plus the number changed with ch_flag.
+        # A single pass over the batch, members given twice take their last score, unchanged scores are skipped.
+        batch = {member: score for score, member in iterable}
+        if self.listpack is not None and len(self.listpack) + len(batch) > self.max_listpack_entries:
+            self.__convert()
+        added = changed = 0
+        if self.listpack is not None:
+            listpack = self.listpack
+            for member, score in batch.items():
+                index = self.__listpack_index(member)
+                if index >= 0:
+                    if listpack[index][0] == score:
+                        continue
+                    del listpack[index]
+                    changed += 1
                 else:
-                    exist_count += 1
-            self.scoremap[key] = scores[ikey]
+                    added += 1
+                insort(listpack, (score, member))
+            return added + changed if ch_flag else added
 
-        for member in members:
-            try:
-                self.members.remove(member)
-            except KeyError:
-                continue
-            except ValueError:
+        scoremap = self.scoremap
+        stale = []
+        fresh = []
+        for member, score in batch.items():
+            old = scoremap.get(member)
+            if old is None:
+                added += 1
+            elif old == score:
                 continue
-        self.members.update(members)
+            else:
+                stale.append((old, member))
+                changed += 1
+            scoremap[member] = score
+            fresh.append((score, member))
 
-        return len(members) - exist_count
+        if len(stale) * 4 > len(self.members):
+            # Rescoring a good part of the set, sorting it afresh beats removing and reinserting one by one
+            self.members = SortedList(zip(scoremap.values(), scoremap.keys()))
+        else:
+            for entry in stale:
+                self.members.remove(entry)
+            self.members.update(fresh)
+        return added + changed if ch_flag else added
 
     def incr_update(self, iterable):
-        # Increments the scores for already existing keys
-        scores, members = zip(*iterable)
-        for ikey, key in enumerate(members):
-            if key in self.scoremap:
-                self.scoremap[key] += scores[ikey]
-            else:
-                self.scoremap[key] = scores[ikey]
-        for member in members:
-            try:
-                self.members.remove(member)
-            except KeyError:
-                continue
-            except ValueError:
+        # ZINCRBY, adds the increments to the members' scores (new members start from 0), returns the last new score
+        for increment, member in iterable:
+            if self.listpack is not None:
+                score = self.score(member)
+                score = increment if score is None else score + increment
+                self.update([(score, member)])
                 continue
-        self.members.update(members)
-        return self.scoremap[members[-1]]
+            old = self.scoremap.get(member)
+            score = increment if old is None else old + increment
+            if old is not None:
+                if score == old:
+                    continue
+                self.members.remove((old, member))
+            self.scoremap[member] = score
+            self.members.add((score, member))
+        return score
 
     def rank(self, member):
-        try:
-            return self.members.index(member)
-        except KeyError:
-            return '(nil)'
+        if self.listpack is not None:
+            index = self.__listpack_index(member)
+            return index if index >= 0 else None
+        score = self.scoremap.get(member)
+        if score is None:
+            return None
+        return self.members.bisect_left((score, member))
 
-    def range(self, start, end, withscores):
-        range_members = self.members[start:end]
+    def remove(self, members):
+        # Removes the given members, returns the number that were in the set
+        removed = 0
+        for member in members:
+            if self.listpack is not None:
+                index = self.__listpack_index(member)
+                if index >= 0:
+                    del self.listpack[index]
+                    removed += 1
+            elif member in self.scoremap:
+                self.members.remove((self.scoremap.pop(member), member))
+                removed += 1
+        return removed
+
+    def __bisect_left(self, key):
+        if self.listpack is not None:
+            return bisect_left(self.listpack, key)
+        return self.members.bisect_left(key)
+
+    def __bisect_right(self, key):
+        if self.listpack is not None:
+            return bisect_right(self.listpack, key)
+        return self.members.bisect_right(key)
+
+    def score_span(self, min_bound, max_bound):
+        """
+        Index range [start, end) of the members with scores within the bounds, found by bisection.
+        Bounds are (score, exclusive) pairs. A key of (score,) sorts before every (score, member) entry.
+        """
+        low, exclusive = min_bound
+        if exclusive and low == math.inf:
+            start = len(self)
+        else:
+            start = self.__bisect_left((math.nextafter(low, math.inf) if exclusive else low,))
+        high, exclusive = max_bound
+        if exclusive:
+            end = self.__bisect_left((high,))
+        elif high == math.inf:
+            end = len(self)
+        else:
+            end = self.__bisect_left((math.nextafter(high, math.inf),))
+        return start, max(start, end)
+
+    def lex_span(self, min_bound, max_bound):
+        """
+        Index range [start, end) of the members within lexicographic bounds, for sets whose members all share one
+        score, as Redis' ZRANGEBYLEX. Bounds are (kind, member) pairs, kind one of '[', '(' or '-'/'+' for unbounded.
+        """
+        if not len(self):
+            return 0, 0
+        score = (self.listpack if self.listpack is not None else self.members)[0][0]
+        kind, member = min_bound
+        if kind == '-':
+            start = 0
+        elif kind == '+':
+            start = len(self)
+        elif kind == '[':
+            start = self.__bisect_left((score, member))
+        else:
+            start = self.__bisect_right((score, member))
+        kind, member = max_bound
+        if kind == '+':
+            end = len(self)
+        elif kind == '-':
+            end = 0
+        elif kind == '[':
+            end = self.__bisect_right((score, member))
+        else:
+            end = self.__bisect_left((score, member))
+        return start, max(start, end)
+
+    def span(self, start, end, withscores, reverse=False):
+        # Members at indexes [start, end), in reverse order if asked, with their scores if asked
+        entries = (self.listpack if self.listpack is not None else self.members)[start:end]
+        if reverse:
+            entries.reverse()
         if withscores:
-            range_scores = [self.scoremap[member] for member in range_members]
-            return list(zip(range_members, range_scores))
+            return [(member, score) for score, member in entries]
+        return [member for _, member in entries]
+
+    def remove_span(self, start, end):
+        # Removes the members at indexes [start, end), returns them
+        removed = self.span(start, end, False)
+        if self.listpack is not None:
+            del self.listpack[start:end]
+        else:
+            del self.members[start:end]
+            for member in removed:
+                del self.scoremap[member]
+        return removed
+
+    def scan(self, after, count):
+        """
+        Up to count (member, score) pairs following the entry after, a (score, member) pair or None to start from the
+        lowest score, and the entry to continue after, None once the end is reached. Resuming by value rather than by
+        index, members that stay in the set with the same score are returned exactly once however the set changes.
+        """
+        entries = self.listpack if self.listpack is not None else self.members
+        start = 0 if after is None else bisect_right(entries, after) if self.listpack is not None \
+            else entries.bisect_right(after)
+        chunk = entries[start:start + count]
+        resume = chunk[-1] if chunk and start + count < len(entries) else None
+        return [(member, score) for score, member in chunk], resume
+
+    def range(self, start, end, withscores):
+        return self.span(start, end, withscores)
+
+    def free_step(self, count):
+        """
+        Releases about count members of a set nobody references any more, True once it is empty. Lets a big set be
+        freed a bit at a time, see Database.lazyfree_cycle, where dropping it whole frees every member in one go.
+        The SortedList is taken apart by its sublists, SortedList._lists, about 15 times faster than popping members
+        through its API, which keeps its index up to date at every step. Should a sortedcontainers release drop that
+        internal, members are popped through the API instead.
+        """
+        if self.listpack is not None:
+            del self.listpack[-count:]
+            return not self.listpack
+        members = self.members
+        sublists = getattr(members, '_lists', None)
+        if type(sublists) == list:
+            popped = 0
+            while sublists and popped < count:
+                popped += len(sublists.pop())
+            remaining = sublists
         else:
-            return range_members
+            for _ in range(min(count, len(members))):
+                members.pop()
+            remaining = len(members)
+        scoremap = self.scoremap
+        deque(islice(iter(scoremap.popitem, None), min(count, len(scoremap))), maxlen=0)
+        if remaining or scoremap:
+            return False
+        members.clear()
+        return True
+
+
+class CompressedString:
+    """
+    A string value held compressed by codec, one of CODECS, see Database.compression. Reads decompress it on the fly,
+    the value itself stays compressed.
+    """
+    __slots__ = ('codec', 'payload')
+
+    def __init__(self, codec, payload):
+        self.codec = codec
+        self.payload = payload
+
+    @classmethod
+    def compress(cls, codec, value):
+        return cls(codec, CODECS[codec][0](value.encode(ENCODING, ERRORS)))
+
+    def decompress(self):
+        return CODECS[self.codec][1](self.payload).decode(ENCODING, ERRORS)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self.payload)
 
 
 class Value:
     # Holds the value objects and timeouts for Database values
     # timeout: time.time() + age
+    # access: eviction metadata, a logical LRU clock or a packed LFU counter, see Database.maxmemory_policy
+    # slot: position of the key in its Database's key list, for O(1) random sampling
+    __slots__ = ('val', 'timeout', 'access', 'slot')
+
     def __init__(self, value=None, timeout=None):
         self.val = value
         self.timeout = timeout
-        self.type = None
+        self.access = 0
+        self.slot = None
+
+
+class BloomFilter:
+    """
+    Counting Bloom filter over keys: check(key) False means key was never added, or removed since, True means it may
+    have been. Each key bumps `hashes` one byte counters picked by double hashing of hash(key), which str objects cache,
+    so the dict lookup that follows a True reuses it. Counters stop at 255 and are never decremented from there, so
+    remove keeps the filter exact save for those.
+    capacity: keys it is sized for, at error_rate false positives among absent keys. Holding more raises the rate.
+    """
+    __slots__ = ('counters', 'size', 'hashes', 'capacity', 'error_rate', 'count', 'negatives', 'false_positives')
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.counters = bytearray(self.size)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = 0
+        # Lookups answered as absent, and the ones let through for keys that turned out absent, see Database
+        self.negatives = 0
+        self.false_positives = 0
+
+    def add(self, key):
+        h = hash(key)
+        step = (h >> 32) | 1
+        counters, size = self.counters, self.size
+        for i in range(self.hashes):
+            index = (h + i * step) % size
+            if counters[index] < 255:
+                counters[index] += 1
+        self.count += 1
+
+    def remove(self, key):
+        # key must have been added
+        h = hash(key)
+        step = (h >> 32) | 1
+        counters, size = self.counters, self.size
+        for i in range(self.hashes):
+            index = (h + i * step) % size
+            if counters[index] < 255:
+                counters[index] -= 1
+        self.count -= 1
+
+    def check(self, key):
+        # Same counters as add, stepped to rather than recomputed. Half or more of absent keys stop at the first.
+        h = hash(key)
+        counters, size = self.counters, self.size
+        index = h % size
+        if counters[index]:
+            step = (h >> 32) | 1
+            for _ in range(self.hashes - 1):
+                index = (index + step) % size
+                if not counters[index]:
+                    break
+            else:
+                return True
+        self.negatives += 1
+        return False
+
+    def expected_error_rate(self):
+        # False positive rate at the current number of keys
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
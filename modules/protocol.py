@@ -0,0 +1,224 @@
+"""
+Length-prefixed wire protocol, modelled on RESP.
+
+Commands travel as arrays of bulk strings, replies are typed:
+    +OK\r\n                 status
+    -ERR message\r\n        error
+    :42\r\n                 integer
+    $-1\r\n                 nil, a None result
+    $5\r\nhello\r\n         bulk string
+    *2\r\n...               array of any of the above
+A single zmq frame may carry any number of commands back to back (a pipeline). The server answers with one frame
+holding the replies in the same order.
+"""
+
+CRLF = b'\r\n'
+ENCODING = 'utf-8'
+# surrogateescape lets arbitrary bytes survive the round trip through str
+ERRORS = 'surrogateescape'
+
+# How nil reads in plain text replies and the shells
+NIL = '(nil)'
+
+
+class ErrorReply(str):
+    """Marks a command result as an error, so it is sent with the error type rather than as a bulk string"""
+    pass
+
+
+class StatusReply(str):
+    """Marks a command result as a status, eg. OK, so it is sent with the status type rather than as a bulk string"""
+    pass
+
+
+OK = StatusReply('OK')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_bulk(value):
+    if not isinstance(value, bytes):
+        value = str(value).encode(ENCODING, ERRORS)
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def encode_command(tokens):
+    """Encodes one command (sequence of tokens) as an array of bulk strings"""
+    return b'*%d\r\n' % len(tokens) + b''.join(encode_bulk(token) for token in tokens)
+
+
+def encode_reply(value):
+    """Encodes a command result with its type, see the module docstring for the mapping"""
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, ErrorReply):
+        return b'-' + value.replace('\r\n', ' ').replace('\n', ' ').encode(ENCODING, ERRORS) + CRLF
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, (list, tuple)):
+        return b'*%d\r\n' % len(value) + b''.join(encode_reply(item) for item in value)
+    if isinstance(value, StatusReply):
+        return b'+' + value.encode(ENCODING, ERRORS) + CRLF
+    return encode_bulk(value)
+
+
+def encode_text(value):
+    """Plain text form of a command result, for clients that predate the framed protocol: str() of it, nil as (nil)"""
+    if value is None:
+        return NIL
+    if isinstance(value, (list, tuple)):
+        return str([NIL if item is None else item for item in value])
+    return str(value)
+
+
+def _read_line(data, pos):
+    end = data.find(CRLF, pos)
+    if end == -1:
+        raise ProtocolError('Truncated message')
+    return data[pos:end], end + 2
+
+
+def _read_bulk(data, pos):
+    header, pos = _read_line(data, pos)
+    if header[:1] != b'$':
+        raise ProtocolError(f'Expected bulk string, got {header[:1]!r}')
+    length = int(header[1:])
+    if length == -1:
+        return None, pos
+    end = pos + length
+    if data[end:end + 2] != CRLF:
+        raise ProtocolError('Bulk string length mismatch')
+    return data[pos:end].decode(ENCODING, ERRORS), end + 2
+
+
+def iter_commands(data):
+    """Yields (tokens, end offset) for each command in data, the offset is where the next command starts"""
+    # Hot path for both request frames and log replay. Splitting on CRLF in one go is done in C, every bulk line is
+    # then checked against its declared length (parsed headers are cached, there are only a handful of distinct ones).
+    # A token that itself contains CRLF fails that check, from that record on the exact reader takes over.
+    lines = data.split(CRLF)
+    last = len(lines) - 1
+    headers = {}
+    index = 0
+    pos = 0
+    try:
+        while index < last:
+            header = lines[index]
+            count = headers.get(header)
+            if count is None:
+                if header[:1] != b'*':
+                    break
+                count = headers[header] = int(header[1:])
+            stop = index + 1 + 2 * count
+            if stop > last:
+                break
+            tokens = []
+            end = pos + len(header) + 2
+            for bulk in range(index + 1, stop, 2):
+                head = lines[bulk]
+                token = lines[bulk + 1]
+                declared = headers.get(head)
+                if declared is None:
+                    if head[:1] != b'$':
+                        break
+                    declared = headers[head] = int(head[1:])
+                if declared != len(token):
+                    break
+                tokens.append(token.decode(ENCODING, ERRORS))
+                end += len(head) + declared + 4
+            else:
+                index = stop
+                pos = end
+                yield tokens, pos
+                continue
+            break
+    except ValueError:
+        pass
+    yield from _iter_commands_exact(data, pos)
+
+
+def _iter_commands_exact(data, pos):
+    find = data.find
+    size = len(data)
+    try:
+        while pos < size:
+            if data[pos] != 42:  # b'*'
+                raise ProtocolError(f'Expected command array, got {data[pos:pos + 1]!r}')
+            end = find(CRLF, pos)
+            if end == -1:
+                raise ProtocolError('Truncated message')
+            count = int(data[pos + 1:end])
+            pos = end + 2
+            tokens = []
+            for _ in range(count):
+                if data[pos] != 36:  # b'$'
+                    raise ProtocolError(f'Expected bulk string, got {data[pos:pos + 1]!r}')
+                end = find(CRLF, pos)
+                if end == -1:
+                    raise ProtocolError('Truncated message')
+                start = end + 2
+                stop = start + int(data[pos + 1:end])
+                if data[stop:stop + 2] != CRLF:
+                    raise ProtocolError('Truncated message')
+                tokens.append(data[start:stop].decode(ENCODING, ERRORS))
+                pos = stop + 2
+            yield tokens, pos
+    except IndexError:
+        raise ProtocolError('Truncated message')
+    except ValueError as e:
+        raise ProtocolError(f'Malformed length: {e}')
+
+
+def decode_commands(data):
+    """Splits a frame into the list of commands (token lists) it carries"""
+    return [tokens for tokens, _ in iter_commands(data)]
+
+
+def _read_reply(data, pos):
+    kind = data[pos:pos + 1]
+    if kind == b'$':
+        return _read_bulk(data, pos)
+    line, pos = _read_line(data, pos)
+    if kind == b'+':
+        return StatusReply(line[1:].decode(ENCODING, ERRORS)), pos
+    if kind == b'-':
+        return ErrorReply(line[1:].decode(ENCODING, ERRORS)), pos
+    if kind == b':':
+        return int(line[1:]), pos
+    if kind == b'*':
+        items = []
+        for _ in range(int(line[1:])):
+            item, pos = _read_reply(data, pos)
+            items.append(item)
+        return items, pos
+    raise ProtocolError(f'Unknown reply type {kind!r}')
+
+
+def decode_replies(data):
+    """Decodes a reply frame into the list of results it carries, errors come back as ErrorReply instances"""
+    replies = []
+    pos = 0
+    while pos < len(data):
+        reply, pos = _read_reply(data, pos)
+        replies.append(reply)
+    return replies
+
+
+def render(reply, indent=''):
+    """Human readable form of a decoded reply, used by the interactive shells"""
+    if reply is None:
+        return NIL
+    if isinstance(reply, ErrorReply):
+        return f'(error) {reply}'
+    if isinstance(reply, list):
+        if not reply:
+            return '(empty list)'
+        width = len(str(len(reply)))
+        lines = []
+        for index, item in enumerate(reply, 1):
+            prefix = f'{index:>{width}}) '
+            lines.append(indent + prefix + render(item, indent + ' ' * len(prefix)).lstrip())
+        return '\n'.join(lines)
+    return str(reply)
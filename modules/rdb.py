@@ -0,0 +1,286 @@
+"""
+Binary snapshot format for Database contents.
+
+    header      b'PYRDB' + 2 byte version
+    entries     [EXPIRETIME <double>] <type> <key> <payload>
+                    TYPE_STRING payload:            <string>
+                    TYPE_ZSET payload:              <length> then <member string><double score> per member
+                    TYPE_COMPRESSED_STRING payload: <codec string><length><compressed bytes>, see CompressedString
+    footer      EOF + CRC32 (4 bytes, little endian) of everything before it
+
+Strings are <length><utf-8 bytes>, lengths take 1 byte below 254, else a marker byte and 4 or 8 bytes.
+Version 2 added TYPE_COMPRESSED_STRING, version 1 snapshots load as they are.
+Entries are streamed out one by one through a small buffer, the dataset is never serialized into memory as a whole.
+"""
+import gc
+import io
+import mmap
+import os
+import struct
+import zlib
+import _pickle as pickle
+from .datastructures import Value, MySortedSet, CompressedString
+
+MAGIC = b'PYRDB'
+VERSION = 2
+
+TYPE_STRING = 0
+TYPE_ZSET = 1
+TYPE_COMPRESSED_STRING = 2
+OPCODE_EXPIRETIME = 0xFC
+OPCODE_EOF = 0xFF
+
+LEN_32BIT = 0xFE
+LEN_64BIT = 0xFF
+
+ENCODING = 'utf-8'
+ERRORS = 'surrogateescape'
+
+_double = struct.Struct('<d')
+_uint16 = struct.Struct('<H')
+_uint32 = struct.Struct('<I')
+_uint64 = struct.Struct('<Q')
+
+
+class RDBError(Exception):
+    pass
+
+
+class RDBWriter:
+    """Buffered writer keeping a running CRC32 of everything written"""
+    flush_size = 1 << 16
+
+    def __init__(self, f):
+        self.__file = f
+        self.__buffer = bytearray()
+        self.__crc = 0
+
+    def write(self, chunk):
+        self.__buffer += chunk
+        if len(self.__buffer) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        self.__crc = zlib.crc32(self.__buffer, self.__crc)
+        self.__file.write(self.__buffer)
+        self.__buffer = bytearray()
+
+    def write_length(self, length):
+        if length < LEN_32BIT:
+            self.write(bytes((length,)))
+        elif length < 1 << 32:
+            self.write(bytes((LEN_32BIT,)) + _uint32.pack(length))
+        else:
+            self.write(bytes((LEN_64BIT,)) + _uint64.pack(length))
+
+    def write_string(self, value):
+        encoded = value.encode(ENCODING, ERRORS)
+        self.write_length(len(encoded))
+        self.write(encoded)
+
+    def write_footer(self):
+        self.write(bytes((OPCODE_EOF,)))
+        self.flush()
+        self.__file.write(_uint32.pack(self.__crc))
+
+
+def _write(data, f):
+    writer = RDBWriter(f)
+    writer.write(MAGIC + _uint16.pack(VERSION))
+    for key, value in data.items():
+        if value.timeout:
+            writer.write(bytes((OPCODE_EXPIRETIME,)) + _double.pack(value.timeout))
+        if type(value.val) == MySortedSet:
+            writer.write(bytes((TYPE_ZSET,)))
+            writer.write_string(key)
+            writer.write_length(len(value.val))
+            for member, score in value.val.items():
+                writer.write_string(member)
+                writer.write(_double.pack(score))
+        elif type(value.val) == CompressedString:
+            writer.write(bytes((TYPE_COMPRESSED_STRING,)))
+            writer.write_string(key)
+            writer.write_string(value.val.codec)
+            writer.write_length(len(value.val.payload))
+            writer.write(value.val.payload)
+        else:
+            writer.write(bytes((TYPE_STRING,)))
+            writer.write_string(key)
+            writer.write_string(value.val)
+    writer.write_footer()
+
+
+def dump(data, path):
+    """
+    Streams data (key -> Value) into a snapshot at path. Written to a temporary file, fsync'ed and renamed over path,
+    so readers only ever see a complete snapshot.
+    """
+    tmp_path = path + '.new'
+    with open(tmp_path, 'wb') as f:
+        _write(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def dumps(data):
+    """Snapshot of data as bytes, in the same format as dump, eg. to send to a replica"""
+    f = io.BytesIO()
+    _write(data, f)
+    return f.getvalue()
+
+
+def _read_length(buffer, pos):
+    marker = buffer[pos]
+    if marker < LEN_32BIT:
+        return marker, pos + 1
+    if marker == LEN_32BIT:
+        return _uint32.unpack_from(buffer, pos + 1)[0], pos + 5
+    return _uint64.unpack_from(buffer, pos + 1)[0], pos + 9
+
+
+def load(path):
+    """
+    Reads the snapshot at path back into a key -> Value dict, snapshots pickled by older versions still load.
+    The file is memory-mapped and decoded in place, no intermediate copy of the whole file is made.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise RDBError(f'{path} is empty')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if buffer[:len(MAGIC)] != MAGIC:
+                return _load_pickled(buffer)
+            # Millions of fresh objects and no garbage, cyclic GC passes over them would only add pauses
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                return _decode(buffer, path)
+            finally:
+                if gc_enabled:
+                    gc.enable()
+
+
+class _PickledValue:
+    # Value as older versions pickled it, with a __dict__ and a since removed type field
+    pass
+
+
+class _PickledSortedSet:
+    # MySortedSet as older versions pickled it, a SortedSet of members keyed by this method and a scoremap dict. The
+    # scoremap holds all of it, the SortedSet is not rebuilt.
+    def sortedset_key(self, member):
+        return self.scoremap[member]
+
+
+def _skip(*args):
+    return None
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module == 'modules.datastructures' and name == 'Value':
+            return _PickledValue
+        if module == 'modules.datastructures' and name == 'MySortedSet':
+            return _PickledSortedSet
+        if module == 'sortedcontainers.sortedset' and name == 'SortedSet':
+            return _skip
+        return super().find_class(module, name)
+
+
+def _load_pickled(f):
+    # Snapshots older versions pickled, their Values and sorted sets rebuilt as the current classes
+    data = {}
+    for key, pickled in _LegacyUnpickler(f).load().items():
+        val = pickled.__dict__.get('val')
+        if isinstance(val, _PickledSortedSet):
+            zset = MySortedSet()
+            if val.scoremap:
+                zset.update([(float(score), member) for member, score in val.scoremap.items()])
+            val = zset
+        data[key] = Value(val, pickled.__dict__.get('timeout'))
+    return data
+
+
+def loads(buffer):
+    """Reads a snapshot made by dumps back into a key -> Value dict"""
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _decode(buffer, 'snapshot')
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _decode(buffer, path):
+    size = len(buffer)
+    if size < len(MAGIC) + 7:
+        raise RDBError(f'{path} is truncated')
+    with memoryview(buffer) as view:
+        checksum = zlib.crc32(view[:size - 4])
+    if checksum != _uint32.unpack_from(buffer, size - 4)[0]:
+        raise RDBError(f'Checksum mismatch, {path} is corrupt')
+    version = _uint16.unpack_from(buffer, len(MAGIC))[0]
+    if version > VERSION:
+        raise RDBError(f'{path} has format version {version}, newer than the supported {VERSION}')
+
+    # Hot loop: lengths below LEN_32BIT are inlined, everything is bound to locals
+    unpack_double = _double.unpack_from
+    read_length = _read_length
+    data = {}
+    pos = len(MAGIC) + 2
+    timeout = None
+    while True:
+        opcode = buffer[pos]
+        pos += 1
+        if opcode == OPCODE_EXPIRETIME:
+            timeout = unpack_double(buffer, pos)[0]
+            pos += 8
+            continue
+        if opcode == OPCODE_EOF:
+            break
+
+        length = buffer[pos]
+        if length < LEN_32BIT:
+            pos += 1
+        else:
+            length, pos = read_length(buffer, pos)
+        key = str(buffer[pos:pos + length], ENCODING, ERRORS)
+        pos += length
+
+        if opcode == TYPE_STRING:
+            length = buffer[pos]
+            if length < LEN_32BIT:
+                pos += 1
+            else:
+                length, pos = read_length(buffer, pos)
+            val = str(buffer[pos:pos + length], ENCODING, ERRORS)
+            pos += length
+        elif opcode == TYPE_ZSET:
+            count, pos = read_length(buffer, pos)
+            pairs = []
+            for _ in range(count):
+                length, pos = read_length(buffer, pos)
+                member = str(buffer[pos:pos + length], ENCODING, ERRORS)
+                pos += length
+                pairs.append((unpack_double(buffer, pos)[0], member))
+                pos += 8
+            val = MySortedSet()
+            if len(pairs) <= MySortedSet.max_listpack_entries:
+                # Small sets go straight into their listpack, sorted as snapshots from version 1 are in no order
+                pairs.sort()
+                val.listpack = pairs
+            else:
+                val.update(pairs)
+        elif opcode == TYPE_COMPRESSED_STRING:
+            length, pos = read_length(buffer, pos)
+            codec = str(buffer[pos:pos + length], ENCODING, ERRORS)
+            pos += length
+            length, pos = read_length(buffer, pos)
+            val = CompressedString(codec, bytes(buffer[pos:pos + length]))
+            pos += length
+        else:
+            raise RDBError(f'Unknown entry type {opcode} in {path}')
+        data[key] = Value(val, timeout)
+        timeout = None
+    return data
@@ -0,0 +1,184 @@
+"""
+Primary/replica replication, as Redis' replication.
+
+A primary started with --replication_port publishes every record it logs, for every open database, on a PUB socket as
+[database name, offset, publish time, record]. Offsets number the records of a database from when it was opened, a
+message with an empty record is a heartbeat carrying the latest offset. A replica (--replicaof host:port) bootstraps
+each database it serves with SYNC, a snapshot of the database and the offset it was taken at, then applies the
+streamed records that follow it in offset order. The primary writes the snapshot from a forked child, the replica
+downloads it a chunk at a time (SYNC db -CHUNK id position) into a file and loads that.
+"""
+import os
+import time
+
+import zmq
+
+from . import rdb
+from .protocol import ErrorReply, ENCODING, ERRORS, decode_commands, decode_replies, encode_command
+
+
+class ReplicationStream:
+    """Primary side, publishes the records of every database it is the replication_feed of"""
+
+    # Seconds between heartbeats, replicas notice records they missed at the latest by then
+    heartbeat_interval = 0.1
+    # Messages queued per replica before PUB starts dropping them for it, the replica then resyncs
+    high_water_mark = 100000
+
+    def __init__(self, port):
+        self.port = port
+        self.__socket = zmq.Context.instance().socket(zmq.PUB)
+        self.__socket.setsockopt(zmq.SNDHWM, self.high_water_mark)
+        self.__socket.bind(f"tcp://*:{port}")
+        self.__last_heartbeat = 0
+
+    def publish(self, database, record):
+        self.__socket.send_multipart([database.name.encode(ENCODING, ERRORS), b'%d' % database.replication_offset,
+                                      repr(time.time()).encode(), encode_command(record)])
+
+    def heartbeat(self, databases):
+        now = time.time()
+        if now - self.__last_heartbeat < self.heartbeat_interval:
+            return
+        self.__last_heartbeat = now
+        for database in databases:
+            self.__socket.send_multipart([database.name.encode(ENCODING, ERRORS),
+                                          b'%d' % database.replication_offset, repr(now).encode(), b''])
+
+
+class ReplicaState:
+    """
+    How far a replicated database is
+    offset: offset of the last record applied
+    primary_offset: latest offset heard of from the primary
+    lag: seconds between the primary publishing the last applied record and the replica applying it
+    last_io: when the primary was last heard from about this database
+    """
+    __slots__ = ('database', 'offset', 'primary_offset', 'lag', 'last_io')
+
+    def __init__(self, database, offset):
+        self.database = database
+        self.offset = offset
+        self.primary_offset = offset
+        self.lag = 0.0
+        self.last_io = time.time()
+
+
+class Replica:
+    """
+    Replica side, keeps databases in step with the primary at `primary` (host:port of its client port).
+    sync() loads a database from a snapshot of the primary's, receive() applies what was streamed since. A gap in the
+    offsets, records dropped while the subscription was still being set up or because the replica fell too far
+    behind, triggers a full resync of that database.
+    """
+
+    # Seconds to wait for the primary to answer SYNC, and for its child to write the snapshot
+    sync_timeout = 10
+    snapshot_timeout = 300
+    # Seconds between asking whether the snapshot is written yet
+    snapshot_poll_interval = 0.05
+    # Stream messages applied per receive() call, so clients are still served while a backlog is worked off
+    receive_batch = 1000
+
+    def __init__(self, primary):
+        self.primary = primary
+        self.__host = primary.rsplit(':', 1)[0]
+        self.__context = zmq.Context.instance()
+        self.socket = self.__context.socket(zmq.SUB)
+        self.__stream_port = None
+        self.__states = {}
+        self.full_syncs = 0
+
+    def following(self, name):
+        return name in self.__states
+
+    def states(self):
+        return self.__states.items()
+
+    def __request(self, tokens):
+        # One request to the primary's client port, a fresh REQ socket each time so a timeout leaves nothing behind
+        socket = self.__context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(f"tcp://{self.primary}")
+        try:
+            socket.send(encode_command(tokens))
+            if not socket.poll(self.sync_timeout * 1000):
+                raise ConnectionError(f'primary {self.primary} did not answer {tokens[0]}')
+            return decode_replies(socket.recv())[0]
+        finally:
+            socket.close()
+
+    def sync(self, database):
+        # Full resync: the primary's snapshot replaces the data, then the stream picks up from its offset
+        name = database.name
+        if name not in self.__states:
+            self.socket.setsockopt(zmq.SUBSCRIBE, name.encode(ENCODING, ERRORS))
+        reply = self.__request(['SYNC', name])
+        if isinstance(reply, ErrorReply):
+            raise ConnectionError(f'primary {self.primary} refused SYNC: {reply}')
+        stream_port, offset, snapshot_id = reply
+        if self.__stream_port != stream_port:
+            # Subscribed before the snapshot was asked for, records published meanwhile are waiting on the socket.
+            # Only on the very first sync the stream's port is not known in time, a gap may then force a second sync.
+            self.socket.connect(f"tcp://{self.__host}:{stream_port}")
+            self.__stream_port = stream_port
+        path = database.dump_path + '.sync'
+        try:
+            self.__download(name, snapshot_id, path)
+            database.load_data(rdb.load(path))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        self.__states[name] = ReplicaState(database, offset)
+        self.full_syncs += 1
+        if database.save_interval is not None:
+            # The local log only holds records from before the snapshot, a fresh local snapshot supersedes it
+            database.bgsave()
+
+    def __download(self, name, snapshot_id, path):
+        # Writes the primary's snapshot snapshot_id to path, a chunk per request
+        deadline = time.time() + self.snapshot_timeout
+        position = 0
+        with open(path, 'wb') as f:
+            while True:
+                chunk = self.__request(['SYNC', name, '-CHUNK', str(snapshot_id), str(position)])
+                if isinstance(chunk, ErrorReply):
+                    raise ConnectionError(f'primary {self.primary} failed to send its snapshot: {chunk}')
+                if chunk is None:
+                    if time.time() > deadline:
+                        raise ConnectionError(f'primary {self.primary} did not write its snapshot in time')
+                    time.sleep(self.snapshot_poll_interval)
+                    continue
+                if not chunk:
+                    return
+                chunk = chunk.encode(ENCODING, ERRORS)
+                f.write(chunk)
+                position += len(chunk)
+
+    def receive(self):
+        # Applies the stream messages waiting on the socket, up to receive_batch of them
+        for _ in range(self.receive_batch):
+            try:
+                name, offset, sent, record = self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            state = self.__states.get(name.decode(ENCODING, ERRORS))
+            if state is None:
+                # A database whose name merely starts with a subscribed one
+                continue
+            offset = int(offset)
+            state.last_io = time.time()
+            state.primary_offset = max(state.primary_offset, offset)
+            if not record:
+                if offset > state.offset:
+                    self.sync(state.database)
+                continue
+            if offset <= state.offset:
+                continue
+            if offset != state.offset + 1:
+                self.sync(state.database)
+                continue
+            for tokens in decode_commands(record):
+                state.database.replicate(tokens)
+            state.offset = offset
+            state.lag = state.last_io - float(sent)
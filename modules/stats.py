@@ -0,0 +1,131 @@
+"""
+Server instrumentation behind INFO, SLOWLOG and LATENCY HISTOGRAM, as Redis' commandstats, latencystats and slow log.
+
+Every command a Session executes is timed and counted per command name. Latencies go into a log-linear histogram:
+exact below 8 microseconds, then four buckets per power of two, so any percentile read off it is within 25% of the
+true value while recording stays a couple of integer operations. Commands slower than slowlog_log_slower_than
+microseconds are also kept in the slow log, the newest slowlog_max_len of them.
+"""
+import itertools
+import time
+from collections import deque
+
+from .protocol import ErrorReply
+
+# Slow log entries keep at most this many arguments, each cut to at most this many characters, as Redis does
+SLOWLOG_MAX_ARGS = 32
+SLOWLOG_MAX_ARG_LEN = 128
+# Histogram buckets, enough for latencies up to 2**40 microseconds
+LATENCY_BUCKETS = 160
+
+
+def latency_bucket(usec):
+    # Histogram index of a latency in microseconds, see the module docstring. Inlined in ServerStats.record.
+    if usec < 8:
+        return usec
+    shift = usec.bit_length() - 3
+    return (shift << 2) + (usec >> shift)
+
+
+def bucket_floor(index):
+    # Smallest latency in microseconds that falls into bucket index
+    if index < 8:
+        return index
+    return (4 + (index & 3)) << ((index >> 2) - 1)
+
+
+class CommandStats:
+    """Calls of one command, total microseconds spent in them, how many replied with an error and their latencies"""
+    __slots__ = ('calls', 'usec', 'failed_calls', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.usec = 0
+        self.failed_calls = 0
+        self.histogram = [0] * LATENCY_BUCKETS
+
+    def percentile(self, fraction):
+        # Upper bound in microseconds of the bucket holding the given fraction of the recorded latencies
+        rank = fraction * sum(self.histogram)
+        seen = 0
+        for index, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= rank:
+                return bucket_floor(index + 1)
+        return 0
+
+
+class SlowLogEntry:
+    __slots__ = ('id', 'timestamp', 'usec', 'args', 'client')
+
+    def __init__(self, entry_id, timestamp, usec, args, client):
+        self.id = entry_id
+        self.timestamp = timestamp
+        self.usec = usec
+        self.args = args
+        self.client = client
+
+    def reply(self):
+        return [self.id, self.timestamp, self.usec, self.args, self.client]
+
+
+def _slowlog_args(tokens):
+    args = [token if len(token) <= SLOWLOG_MAX_ARG_LEN else
+            f'{token[:SLOWLOG_MAX_ARG_LEN]}... ({len(token) - SLOWLOG_MAX_ARG_LEN} more bytes)'
+            for token in tokens[:SLOWLOG_MAX_ARGS]]
+    if len(tokens) > SLOWLOG_MAX_ARGS:
+        args[-1] = f'... ({len(tokens) - SLOWLOG_MAX_ARGS + 1} more arguments)'
+    return args
+
+
+class ServerStats:
+    """
+    Counters of a Session
+    slowlog_log_slower_than: microseconds a command has to take to be logged, 0 logs every command, negative none
+    slowlog_max_len: entries the slow log keeps, the oldest go first
+    latency_tracking: False to skip the per command histograms, calls and times are still counted
+    """
+    def __init__(self, slowlog_log_slower_than=10000, slowlog_max_len=128, latency_tracking=True):
+        self.started = time.time()
+        self.commands = {}
+        self.slowlog_log_slower_than = slowlog_log_slower_than
+        self.slowlog = deque(maxlen=slowlog_max_len)
+        self.latency_tracking = latency_tracking
+        self.__slowlog_ids = itertools.count()
+
+    @property
+    def total_commands(self):
+        return sum(stats.calls for stats in self.commands.values())
+
+    def record(self, command, usec, reply):
+        # Counts a command that took usec microseconds, True if it belongs in the slow log. Runs for every command,
+        # so it is kept to the bare minimum.
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+        stats.calls += 1
+        stats.usec += usec
+        if reply.__class__ is ErrorReply:
+            stats.failed_calls += 1
+        if self.latency_tracking:
+            if usec < 8:
+                stats.histogram[usec] += 1
+            else:
+                shift = usec.bit_length() - 3
+                stats.histogram[min((shift << 2) + (usec >> shift), LATENCY_BUCKETS - 1)] += 1
+        return 0 <= self.slowlog_log_slower_than <= usec
+
+    def log_slow(self, usec, tokens, client):
+        self.slowlog.appendleft(SlowLogEntry(next(self.__slowlog_ids), int(time.time()), usec, _slowlog_args(tokens),
+                                             client))
+
+    def histogram(self, command):
+        # [calls, [[bucket upper bound in microseconds, calls up to it], ...]] over the non empty buckets
+        stats = self.commands[command]
+        buckets = []
+        seen = 0
+        for index, count in enumerate(stats.histogram):
+            if count:
+                seen += count
+                buckets.append([bucket_floor(index + 1), seen])
+        return [stats.calls, buckets]
@@ -0,0 +1,62 @@
+"""
+Client side caching support, as Redis' CLIENT TRACKING in its default mode with invalidations redirected to a pub/sub
+channel.
+
+A server started with --tracking_port publishes invalidations on a PUB socket. A client turns tracking on per
+connection with CLIENT TRACKING ON and gets a topic back, or names one with -REDIRECT, eg. a topic shared by every
+connection of a pool. The server then remembers every key the connection reads, and once such a key is modified,
+expires or gets evicted it publishes [topic, database name, key] once and forgets the key until it is read again.
+[topic, database name] without a key invalidates the whole database, eg. when a replica reloads it.
+
+Messages of a lost connection are gone for good, so the server also publishes [HEARTBEAT_TOPIC, run id, sequence]
+every heartbeat_interval: a client that sees a new run id, a gap in the sequence or no heartbeat for a while has to
+drop everything it cached.
+"""
+import itertools
+import os
+import time
+
+import zmq
+
+from .protocol import ENCODING, ERRORS
+
+HEARTBEAT_TOPIC = b'__heartbeat__'
+
+
+class InvalidationStream:
+    """Server side, publishes the invalidations of every database it is the invalidation_feed of"""
+
+    # Seconds between heartbeats
+    heartbeat_interval = 0.1
+    # Messages queued per client before PUB starts dropping them, the client notices by the heartbeat sequence
+    high_water_mark = 100000
+
+    def __init__(self, port):
+        self.port = port
+        self.run_id = os.urandom(8).hex()
+        self.__socket = zmq.Context.instance().socket(zmq.PUB)
+        self.__socket.setsockopt(zmq.SNDHWM, self.high_water_mark)
+        self.__socket.bind(f"tcp://*:{port}")
+        self.__topics = itertools.count(1)
+        self.__sequence = 0
+        self.__last_heartbeat = 0
+
+    def new_topic(self):
+        # Topic of a connection that turned tracking on without -REDIRECT
+        return f'tracking:{self.run_id}:{next(self.__topics)}'
+
+    def invalidate(self, database, key, topics):
+        # key None invalidates every key of database
+        frames = [database.name.encode(ENCODING, ERRORS)]
+        if key is not None:
+            frames.append(key.encode(ENCODING, ERRORS))
+        for topic in topics:
+            self.__socket.send_multipart([topic.encode(ENCODING, ERRORS), *frames])
+
+    def heartbeat(self):
+        now = time.time()
+        if now - self.__last_heartbeat < self.heartbeat_interval:
+            return
+        self.__last_heartbeat = now
+        self.__sequence += 1
+        self.__socket.send_multipart([HEARTBEAT_TOPIC, self.run_id.encode(), b'%d' % self.__sequence])
@@ -1,4 +1,7 @@
 import argparse
+import math
+import re
+import shlex
 
 
 class CommandParser(argparse.ArgumentParser):
@@ -8,6 +11,9 @@ class CommandParser(argparse.ArgumentParser):
     def __init__(self, command):
 
         super().__init__(prog=command)
+        self.last_error = None
+        # Options start with '-' here, score bounds like -inf and -1e3 must still read as positional values
+        self._negative_number_matcher = _NEGATIVE_NUMBER
 
         if command == 'SELECT':
             self.add_argument('db_name', help="Identifier for the database")
@@ -57,6 +63,25 @@ class CommandParser(argparse.ArgumentParser):
             self.description = "Removes the specified keys. A key is ignored if it does not exist."
             self.add_argument('keys', nargs='+', help='Identifier for the key.')
 
+        elif command == 'UNLINK':
+            self.description = "Removes the specified keys like DEL, but big values are freed incrementally between " \
+                               "commands rather than before replying."
+            self.add_argument('keys', nargs='+', help='Identifier for the key.')
+
+        elif command == 'MGET':
+            self.description = "Returns the values of all specified keys. For every key that does not hold a string " \
+                               "value or does not exist, the special value nil is returned."
+            self.add_argument('keys', nargs='+', help='Identifier for the key.')
+
+        elif command in ('MSET', 'MSETNX'):
+            if command == 'MSET':
+                self.description = "Sets the given keys to their respective values. MSET replaces existing values " \
+                                   "with new values, just as regular SET."
+            else:
+                self.description = "Sets the given keys to their respective values. MSETNX will not perform any " \
+                                   "operation at all even if just a single key already exists."
+            self.add_argument('key_value_pairs', nargs='+', help='Pairs of key identifiers and values')
+
         elif command == "ZADD":
             self.description = "Adds all the specified members with the specified scores to the sorted set" \
                                 "stored at key."
@@ -92,15 +117,174 @@ class CommandParser(argparse.ArgumentParser):
             self.add_argument('stop', type=int, help="Last Index")
             self.add_argument('-WITHSCORES', action='store_true', help="Display scores of members")
 
+        elif command in ('ZREVRANK', 'ZSCORE'):
+            if command == 'ZREVRANK':
+                self.description = "Returns the rank of member in the sorted set stored at key, with the scores " \
+                                   "ordered from high to low. The rank (or index) is 0-based, which means that the " \
+                                   "member with the highest score has rank 0. "
+            else:
+                self.description = "Returns the score of member in the sorted set at key. If member does not exist " \
+                                   "in the sorted set, or key does not exist, nil is returned. "
+            self.add_argument('key', help="Identifier for the key.")
+            self.add_argument('member', help="Identifier for the sortedset member.")
+
+        elif command == 'ZREVRANGE':
+            self.description = "Returns the specified range of elements in the sorted set stored at key, ordered " \
+                               "from the highest to the lowest score."
+            self.add_argument('key', help="Identifier for the key.")
+            self.add_argument('start', type=int, help="Starting Index")
+            self.add_argument('stop', type=int, help="Last Index")
+            self.add_argument('-WITHSCORES', action='store_true', help="Display scores of members")
+
+        elif command in ('ZRANGEBYSCORE', 'ZREVRANGEBYSCORE'):
+            if command == 'ZRANGEBYSCORE':
+                self.description = "Returns all the elements in the sorted set at key with a score between min and " \
+                                   "max, ordered from low to high scores. "
+                self.add_argument('key', help="Identifier for the key.")
+                self.add_argument('min', type=score_bound, help="Minimum score, ( prefix to exclude it, -inf.")
+                self.add_argument('max', type=score_bound, help="Maximum score, ( prefix to exclude it, +inf.")
+            else:
+                self.description = "Returns all the elements in the sorted set at key with a score between max and " \
+                                   "min, ordered from high to low scores. "
+                self.add_argument('key', help="Identifier for the key.")
+                self.add_argument('max', type=score_bound, help="Maximum score, ( prefix to exclude it, +inf.")
+                self.add_argument('min', type=score_bound, help="Minimum score, ( prefix to exclude it, -inf.")
+            self.add_argument('-WITHSCORES', action='store_true', help="Display scores of members")
+            self.add_argument('-LIMIT', type=int, nargs=2, metavar=('offset', 'count'),
+                              help="Skip offset matching elements and return at most count, all if negative.")
+
+        elif command in ('ZCOUNT', 'ZREMRANGEBYSCORE'):
+            if command == 'ZCOUNT':
+                self.description = "Returns the number of elements in the sorted set at key with a score between " \
+                                   "min and max. "
+            else:
+                self.description = "Removes all elements in the sorted set stored at key with a score between min " \
+                                   "and max. "
+            self.add_argument('key', help="Identifier for the key.")
+            self.add_argument('min', type=score_bound, help="Minimum score, ( prefix to exclude it, -inf.")
+            self.add_argument('max', type=score_bound, help="Maximum score, ( prefix to exclude it, +inf.")
+
+        elif command in ('ZRANGEBYLEX', 'ZLEXCOUNT'):
+            if command == 'ZRANGEBYLEX':
+                self.description = "When all the elements in a sorted set are inserted with the same score, returns " \
+                                   "the elements between min and max in lexicographical order. "
+            else:
+                self.description = "When all the elements in a sorted set are inserted with the same score, returns " \
+                                   "the number of elements between min and max. "
+            self.add_argument('key', help="Identifier for the key.")
+            self.add_argument('min', type=lex_bound, help="[member inclusive, (member exclusive, or - for no bound")
+            self.add_argument('max', type=lex_bound, help="[member inclusive, (member exclusive, or + for no bound")
+            if command == 'ZRANGEBYLEX':
+                self.add_argument('-LIMIT', type=int, nargs=2, metavar=('offset', 'count'),
+                                  help="Skip offset matching elements and return at most count, all if negative.")
+
+        elif command == 'ZREM':
+            self.description = "Removes the specified members from the sorted set stored at key. Non existing " \
+                               "members are ignored. "
+            self.add_argument('key', help="Identifier for the key.")
+            self.add_argument('members', nargs='+', help="Identifiers for the sortedset members.")
+
+        elif command == 'ZREMRANGEBYRANK':
+            self.description = "Removes all elements in the sorted set stored at key with rank between start and " \
+                               "stop, stop excluded as in ZRANGE. "
+            self.add_argument('key', help="Identifier for the key.")
+            self.add_argument('start', type=int, help="Starting Index")
+            self.add_argument('stop', type=int, help="Last Index")
+
+        elif command == 'SCAN':
+            self.description = "Incrementally iterates over the keys of the database. Every call returns a cursor " \
+                               "for the next call and a chunk of keys, the iteration is complete once the returned " \
+                               "cursor is 0. "
+            self.add_argument('cursor', type=int, help="0 to start, else the cursor returned by the previous call")
+            self.add_argument('-MATCH', help="Only return keys matching this glob-style pattern.")
+            self.add_argument('-COUNT', type=int, default=10, help="Amount of work done per call, 10 by default.")
+            self.add_argument('-TYPE', choices=KEY_TYPES, help="Only return keys holding this type.")
+
+        elif command == 'ZSCAN':
+            self.description = "Incrementally iterates over the members and scores of the sorted set at key, like " \
+                               "SCAN. "
+            self.add_argument('key', help="Identifier for the key.")
+            self.add_argument('cursor', help="0 to start, else the cursor returned by the previous call")
+            self.add_argument('-MATCH', help="Only return members matching this glob-style pattern.")
+            self.add_argument('-COUNT', type=int, default=10, help="Amount of work done per call, 10 by default.")
+
+        elif command in ('MULTI', 'EXEC', 'DISCARD', 'UNWATCH'):
+            self.description = {
+                'MULTI': "Marks the start of a transaction block. Subsequent commands are queued for atomic "
+                         "execution using EXEC. ",
+                'EXEC': "Executes all previously queued commands in a transaction and restores the connection state "
+                        "to normal. When WATCH is used, EXEC executes commands only if the watched keys were not "
+                        "modified. ",
+                'DISCARD': "Flushes all previously queued commands in a transaction and restores the connection "
+                           "state to normal. ",
+                'UNWATCH': "Flushes all the previously watched keys for a transaction. ",
+            }[command]
+
+        elif command == 'WATCH':
+            self.description = "Marks the given keys to be watched for conditional execution of a transaction."
+            self.add_argument('keys', nargs='+', help='Identifier for the key.')
+
+        elif command == 'BGSAVE':
+            self.description = "Saves a snapshot of the dataset in the background, from a forked child process. " \
+                               "Writes keep being served while the snapshot is written."
+
+        elif command == 'BGREWRITEAOF':
+            self.description = "Rewrites the append only file in the background, from the current state of the " \
+                               "dataset. Writes keep being served while the rewrite runs."
+
+        elif command == 'SYNC':
+            self.description = "Used by replicas: starts a snapshot of the database, returns the replication offset " \
+                               "it is taken at and its id. With -CHUNK, returns the part of it at that position."
+            self.add_argument('db_name', help="Identifier for the database")
+            self.add_argument('-CHUNK', type=int, nargs=2, metavar=('snapshot', 'position'),
+                              help="Part of a snapshot started before, nil while it is still being written, empty "
+                                   "past its end.")
+
+        elif command == 'ROLE':
+            self.description = "Replication role of the server with the offset of every database, on a replica also " \
+                               "how far behind the primary each database is."
+
+        elif command == 'CLIENT':
+            self.description = "CLIENT TRACKING ON|OFF: with tracking on the server remembers the keys this client " \
+                               "reads and publishes an invalidation once one of them changes. The reply to ON is the " \
+                               "port and topic invalidations are published on."
+            self.add_argument('subcommand', type=str.upper, choices=CLIENT_SUBCOMMANDS)
+            self.add_argument('state', type=str.upper, choices=TRACKING_STATES)
+            self.add_argument('-REDIRECT', help="Topic to publish the invalidations on, eg. one shared by the "
+                                                "connections of a pool. Generated by the server if not given.")
+
+        elif command == 'INFO':
+            self.description = "Information and statistics about the server: server, memory, stats, replication, " \
+                               "persistence, commandstats, latencystats and keyspace sections."
+            self.add_argument('sections', nargs='*', type=str.lower,
+                              help="Sections to return, `all` for all of them. Default: all but commandstats and "
+                                   "latencystats.")
+
+        elif command == 'SLOWLOG':
+            self.description = "The commands that took longer than --slowlog_log_slower_than microseconds. GET " \
+                               "returns the newest count entries as [id, unix time, microseconds, arguments, client], " \
+                               "LEN the number of entries, RESET empties the log."
+            self.add_argument('subcommand', type=str.upper, choices=SLOWLOG_SUBCOMMANDS)
+            self.add_argument('count', nargs='?', type=int, default=10, help="Entries returned by GET, -1 for all.")
+
+        elif command == 'LATENCY':
+            self.description = "LATENCY HISTOGRAM: the latency histogram of the given commands, of every command that " \
+                               "ran if none are given, as calls and cumulative calls per bucket in microseconds."
+            self.add_argument('subcommand', type=str.upper, choices=LATENCY_SUBCOMMANDS)
+            self.add_argument('commands', nargs='*', type=str.upper)
+
         elif command == 'EXIT':
             pass
 
     def error(self, message):
-        # Custom Error function to avoid sys exit on parsing errors
-        print(message)
-        self.print_usage()
+        # Custom Error function to avoid sys exit on parsing errors, the caller reports `last_error`
+        self.last_error = f'{message}\n{self.format_usage().rstrip()}'
         raise Exception
 
+    def print_help(self, file=None):
+        # Help text is handed back like an error message, so remote clients get to see it too
+        self.last_error = self.format_help().rstrip()
+
     def __fetch_pair_list(self, arglist):
         # Parses sequence of score key pairs for ZADD command, called from parse function
         if len(arglist) % 2 == 1:
@@ -109,20 +293,302 @@ class CommandParser(argparse.ArgumentParser):
         pairs_list = []
         for i in range(0, len(arglist)-1, 2):
             try:
-                score = float(arglist[i])
+                score = parse_score(arglist[i])
             except ValueError:
                 self.error(f"Score values should be int or float, not string")
             member = arglist[i+1]
             pairs_list.append((score, member))
         return pairs_list
 
+    def __fetch_key_value_list(self, arglist):
+        # Parses sequence of key value pairs for MSET and MSETNX, called from parse function
+        if len(arglist) % 2 == 1:
+            self.error(f"Key value should be in pairs.")
+        return list(zip(arglist[::2], arglist[1::2]))
+
     def parse(self, cmd_args):
+        self.last_error = None
         try:
             parsed_args = self.parse_args(cmd_args)
             if self.prog == 'ZADD':
                 parsed_args.score_member = self.__fetch_pair_list(parsed_args.score_member_pairs)
+            elif self.prog in ('MSET', 'MSETNX'):
+                parsed_args.key_value = self.__fetch_key_value_list(parsed_args.key_value_pairs)
 
             return parsed_args
+        except InvalidFloat as e:
+            self.last_error = str(e)
+            return None
         except:
             # print(self.print_help())
             return None
+
+
+class InvalidFloat(Exception):
+    """
+    A NaN score or score bound. Not a ValueError, so argparse lets it through rather than turning it into a usage
+    error, and the command is refused with just its message.
+    """
+    def __init__(self):
+        super().__init__('ERR value is not a valid float')
+
+
+def parse_score(token):
+    # Sorted set score. NaN compares false to everything, a set holding one would no longer be ordered.
+    score = float(token)
+    if math.isnan(score):
+        raise InvalidFloat()
+    return score
+
+
+def score_bound(token):
+    """Sorted set score bound as (score, exclusive): 1.5, (1.5 to exclude it, -inf or +inf"""
+    if token[:1] == '(':
+        return parse_score(token[1:]), True
+    return parse_score(token), False
+
+
+def lex_bound(token):
+    """Sorted set member bound as (kind, member): [member inclusive, (member exclusive, - or + unbounded"""
+    if token in ('-', '+'):
+        return token, None
+    if token[:1] in ('[', '('):
+        return token[0], token[1:]
+    raise ValueError(token)
+
+
+KEY_TYPES = ('string', 'zset')
+
+
+def key_type(token):
+    """Type name for SCAN -TYPE, anything else is left to argparse's choices check to report"""
+    if token not in KEY_TYPES:
+        raise ValueError(token)
+    return token
+
+
+CLIENT_SUBCOMMANDS = ('TRACKING',)
+TRACKING_STATES = ('ON', 'OFF')
+
+
+def client_subcommand(token):
+    # Case insensitive as the argparse definition, which reports anything else
+    if token.upper() not in CLIENT_SUBCOMMANDS:
+        raise ValueError(token)
+    return token.upper()
+
+
+def tracking_state(token):
+    if token.upper() not in TRACKING_STATES:
+        raise ValueError(token)
+    return token.upper()
+
+
+SLOWLOG_SUBCOMMANDS = ('GET', 'LEN', 'RESET')
+LATENCY_SUBCOMMANDS = ('HISTOGRAM',)
+
+
+def slowlog_subcommand(token):
+    if token.upper() not in SLOWLOG_SUBCOMMANDS:
+        raise ValueError(token)
+    return token.upper()
+
+
+def latency_subcommand(token):
+    if token.upper() not in LATENCY_SUBCOMMANDS:
+        raise ValueError(token)
+    return token.upper()
+
+
+_RANGE_BY_SCORE = {'options': {'-WITHSCORES': ('WITHSCORES', None), '-LIMIT': ('LIMIT', int, 2)}, 'exclusive': []}
+
+# Per command layout consumed by FastCommandParser, mirrors the argparse definitions in CommandParser above.
+#   positionals: (dest, type, nargs) in order, nargs is None for exactly one token or '+' for one or more
+#   options: flag -> (dest, type) or (dest, type, count) for an option taking count values, a type of None marks a
+#            store_true flag
+#   exclusive: groups of option dests that may not be combined
+COMMAND_SPECS = {
+    'SELECT': {'positionals': [('db_name', str, None)], 'options': {}, 'exclusive': []},
+    'DESELECT': {'positionals': [], 'options': {}, 'exclusive': []},
+    'GET': {'positionals': [('key', str, None)], 'options': {}, 'exclusive': []},
+    'SET': {'positionals': [('key', str, None), ('value', str, None)],
+            'options': {'-EX': ('EX', int), '-PX': ('PX', int), '-NX': ('NX', None), '-XX': ('XX', None),
+                        '-KEEPTTL': ('KEEPTTL', None)},
+            'exclusive': [('EX', 'PX'), ('NX', 'XX')]},
+    'EXPIRE': {'positionals': [('key', str, None), ('seconds', str, None)], 'options': {}, 'exclusive': []},
+    'TTL': {'positionals': [('key', str, None)], 'options': {}, 'exclusive': []},
+    'DEL': {'positionals': [('keys', str, '+')], 'options': {}, 'exclusive': []},
+    'UNLINK': {'positionals': [('keys', str, '+')], 'options': {}, 'exclusive': []},
+    'MGET': {'positionals': [('keys', str, '+')], 'options': {}, 'exclusive': []},
+    'MSET': {'positionals': [('key_value_pairs', str, '+')], 'options': {}, 'exclusive': []},
+    'MSETNX': {'positionals': [('key_value_pairs', str, '+')], 'options': {}, 'exclusive': []},
+    'ZADD': {'positionals': [('key', str, None), ('score_member_pairs', str, '+')],
+             'options': {'-NX': ('NX', None), '-XX': ('XX', None), '-CH': ('CH', None), '-INCR': ('INCR', None)},
+             'exclusive': [('NX', 'XX')]},
+    'ZRANK': {'positionals': [('key', str, None), ('member', str, None)], 'options': {}, 'exclusive': []},
+    'ZRANGE': {'positionals': [('key', str, None), ('start', int, None), ('stop', int, None)],
+               'options': {'-WITHSCORES': ('WITHSCORES', None)}, 'exclusive': []},
+    'ZREVRANK': {'positionals': [('key', str, None), ('member', str, None)], 'options': {}, 'exclusive': []},
+    'ZSCORE': {'positionals': [('key', str, None), ('member', str, None)], 'options': {}, 'exclusive': []},
+    'ZREVRANGE': {'positionals': [('key', str, None), ('start', int, None), ('stop', int, None)],
+                  'options': {'-WITHSCORES': ('WITHSCORES', None)}, 'exclusive': []},
+    'ZRANGEBYSCORE': {'positionals': [('key', str, None), ('min', score_bound, None), ('max', score_bound, None)],
+                      **_RANGE_BY_SCORE},
+    'ZREVRANGEBYSCORE': {'positionals': [('key', str, None), ('max', score_bound, None), ('min', score_bound, None)],
+                         **_RANGE_BY_SCORE},
+    'ZCOUNT': {'positionals': [('key', str, None), ('min', score_bound, None), ('max', score_bound, None)],
+               'options': {}, 'exclusive': []},
+    'ZREMRANGEBYSCORE': {'positionals': [('key', str, None), ('min', score_bound, None), ('max', score_bound, None)],
+                         'options': {}, 'exclusive': []},
+    'ZRANGEBYLEX': {'positionals': [('key', str, None), ('min', lex_bound, None), ('max', lex_bound, None)],
+                    'options': {'-LIMIT': ('LIMIT', int, 2)}, 'exclusive': []},
+    'ZLEXCOUNT': {'positionals': [('key', str, None), ('min', lex_bound, None), ('max', lex_bound, None)],
+                  'options': {}, 'exclusive': []},
+    'ZREM': {'positionals': [('key', str, None), ('members', str, '+')], 'options': {}, 'exclusive': []},
+    'ZREMRANGEBYRANK': {'positionals': [('key', str, None), ('start', int, None), ('stop', int, None)],
+                        'options': {}, 'exclusive': []},
+    'SCAN': {'positionals': [('cursor', int, None)],
+             'options': {'-MATCH': ('MATCH', str), '-COUNT': ('COUNT', int), '-TYPE': ('TYPE', key_type)}, 'exclusive': []},
+    'ZSCAN': {'positionals': [('key', str, None), ('cursor', str, None)],
+              'options': {'-MATCH': ('MATCH', str), '-COUNT': ('COUNT', int)}, 'exclusive': []},
+    'MULTI': {'positionals': [], 'options': {}, 'exclusive': []},
+    'EXEC': {'positionals': [], 'options': {}, 'exclusive': []},
+    'DISCARD': {'positionals': [], 'options': {}, 'exclusive': []},
+    'WATCH': {'positionals': [('keys', str, '+')], 'options': {}, 'exclusive': []},
+    'UNWATCH': {'positionals': [], 'options': {}, 'exclusive': []},
+    'BGSAVE': {'positionals': [], 'options': {}, 'exclusive': []},
+    'BGREWRITEAOF': {'positionals': [], 'options': {}, 'exclusive': []},
+    'SYNC': {'positionals': [('db_name', str, None)], 'options': {'-CHUNK': ('CHUNK', int, 2)}, 'exclusive': []},
+    'ROLE': {'positionals': [], 'options': {}, 'exclusive': []},
+    # Optional positionals are left to the argparse fallback when absent
+    'INFO': {'positionals': [('sections', str.lower, '+')], 'options': {}, 'exclusive': []},
+    'SLOWLOG': {'positionals': [('subcommand', slowlog_subcommand, None), ('count', int, None)], 'options': {},
+                'exclusive': []},
+    'LATENCY': {'positionals': [('subcommand', latency_subcommand, None), ('commands', str.upper, '+')],
+                'options': {}, 'exclusive': []},
+    'CLIENT': {'positionals': [('subcommand', client_subcommand, None), ('state', tracking_state, None)],
+               'options': {'-REDIRECT': ('REDIRECT', str)}, 'exclusive': []},
+    'EXIT': {'positionals': [], 'options': {}, 'exclusive': []},
+}
+
+# Lines without quotes, escapes or comments tokenize exactly like shlex does by splitting on its whitespace set
+_PLAIN_LINE = re.compile(r'[^\'"\\#]*')
+_TOKEN = re.compile(r'[^ \t\r\n]+')
+# Decides that a leading '-' belongs to a number rather than an option, argparse's own test widened to exponents and
+# -inf, CommandParser installs it in place of argparse's
+_NEGATIVE_NUMBER = re.compile(r'^-(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?$|^-inf$', re.IGNORECASE)
+
+
+def tokenize(cmd):
+    """
+    Equivalent of shlex.split(cmd, comments=True), skipping the shlex state machine for plain lines
+    """
+    if _PLAIN_LINE.fullmatch(cmd):
+        return _TOKEN.findall(cmd)
+    return shlex.split(cmd, comments=True)
+
+
+class FastCommandParser:
+    """
+    Drop-in replacement for CommandParser.parse on the hot path. Walks the tokens once against COMMAND_SPECS and
+    builds the same argument namespace without going through argparse.
+    Anything off the fast path (-h, abbreviated or unknown options, missing or surplus arguments, bad types) is handed
+    to the argparse CommandParser, so help output and error messages stay exactly what they were.
+    """
+    def __init__(self, command):
+        self.prog = command
+        spec = COMMAND_SPECS[command]
+        self.__positionals = spec['positionals']
+        self.__options = spec['options']
+        self.__exclusive = spec['exclusive']
+        self.__fallback = CommandParser(command)
+        self.__defaults = {option[0]: self.__fallback.get_default(option[0]) for option in self.__options.values()}
+
+    @property
+    def last_error(self):
+        # Only meaningful after parse returned None, which only ever happens through the argparse fallback
+        return self.__fallback.last_error
+
+    @staticmethod
+    def __is_option(token):
+        return len(token) > 1 and token[0] == '-' and not _NEGATIVE_NUMBER.match(token)
+
+    def __consume(self, chunk, spec_index, values):
+        # Mirrors argparse: a run of positional tokens between options fills as many of the remaining positionals as
+        # it can, a trailing '+' positional takes the rest of the run. Returns the new spec index, None on leftovers.
+        remaining = self.__positionals[spec_index:]
+        if remaining and remaining[-1][2] == '+' and len(chunk) >= len(remaining):
+            count = len(remaining)
+        else:
+            count = min(len(chunk), sum(1 for spec in remaining if spec[2] is None))
+            if count < len(chunk):
+                return None
+        for position, (dest, kind, nargs) in enumerate(remaining[:count]):
+            if nargs == '+':
+                values[dest] = [kind(token) for token in chunk[position:]]
+            else:
+                values[dest] = kind(chunk[position])
+        return spec_index + count
+
+    def parse(self, cmd_args):
+        values = dict(self.__defaults)
+        seen = set()
+        chunk = []
+        spec_index = 0
+        index = 0
+        try:
+            while index < len(cmd_args):
+                token = cmd_args[index]
+                if not self.__is_option(token):
+                    chunk.append(token)
+                    index += 1
+                    continue
+
+                option = self.__options.get(token)
+                if option is None:
+                    return self.__fallback.parse(cmd_args)
+                if chunk:
+                    spec_index = self.__consume(chunk, spec_index, values)
+                    if spec_index is None:
+                        return self.__fallback.parse(cmd_args)
+                    chunk = []
+
+                dest, kind = option[:2]
+                if kind is None:
+                    values[dest] = True
+                else:
+                    count = option[2] if len(option) > 2 else 1
+                    option_values = cmd_args[index + 1:index + 1 + count]
+                    if len(option_values) < count or any(self.__is_option(token) for token in option_values):
+                        return self.__fallback.parse(cmd_args)
+                    values[dest] = kind(option_values[0]) if len(option) == 2 else [kind(t) for t in option_values]
+                    index += count
+                seen.add(dest)
+                index += 1
+
+            if chunk:
+                spec_index = self.__consume(chunk, spec_index, values)
+        except (ValueError, InvalidFloat):
+            return self.__fallback.parse(cmd_args)
+
+        if spec_index is None or spec_index != len(self.__positionals):
+            return self.__fallback.parse(cmd_args)
+        for group in self.__exclusive:
+            if len(seen.intersection(group)) > 1:
+                return self.__fallback.parse(cmd_args)
+
+        if self.prog == 'ZADD':
+            pairs = values['score_member_pairs']
+            if len(pairs) % 2 == 1:
+                return self.__fallback.parse(cmd_args)
+            try:
+                values['score_member'] = [(parse_score(pairs[i]), pairs[i+1]) for i in range(0, len(pairs), 2)]
+            except (ValueError, InvalidFloat):
+                return self.__fallback.parse(cmd_args)
+        elif self.prog in ('MSET', 'MSETNX'):
+            pairs = values['key_value_pairs']
+            if len(pairs) % 2 == 1:
+                return self.__fallback.parse(cmd_args)
+            values['key_value'] = list(zip(pairs[::2], pairs[1::2]))
+
+        return argparse.Namespace(**values)
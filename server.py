@@ -1,33 +1,328 @@
 from engine import *
+from modules.protocol import ErrorReply, ProtocolError, decode_commands, decode_replies, encode_command, encode_reply, \
+    encode_text
+from modules.cluster import Batch, ClusterConnection, ShardRouter
+from collections import deque
+import multiprocessing
+import signal
 import zmq
 import argparse
 
 
+def route_of(envelope):
+    # The frames that tell a client apart, up to the empty delimiter. Whatever a client puts after it, eg. a request
+    # id to match replies to requests, is per request and only echoed back.
+    return tuple(envelope[:envelope.index(b'')]) if b'' in envelope else tuple(envelope)
+
+
 class ServerSession:
+    """
+    Network frontend for a Session.
+    `router` mode (default) binds a ROUTER socket, so any number of REQ/DEALER clients can have requests in flight at
+    once and every reply is routed back by the identity envelope it arrived with. `rep` mode keeps the old lock-step
+    REQ/REP loop around for comparison.
+    """
+
+    # Milliseconds to wait for a request before running housekeeping anyway
+    cron_interval = 100
 
     def __init__(self, args):
         self.__port = args.port
+        self.__mode = args.serve_mode
         self.__session = Session(args)
 
+    def __execute(self, tokens):
+        validated_cmd, parsed_args = self.__session.validate_tokens(tokens)
+        if validated_cmd is None:
+            return parsed_args
+        return self.__session.process_command(validated_cmd[0], parsed_args, validated_cmd)
+
+    def __handle(self, payload, identity=None):
+        # Framed requests may pipeline any number of commands, answered in order within a single reply frame.
+        # Anything else is a plain text command line from an older client and gets the plain text reply it expects.
+        # identity tells clients apart for their per connection state, eg. an open MULTI.
+        self.__session.set_connection(identity)
+        if payload[:1] == b'*':
+            try:
+                commands = decode_commands(payload)
+            except (ProtocolError, ValueError) as e:
+                return encode_reply(ErrorReply(f'ERR Protocol error: {e}'))
+            return b''.join(encode_reply(self.__execute(tokens)) for tokens in commands)
+        try:
+            tokens = tokenize(payload.decode())
+        except ValueError as e:
+            return str(ErrorReply(f'ERR Protocol error: {e}')).encode()
+        return encode_text(self.__execute(tokens)).encode()
+
+    @staticmethod
+    def __split_envelope(frames):
+        # ROUTER prepends the peer identity, REQ peers add an empty delimiter frame, DEALER peers may not.
+        # Everything up to the payload is echoed back untouched so the reply finds its way home.
+        return frames[:-1], frames[-1]
+
     def serve(self):
+        if self.__mode == 'rep':
+            self.__serve_rep()
+        else:
+            self.__serve_router()
+
+    def __poller(self, socket):
+        # Polls the client socket, and on a replica the primary's write stream
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        if self.__session.replica is not None:
+            poller.register(self.__session.replica.socket, zmq.POLLIN)
+        return poller
+
+    def __replicate(self, events):
+        replica = self.__session.replica
+        if replica is not None and replica.socket in events:
+            replica.receive()
+
+    def __serve_rep(self):
         context = zmq.Context()
         socket = context.socket(zmq.REP)
         socket.bind("tcp://*:%s" % self.__port)
+        poller = self.__poller(socket)
 
         while True:
-            message = socket.recv_string()
-            print("Received request: ", message)
-            validated_cmd, parsed_args = self.__session.validate_cmd(message)
-            if validated_cmd is None:
-                output = parsed_args
+            events = dict(poller.poll(self.cron_interval))
+            if socket in events:
+                socket.send(self.__handle(socket.recv()))
+            self.__replicate(events)
+            self.__session.cron()
+
+    def __serve_router(self):
+        context = zmq.Context()
+        socket = context.socket(zmq.ROUTER)
+        # libzmq builds with the draft ROUTER_NOTIFY option report disconnected peers as an [identity, b''] message,
+        # so their connection state can go. Elsewhere state is dropped once a client has nothing open or has been idle
+        # for --timeout seconds, see Session.timeout.
+        try:
+            socket.setsockopt(zmq.ROUTER_NOTIFY, zmq.NOTIFY_DISCONNECT)
+            notify = True
+        except (AttributeError, zmq.ZMQError):
+            notify = False
+        socket.bind("tcp://*:%s" % self.__port)
+        poller = self.__poller(socket)
+
+        while True:
+            events = dict(poller.poll(self.cron_interval))
+            if socket in events:
+                frames = socket.recv_multipart()
+                if notify and len(frames) == 2 and frames[1] == b'':
+                    self.__session.drop_connection((frames[0],))
+                    continue
+                envelope, payload = self.__split_envelope(frames)
+                # Requests from the front of a sharded server carry the client's identity after the front's
+                socket.send_multipart(envelope + [self.__handle(payload, route_of(envelope))])
+            self.__replicate(events)
+            self.__session.cron()
+
+
+class Request:
+    """A client request in flight through a ShardedServer, complete once every shard it was sent to has replied"""
+    __slots__ = ('envelope', 'batch', 'text', 'waiting', 'shard_replies', 'reply')
+
+    def __init__(self, envelope, batch, text):
+        self.envelope = envelope
+        self.batch = batch
+        self.text = text
+        self.waiting = 0
+        self.shard_replies = {}
+        self.reply = None
+
+
+class ShardedServer:
+    """
+    Front of a sharded server. The keyspace is spread over `shards` worker processes by modules/cluster.py, each worker
+    a plain ServerSession listening on port + 1 + i with its own databases, logs and snapshots under shard-i of
+    database_path and log_path. Workers run on their own cores, the front only routes: it forwards every command to
+    the shard of its key, fans out multi key and database wide commands and merges the replies.
+    Requests are forwarded without waiting for earlier ones, replies still go back to each client in request order.
+    Shard aware clients (client.py --cluster) ask for the workers' ports with SHARDS and skip the front.
+    """
+
+    cron_interval = 100
+
+    def __init__(self, args):
+        self.__port = args.port
+        self.__shards = args.shards
+        self.__timeout = getattr(args, 'timeout', 300)
+        self.__router = ShardRouter(args.shards)
+        self.__workers = []
+        self.__worker_args = []
+        for shard in range(args.shards):
+            worker_args = argparse.Namespace(**vars(args))
+            worker_args.port = args.port + 1 + shard
+            worker_args.database_path = os.path.join(args.database_path, f'shard-{shard}')
+            worker_args.log_path = os.path.join(args.log_path, f'shard-{shard}')
+            worker_args.serve_mode = 'router'
+            worker_args.shards = 0
+            # Shard i of a replica follows shard i of the primary
+            if args.replication_port:
+                worker_args.replication_port = args.replication_port + shard
+            if args.replicaof:
+                host, port = args.replicaof.rsplit(':', 1)
+                worker_args.replicaof = f'{host}:{int(port) + 1 + shard}'
+            if args.tracking_port:
+                worker_args.tracking_port = args.tracking_port + shard
+            self.__worker_args.append(worker_args)
+
+        # Keys live on the shard their hash picks for this many shards, opening the files with another count would
+        # leave keys where they can't be found
+        marker = os.path.join(args.database_path, 'shards')
+        if os.path.exists(marker):
+            with open(marker) as f:
+                shards = int(f.read())
+            if shards != args.shards:
+                raise SystemExit(f'{args.database_path} holds data sharded {shards} ways, not {args.shards}')
+        else:
+            with open(marker, 'w') as f:
+                f.write(str(args.shards))
+
+        # Per client state: transaction state in the order clients were last seen, requests in flight in arrival
+        # order, and per shard the requests sent to it, a shard answers a client's requests in the order they were sent
+        self.__connections = {}
+        self.__requests = {}
+        self.__sent = {}
+
+    def __plan(self, envelope, payload):
+        # Request for payload, its reply already set if no shard has to see it
+        route = route_of(envelope)
+        connection = self.__connections.pop(route, None) or ClusterConnection()
+        connection.last_seen = time.time()
+        self.__connections[route] = connection
+        text = payload[:1] != b'*'
+        try:
+            commands = [tokenize(payload.decode())] if text else decode_commands(payload)
+        except (ProtocolError, ValueError) as e:
+            request = Request(envelope, Batch([]), text)
+            error = ErrorReply(f'ERR Protocol error: {e}')
+            request.reply = str(error).encode() if text else encode_reply(error)
+            return request
+        plans = []
+        for tokens in commands:
+            if tokens == ['SHARDS']:
+                plans.append(([], lambda replies: [worker.port for worker in self.__worker_args]))
             else:
-                output = self.__session.process_command(validated_cmd[0], parsed_args)
-            print(output)
-            socket.send_string(str(output))
+                plans.append(self.__router.route(tokens, connection))
+        return Request(envelope, Batch(plans), text)
+
+    def __forward(self, backends, request, payload):
+        key = tuple(request.envelope)
+        shard = request.batch.passthrough
+        if shard is not None:
+            # Single shard requests go out and come back untouched, nothing is encoded or decoded twice
+            backends[shard].send_multipart(request.envelope + [payload])
+            self.__sent.setdefault((key, shard), deque()).append(request)
+            request.waiting = 1
+            return
+        for shard, commands in request.batch.commands.items():
+            backends[shard].send_multipart(request.envelope + [b''.join(encode_command(tokens) for tokens in commands)])
+            self.__sent.setdefault((key, shard), deque()).append(request)
+            request.waiting += 1
+        if not request.waiting:
+            self.__complete(request)
+
+    def __complete(self, request):
+        replies = request.batch.replies(request.shard_replies)
+        if request.text:
+            request.reply = encode_text(replies[0]).encode()
+        else:
+            request.reply = b''.join(encode_reply(reply) for reply in replies)
+
+    def __receive(self, shard, frames):
+        key = tuple(frames[:-1])
+        sent = self.__sent[(key, shard)]
+        request = sent.popleft()
+        if not sent:
+            del self.__sent[(key, shard)]
+        request.waiting -= 1
+        if request.batch.passthrough is not None:
+            request.reply = frames[-1]
+            return key
+        request.shard_replies[shard] = decode_replies(frames[-1])
+        if not request.waiting:
+            self.__complete(request)
+        return key
+
+    def __flush(self, frontend, key):
+        # Sends the client the replies that are ready, up to the first request still waiting on a shard
+        requests = self.__requests[key]
+        while requests and requests[0].reply is not None:
+            request = requests.popleft()
+            frontend.send_multipart(request.envelope + [request.reply])
+        if not requests:
+            del self.__requests[key]
+            route = route_of(key)
+            if route in self.__connections and self.__connections[route].idle:
+                del self.__connections[route]
+
+    def __expire_connections(self):
+        # Forgets the transaction state of clients idle for more than timeout seconds, oldest first, as the workers do
+        deadline = time.time() - self.__timeout
+        expired = []
+        for route, connection in self.__connections.items():
+            if connection.last_seen >= deadline:
+                break
+            expired.append(route)
+        for route in expired:
+            del self.__connections[route]
+
+    def serve(self):
+        # Workers are forked before the front opens any socket, they must not inherit its zmq context
+        for worker_args in self.__worker_args:
+            worker = multiprocessing.Process(target=main, args=(worker_args,), daemon=True)
+            worker.start()
+            self.__workers.append(worker)
+        # Exit through SystemExit on SIGTERM so the workers are stopped along with the front
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            self.__serve()
+        finally:
+            for worker in self.__workers:
+                worker.terminate()
+            for worker in self.__workers:
+                worker.join()
+
+    def __serve(self):
+        context = zmq.Context()
+        frontend = context.socket(zmq.ROUTER)
+        frontend.bind("tcp://*:%s" % self.__port)
+        backends = []
+        poller = zmq.Poller()
+        poller.register(frontend, zmq.POLLIN)
+        for worker_args in self.__worker_args:
+            backend = context.socket(zmq.DEALER)
+            backend.connect(f"tcp://localhost:{worker_args.port}")
+            poller.register(backend, zmq.POLLIN)
+            backends.append(backend)
+        shard_of = {backend: shard for shard, backend in enumerate(backends)}
+
+        while True:
+            for socket, _ in poller.poll(self.cron_interval):
+                if socket is frontend:
+                    frames = frontend.recv_multipart()
+                    envelope, payload = frames[:-1], frames[-1]
+                    key = tuple(envelope)
+                    request = self.__plan(envelope, payload)
+                    self.__requests.setdefault(key, deque()).append(request)
+                    if request.reply is None:
+                        self.__forward(backends, request, payload)
+                else:
+                    key = self.__receive(shard_of[socket], socket.recv_multipart())
+                self.__flush(frontend, key)
+            if self.__timeout and self.__connections:
+                self.__expire_connections()
+            for worker in self.__workers:
+                if not worker.is_alive():
+                    raise SystemExit(f'Shard worker {worker.pid} exited with {worker.exitcode}')
 
 
 def main(args):
-    session = ServerSession(args)
+    validate_args(args)
+    session = ShardedServer(args) if args.shards else ServerSession(args)
     session.serve()
 
 
@@ -38,8 +333,57 @@ if __name__=="__main__":
     parser.add_argument('--RDB_persistence', type=bool, default=True, help="True if RDB persistence needed.")
     parser.add_argument('--RDB_timeout', default=30, type=int, help="Save dataset state every x minutes")
     parser.add_argument('--AOF_persistence', type=bool, default=True, help="True if AOF persistence needed.")
+    parser.add_argument('--appendfsync', default='everysec', choices=['always', 'everysec', 'no'],
+                        help="When to fsync the append only log: every write, once a second, or leave it to the OS.")
+    parser.add_argument('--auto_aof_rewrite_percentage', default=100, type=int,
+                        help="Rewrite the log in the background once it grew this many percent since the last "
+                             "rewrite, 0 disables automatic rewrites.")
+    parser.add_argument('--auto_aof_rewrite_min_size', default=64, type=int,
+                        help="Minimum log size in MB for automatic rewrites.")
+    parser.add_argument('--maxmemory', default=0, type=int,
+                        help="Memory limit in MB for the dataset, 0 for no limit.")
+    parser.add_argument('--maxmemory_policy', default='noeviction',
+                        choices=['noeviction', 'allkeys-lru', 'allkeys-lfu', 'allkeys-random', 'volatile-lru',
+                                 'volatile-lfu', 'volatile-random', 'volatile-ttl'],
+                        help="Which keys to evict once maxmemory is reached, noeviction rejects writes instead.")
+    parser.add_argument('--maxmemory_samples', default=5, type=int,
+                        help="Keys sampled per eviction, more is closer to exact LRU/LFU but slower.")
+    parser.add_argument('--lazyfree', action='store_true',
+                        help="Free big values dropped by DEL, overwrites, expiry and eviction incrementally between "
+                             "commands, as UNLINK always does.")
+    parser.add_argument('--lazyfree_threshold', default=1024, type=int,
+                        help="Sorted sets of more members than this are freed lazily by UNLINK and --lazyfree.")
+    parser.add_argument('--bloom_error_rate', default=None, type=float,
+                        help="Keep a Bloom filter over each database's keys with this false positive rate, eg. 0.01, "
+                             "so lookups of absent keys skip the keyspace. Off by default.")
+    parser.add_argument('--compression', default=None, choices=['zlib', 'lzma'],
+                        help="Keep big string values compressed with this codec, in memory, the log and snapshots.")
+    parser.add_argument('--compression_min_size', default=1024, type=int,
+                        help="Characters a string value needs for --compression to apply to it.")
+    parser.add_argument('--slowlog_log_slower_than', default=10000, type=int,
+                        help="Log commands taking longer than this many microseconds to SLOWLOG, 0 logs every "
+                             "command, a negative value none.")
+    parser.add_argument('--slowlog_max_len', default=128, type=int, help="Entries SLOWLOG keeps.")
+    parser.add_argument('--no_latency_tracking', dest='latency_tracking', action='store_false',
+                        help="Skip the per command latency histograms of INFO latencystats and LATENCY HISTOGRAM.")
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--port', default=5698, type=int, help='port to serve at')
+    parser.add_argument('--timeout', default=300, type=int,
+                        help="Forget a client's SELECT, MULTI, WATCH and CLIENT TRACKING after it has been idle this "
+                             "many seconds, 0 never. client.py selects its database again on its own.")
+    parser.add_argument('--serve_mode', default='router', choices=['router', 'rep'],
+                        help='router: concurrent ROUTER socket, rep: legacy one-request-at-a-time REQ/REP loop')
+    parser.add_argument('--shards', default=0, type=int,
+                        help='Spread the keys over this many worker processes on ports port+1 to port+shards, '
+                             'the front on port routes every command to its shard. 0 serves from a single process.')
+    parser.add_argument('--replication_port', default=None, type=int,
+                        help='Publish every write on this port for replicas to follow, sharded servers use one port '
+                             'per shard from this one on.')
+    parser.add_argument('--replicaof', default=None, metavar='HOST:PORT',
+                        help='Run as a read only replica of the server at HOST:PORT, which needs --replication_port.')
+    parser.add_argument('--tracking_port', default=None, type=int,
+                        help='Publish CLIENT TRACKING invalidations on this port, sharded servers use one port per '
+                             'shard from this one on, for clients connected to the shards directly.')
     main_args = parser.parse_args()
 
     main(main_args)